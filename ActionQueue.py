@@ -0,0 +1,171 @@
+"""
+Per-device, persistent queue of the actions sent to the Beacon devices.
+
+An action is queued either for one device or, without device ID, for the shared
+queue that is delivered to the legacy callers of /get-actions (who don't say
+who they are). The queue is kept in memory and persisted through Database.py
+(database/actions.json), so queued actions survive a restart.
+
+Delivery modes:
+    -Without acknowledgement the actions are removed as soon as they are delivered
+     (the original behavior).
+    -With acknowledgement the delivered actions are only leased for ACK_TIMEOUT
+     seconds, and are delivered again unless they are acknowledged in time.
+
+Take() can wait for new actions (long polling), so a Beacon gets its commands as
+soon as they are queued instead of at its next poll.
+"""
+import datetime
+import threading
+import time
+import uuid
+
+from tinydb import Query
+
+import Database
+
+# Seconds after which an unacknowledged action is delivered again
+ACK_TIMEOUT = 60.0
+
+# Upper limit of the long polling wait, in seconds
+MAX_WAIT = 60.0
+
+_queue = None
+_queueLock = threading.Lock()
+
+
+class ActionQueue:
+    """Actions waiting for delivery, grouped by device (None is the shared queue)."""
+
+    def __init__(self, db):
+        self._db = db
+        self._condition = threading.Condition()
+        self._actions = {}
+        self._listeners = []
+
+        for doc in db.all():
+            action = dict(doc)
+            self._actions.setdefault(action.get("deviceId"), []).append(action)
+
+    def push(self, action, deviceId=None):
+        """
+        Queue an action.
+
+        :param action: The action name, e.g. "take-photo".
+        :param deviceId: The target device, None for the shared queue.
+        :return: The ID of the queued action.
+        """
+        record = {
+            "id": uuid.uuid4().hex,
+            "deviceId": deviceId,
+            "action": action,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "leasedUntil": None,
+        }
+
+        with self._condition:
+            self._db.insert(record)
+            self._actions.setdefault(deviceId, []).append(record)
+            self._condition.notify_all()
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            listener(deviceId)
+
+        return record["id"]
+
+    def _available(self, deviceId, now):
+        queues = [self._actions.get(None, [])]
+        if deviceId is not None:
+            queues.insert(0, self._actions.get(deviceId, []))
+
+        return [action for queue in queues for action in queue
+                if action["leasedUntil"] is None or action["leasedUntil"] <= now]
+
+    def take(self, deviceId=None, wait=0, ack=False):
+        """
+        Return the actions waiting for a device (and the shared ones).
+
+        :param deviceId: The device asking for its actions, None for the shared queue only.
+        :param wait: Seconds to wait for an action if there is none yet.
+        :param ack: If True the actions are only leased until acknowledged, otherwise they are removed.
+        :return: List of {"id", "action"} dicts.
+        """
+        deadline = time.monotonic() + min(max(wait or 0, 0), MAX_WAIT)
+
+        with self._condition:
+            while True:
+                now = time.time()
+                actions = self._available(deviceId, now)
+                remaining = deadline - time.monotonic()
+                if actions or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            if not actions:
+                return []
+
+            ids = [action["id"] for action in actions]
+            if ack:
+                leasedUntil = now + ACK_TIMEOUT
+                for action in actions:
+                    action["leasedUntil"] = leasedUntil
+                self._db.update({"leasedUntil": leasedUntil}, Query().id.one_of(ids))
+            else:
+                self._remove(ids)
+
+            return [{"id": action["id"], "action": action["action"]} for action in actions]
+
+    def ack(self, ids):
+        """
+        Acknowledge delivered actions, so they are not delivered again.
+
+        :param ids: List of action IDs (strings).
+        :return: The number of removed actions.
+        :raises ValueError: If ids is not a list of strings.
+        """
+        if not isinstance(ids, list) or not all(isinstance(actionId, str) for actionId in ids):
+            raise ValueError("'ids' must be a list of action IDs.")
+        with self._condition:
+            return self._remove(ids)
+
+    def _remove(self, ids):
+        ids = set(ids)
+        removed = 0
+
+        for deviceId, queue in list(self._actions.items()):
+            kept = [action for action in queue if action["id"] not in ids]
+            removed += len(queue) - len(kept)
+            if kept:
+                self._actions[deviceId] = kept
+            else:
+                del self._actions[deviceId]
+
+        if removed:
+            self._db.remove(Query().id.one_of(list(ids)))
+        return removed
+
+    def pending(self, deviceId=None):
+        """Number of actions queued for the device (including the shared ones)."""
+        with self._condition:
+            return len(self._available(deviceId, float("inf")))
+
+    def subscribe(self, listener):
+        """Call listener(deviceId) whenever an action is queued (deviceId is None for shared actions)."""
+        with self._condition:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._condition:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+
+def Get():
+    """Return the shared action queue of the server."""
+    global _queue
+
+    with _queueLock:
+        if _queue is None:
+            _queue = ActionQueue(Database.Get("actions"))
+        return _queue
@@ -0,0 +1,234 @@
+"""
+Glitch-free playback of the received WebRTC audio.
+
+Blocking in the event loop, as a call to sd.play() per 20 ms frame does, stalls the
+signaling and leaves gaps between the frames. Here the audio takes two sides instead:
+
+    asyncio task  --write()-->  RingBuffer  --callback-->  sounddevice.OutputStream
+
+-The receiving task only copies the decoded samples into a NumPy ring buffer, which
+ never blocks.
+-One persistent OutputStream pulls the samples from PortAudio's own audio thread.
+
+The ring buffer has one writer and one reader. Each side only moves its own index,
+so no lock is needed.
+
+Jitter buffer: the playback starts (and restarts after an underrun) only when
+PREBUFFER_MS of audio is waiting. If more than MAX_LATENCY_MS piles up, for example
+after a network burst, the oldest samples are dropped so the delay stays bounded.
+
+Frames whose sample rate differs from the output device are resampled with linear
+interpolation.
+"""
+import numpy as np
+import sounddevice as sd
+
+# Audio buffered before the playback starts (and restarts after an underrun)
+PREBUFFER_MS = 60
+
+# Buffered audio above which the oldest samples are dropped
+MAX_LATENCY_MS = 200
+
+# Capacity of the ring buffer
+BUFFER_MS = 1000
+
+# Samples per OutputStream callback (0: chosen by PortAudio)
+BLOCK_SIZE = 0
+
+
+class RingBuffer:
+    """Fixed size NumPy ring buffer with one writer thread and one reader thread."""
+
+    def __init__(self, capacity, channels):
+        self.data = np.zeros((capacity, channels), dtype=np.float32)
+        self.capacity = capacity
+        # Total samples written / read; only the writer moves 'written', only the reader moves 'read'
+        self.written = 0
+        self.read = 0
+
+    def available(self):
+        """Number of samples waiting to be read."""
+        return self.written - self.read
+
+    def write(self, samples):
+        """
+        Append samples; the ones not fitting in the free space are dropped.
+
+        :return: Number of samples written.
+        """
+        count = min(len(samples), self.capacity - self.available())
+        start = self.written % self.capacity
+        first = min(count, self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:count - first] = samples[first:count]
+        self.written += count
+        return count
+
+    def read_into(self, out):
+        """
+        Fill 'out' with the oldest samples.
+
+        :return: Number of samples copied; the rest of 'out' is left untouched.
+        """
+        count = min(len(out), self.available())
+        start = self.read % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self.data[start:start + first]
+        out[first:count] = self.data[:count - first]
+        self.read += count
+        return count
+
+    def skip(self, count):
+        """Drop the 'count' oldest samples (called by the reader)."""
+        self.read += min(count, self.available())
+
+
+class AudioPlayer:
+    """Persistent audio output, fed with the frames of a WebRTC track."""
+
+    def __init__(self, sampleRate=48000, channels=2, device=None):
+        """
+        :param sampleRate: Sample rate of the output stream.
+        :param channels: Channels of the output stream.
+        :param device: sounddevice output device (default device if None).
+        """
+        self.sampleRate = sampleRate
+        self.channels = channels
+        self.device = device
+        self.buffer = RingBuffer(sampleRate * BUFFER_MS // 1000, channels)
+        self.prebuffer = sampleRate * PREBUFFER_MS // 1000
+        self.maxBuffered = sampleRate * MAX_LATENCY_MS // 1000
+        self.stream = None
+        self.playing = False
+        # Every counter is only moved by one side (writer or audio thread), so no lock is needed
+        self.metrics = {"frames": 0, "resampled": 0, "overflows": 0, "dropped": 0,
+                        "underruns": 0, "skipped": 0, "statusErrors": 0}
+
+    def start(self):
+        self.stream = sd.OutputStream(samplerate=self.sampleRate, channels=self.channels, dtype="float32",
+                                      blocksize=BLOCK_SIZE, device=self.device, callback=self._callback)
+        self.stream.start()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, name, value=1):
+        self.metrics[name] += value
+
+    def write_frame(self, frame):
+        """
+        Queue one decoded av.AudioFrame for playback. Never blocks.
+
+        :param frame: The frame returned by the track's recv().
+        """
+        samples = frame.to_ndarray()
+        frameChannels = len(frame.layout.channels)
+
+        # Planar formats are (channels, samples), packed ones (1, samples * channels)
+        if frame.format.is_planar:
+            samples = samples.T
+        else:
+            samples = samples.reshape(-1, frameChannels)
+
+        if np.issubdtype(samples.dtype, np.integer):
+            samples = samples.astype(np.float32) / np.iinfo(samples.dtype).max
+        else:
+            samples = samples.astype(np.float32, copy=False)
+
+        self.write(samples, frame.sample_rate)
+
+    def write(self, samples, sampleRate=None):
+        """
+        Queue float32 samples of shape (samples, channels) for playback. Never blocks.
+
+        :param samples: The samples, between -1.0 and 1.0.
+        :param sampleRate: Their sample rate, resampled to the output's if it differs.
+        """
+        samples = self._match_channels(samples)
+        if sampleRate and sampleRate != self.sampleRate:
+            samples = Resample(samples, sampleRate, self.sampleRate)
+            self._count("resampled")
+
+        written = self.buffer.write(samples)
+        self._count("frames")
+        if written < len(samples):
+            self._count("overflows")
+            self._count("dropped", len(samples) - written)
+
+    def _match_channels(self, samples):
+        if samples.shape[1] == self.channels:
+            return samples
+        if samples.shape[1] == 1:
+            return np.repeat(samples, self.channels, axis=1)
+        # Downmix to mono, then spread to the output channels
+        return np.repeat(samples.mean(axis=1, keepdims=True), self.channels, axis=1)
+
+    def _callback(self, outdata, frames, time, status):
+        """Runs on PortAudio's thread: must not block or allocate much."""
+        if status:
+            self._count("statusErrors")
+
+        available = self.buffer.available()
+
+        # Jitter buffer: wait until enough audio has arrived
+        if not self.playing:
+            if available < self.prebuffer:
+                outdata.fill(0)
+                return
+            self.playing = True
+
+        # Bound the latency: drop what is above the limit
+        if available > self.maxBuffered:
+            excess = available - self.prebuffer
+            self.buffer.skip(excess)
+            self._count("skipped", excess)
+
+        copied = self.buffer.read_into(outdata)
+        if copied < frames:
+            outdata[copied:].fill(0)
+            self.playing = False
+            self._count("underruns")
+
+    def latency(self):
+        """Current playback delay in seconds: the buffered audio plus the output device's latency."""
+        deviceLatency = self.stream.latency if self.stream is not None else 0.0
+        return self.buffer.available() / self.sampleRate + deviceLatency
+
+    def stats(self):
+        """Return the playback metrics."""
+        stats = dict(self.metrics)
+        stats["bufferedMs"] = round(self.buffer.available() * 1000 / self.sampleRate, 1)
+        stats["latencyMs"] = round(self.latency() * 1000, 1)
+        stats["playing"] = self.playing
+        return stats
+
+
+def Resample(samples, sourceRate, targetRate):
+    """
+    Resample (samples, channels) float32 audio with linear interpolation.
+
+    :param samples: The audio samples.
+    :param sourceRate: Their sample rate.
+    :param targetRate: The required sample rate.
+    """
+    count = len(samples)
+    targetCount = int(round(count * targetRate / sourceRate))
+    if count == 0 or targetCount == 0:
+        return np.zeros((0, samples.shape[1]), dtype=np.float32)
+
+    positions = np.arange(targetCount) * (sourceRate / targetRate)
+    indices = np.arange(count)
+    out = np.empty((targetCount, samples.shape[1]), dtype=np.float32)
+    for channel in range(samples.shape[1]):
+        out[:, channel] = np.interp(positions, indices, samples[:, channel])
+    return out
@@ -0,0 +1,289 @@
+"""
+Server-side fan-out of the Beacon microphone (SFU-style relay).
+
+The Beacon publishes its microphone once, to the server. Every listener gets its own
+peer connection from the server, and they all share the one upstream track through
+aiortc's MediaRelay. The Beacon's CPU and uplink use stay the same however many
+operators listen. The upstream is decoded once; every listener's RTCRtpSender
+encodes the shared frames again, so the server's CPU use grows with the listeners.
+
+Offer/answer goes over plain HTTP (see /audio/publish and /audio/listen in app.py).
+aiortc gathers every ICE candidate before the description is returned, so one
+request/response is enough and no trickle ICE is needed.
+
+    Beacon  --offer-->  POST /audio/publish?deviceId=Beacon_1   <--answer--
+    Client  --offer-->  POST /audio/listen?deviceId=Beacon_1    <--answer--
+
+The upstream can also be recorded to disk on the server:
+
+    recordings/<deviceId>/<YYYYmmddHHMMSS>.wav
+
+aiortc runs on its own asyncio event loop in a background thread; the Flask
+handlers submit coroutines to it and wait for the result.
+
+aiortc is optional: without it the relay endpoints answer 503.
+"""
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import os
+import threading
+
+import ImageStore
+
+try:
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.contrib.media import MediaBlackhole, MediaRecorder, MediaRelay
+except ImportError:
+    RTCPeerConnection = None
+
+log = logging.getLogger(__name__)
+
+RECORDINGS_DIR = "recordings"
+
+# Seconds a Flask handler waits for the event loop to negotiate a connection
+NEGOTIATION_TIMEOUT = 15.0
+
+# Listener connections per device
+MAX_LISTENERS = 32
+
+_loop = None
+_loopLock = threading.Lock()
+_sessions = {}
+_record = False
+_recordingsDir = RECORDINGS_DIR
+
+
+def Available():
+    """True if aiortc is installed, so the audio can be relayed."""
+    return RTCPeerConnection is not None
+
+
+def _ParseBool(value):
+    # JSON booleans, or the strings of a query string / form ("true", "1", "yes", "on")
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def Configure(record=None, recordingsDir=None):
+    """
+    Set the recording options of the sessions published from now on.
+
+    :param record: Record every published upstream to disk by default.
+    :param recordingsDir: Directory of the recordings.
+    """
+    global _record, _recordingsDir
+    if record is not None:
+        _record = _ParseBool(record)
+    if recordingsDir:
+        _recordingsDir = recordingsDir
+
+
+class RelaySession:
+    """The upstream connection of one Beacon and the listeners sharing its track."""
+
+    def __init__(self, deviceId, pc):
+        self.deviceId = deviceId
+        self.pc = pc
+        self.track = None
+        self.relay = MediaRelay()
+        self.listeners = set()
+        self.sink = None
+        self.recording = None
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+
+    def to_dict(self):
+        return {
+            "deviceId": self.deviceId,
+            "state": self.pc.connectionState,
+            "listeners": len(self.listeners),
+            "recording": self.recording,
+            "started": self.started.isoformat(),
+        }
+
+    async def start_sink(self, record):
+        """Consume the upstream, into a recording or a blackhole, so it keeps flowing without listeners."""
+        if record:
+            # The device ID becomes a folder name, sanitized like the image folders
+            folder = os.path.join(_recordingsDir, ImageStore._SafeDeviceId(self.deviceId))
+            os.makedirs(folder, exist_ok=True)
+            self.recording = os.path.join(folder, datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".wav")
+            self.sink = MediaRecorder(self.recording)
+        else:
+            self.sink = MediaBlackhole()
+        self.sink.addTrack(self.relay.subscribe(self.track))
+        await self.sink.start()
+
+    async def close(self):
+        for pc in list(self.listeners):
+            await pc.close()
+        self.listeners.clear()
+        if self.sink is not None:
+            await self.sink.stop()
+            self.sink = None
+        await self.pc.close()
+
+
+def _Loop():
+    """Return the relay's event loop, starting its thread on first use."""
+    global _loop
+    with _loopLock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="audio-relay", daemon=True).start()
+        return _loop
+
+
+def _Run(coroutine):
+    """
+    Run a coroutine on the relay's event loop and wait for its result.
+
+    :raises TimeoutError: If it takes more than NEGOTIATION_TIMEOUT seconds; the coroutine is cancelled.
+    """
+    future = asyncio.run_coroutine_threadsafe(coroutine, _Loop())
+    try:
+        return future.result(NEGOTIATION_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # The coroutine closes its half-negotiated connection when it is cancelled
+        future.cancel()
+        raise TimeoutError(f"The negotiation took more than {NEGOTIATION_TIMEOUT:g} seconds.") from None
+
+
+def _Description(offer):
+    if not isinstance(offer, dict) or offer.get("type") != "offer" or not offer.get("sdp"):
+        raise ValueError("An SDP offer ('sdp' and type 'offer') is required.")
+    return RTCSessionDescription(sdp=offer["sdp"], type="offer")
+
+
+async def _Publish(deviceId, description, record):
+    pc = RTCPeerConnection()
+    session = RelaySession(deviceId, pc)
+    gotTrack = asyncio.Event()
+
+    @pc.on("track")
+    def on_track(track):
+        if track.kind == "audio" and session.track is None:
+            session.track = track
+            gotTrack.set()
+
+    @pc.on("connectionstatechange")
+    async def on_state():
+        if pc.connectionState in ("failed", "closed") and _sessions.get(deviceId) is session:
+            del _sessions[deviceId]
+            await session.close()
+            log.info("%s stopped publishing", deviceId)
+
+    try:
+        await pc.setRemoteDescription(description)
+        if not gotTrack.is_set():
+            raise ValueError("The offer has no audio track.")
+
+        # The previous upstream is only replaced by a valid offer
+        previous = _sessions.pop(deviceId, None)
+        if previous is not None:
+            await previous.close()
+
+        await session.start_sink(record)
+        await pc.setLocalDescription(await pc.createAnswer())
+    except BaseException:
+        # Also on cancellation (timeout): nothing of the failed negotiation stays open
+        await session.close()
+        raise
+
+    _sessions[deviceId] = session
+    log.info("%s publishing, recording to %s", deviceId, session.recording)
+    return {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+
+
+async def _Listen(deviceId, description):
+    session = _sessions.get(deviceId)
+    if session is None:
+        raise LookupError(f"{deviceId} is not publishing audio.")
+    if len(session.listeners) >= MAX_LISTENERS:
+        raise OverflowError(f"{deviceId} already has {MAX_LISTENERS} listeners.")
+
+    pc = RTCPeerConnection()
+
+    @pc.on("connectionstatechange")
+    async def on_state():
+        if pc.connectionState in ("failed", "closed"):
+            session.listeners.discard(pc)
+            await pc.close()
+
+    try:
+        await pc.setRemoteDescription(description)
+        # Every listener reads the same upstream track, decoded once for all of them
+        pc.addTrack(session.relay.subscribe(session.track, buffered=False))
+        await pc.setLocalDescription(await pc.createAnswer())
+        # Other listeners may have been negotiated meanwhile
+        if len(session.listeners) >= MAX_LISTENERS:
+            raise OverflowError(f"{deviceId} already has {MAX_LISTENERS} listeners.")
+    except BaseException:
+        # A failed negotiation does not take a listener slot
+        await pc.close()
+        raise
+
+    # Registered only now, so a bad offer never counts against MAX_LISTENERS
+    session.listeners.add(pc)
+    return {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+
+
+async def _Stop(deviceId):
+    session = _sessions.pop(deviceId, None)
+    if session is None:
+        return False
+    await session.close()
+    return True
+
+
+def Publish(deviceId, offer, record=None):
+    """
+    Accept the microphone of a Beacon; it replaces the device's previous upstream.
+
+    :param deviceId: The ID of the publishing Beacon.
+    :param offer: The Beacon's offer ({"sdp": ..., "type": "offer"}) with one audio track.
+    :param record: Record the upstream to disk (defaults to the configured setting).
+    :return: The server's answer ({"sdp": ..., "type": "answer"}).
+    :raises ValueError: If the offer is invalid.
+    :raises TimeoutError: If the negotiation takes more than NEGOTIATION_TIMEOUT seconds.
+    """
+    return _Run(_Publish(deviceId, _Description(offer), _record if record is None else _ParseBool(record)))
+
+
+def Listen(deviceId, offer):
+    """
+    Connect a listener to the audio published by a Beacon.
+
+    :param deviceId: The ID of the Beacon to listen to.
+    :param offer: The listener's offer with a receive-only audio transceiver.
+    :return: The server's answer.
+    :raises ValueError: If the offer is invalid.
+    :raises LookupError: If the Beacon is not publishing.
+    :raises OverflowError: If the Beacon already has MAX_LISTENERS listeners.
+    :raises TimeoutError: If the negotiation takes more than NEGOTIATION_TIMEOUT seconds.
+    """
+    return _Run(_Listen(deviceId, _Description(offer)))
+
+
+def Stop(deviceId):
+    """Close the upstream of a Beacon and all of its listeners; False if it was not publishing."""
+    return _Run(_Stop(deviceId))
+
+
+def Sessions():
+    """Return the state of every published upstream."""
+    return [session.to_dict() for session in list(_sessions.values())]
+
+
+def Shutdown():
+    """Close every session and stop the event loop."""
+    global _loop
+    with _loopLock:
+        loop, _loop = _loop, None
+    if loop is None:
+        return
+    for deviceId in list(_sessions):
+        asyncio.run_coroutine_threadsafe(_Stop(deviceId), loop).result(NEGOTIATION_TIMEOUT)
+    loop.call_soon_threadsafe(loop.stop)
@@ -0,0 +1,142 @@
+"""
+In-memory caches of the authentication hot path.
+
+TokenCache: the verified access tokens. A token whose signature was checked once is
+looked up by its SHA-256 digest on the next requests, instead of going through
+jwt.decode (header parsing, HMAC verification, claim checks) again. Entries live
+until the token's own 'exp', and the least recently used ones are evicted above
+MAX_TOKENS.
+
+CredentialCache: the recently verified username/password pairs. check_password_hash
+is deliberately slow (PBKDF2/scrypt), so a fleet of Beacons logging in again and
+again would keep the CPU busy. A pair is remembered for CREDENTIALS_TTL seconds,
+as an HMAC with a random per-process key that also covers the stored password
+hash. Changing the password therefore invalidates the entry, and the plain
+passwords are never kept.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Verified tokens kept in memory
+MAX_TOKENS = 10000
+
+# Seconds a token without 'exp' claim stays cached
+DEFAULT_TOKEN_TTL = 300
+
+# Verified credentials kept in memory, and for how many seconds
+MAX_CREDENTIALS = 1000
+CREDENTIALS_TTL = 600
+
+_tokens = None
+_credentials = None
+_lock = threading.Lock()
+
+
+class _LRU:
+    """Thread-safe LRU mapping of key -> (value, expiration timestamp)."""
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, expires):
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class TokenCache(_LRU):
+    """Verified token payloads, keyed by the token's SHA-256 digest."""
+
+    def __init__(self, maxEntries=MAX_TOKENS):
+        super().__init__(maxEntries)
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token):
+        """Return the cached payload of a verified, unexpired token, or None."""
+        return super().get(self._key(token))
+
+    def put(self, token, payload):
+        """Remember a token whose signature and claims were verified."""
+        expires = payload.get("exp")
+        if expires is None:
+            expires = time.time() + DEFAULT_TOKEN_TTL
+        super().put(self._key(token), payload, expires)
+
+    def discard(self, token):
+        super().discard(self._key(token))
+
+
+class CredentialCache(_LRU):
+    """Recently verified username/password pairs, as keyed HMACs."""
+
+    def __init__(self, maxEntries=MAX_CREDENTIALS):
+        super().__init__(maxEntries)
+        self._secret = os.urandom(32)
+
+    def _key(self, username, password, passwordHash):
+        message = "\0".join((username, password, passwordHash)).encode("utf-8")
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def verified(self, username, password, passwordHash):
+        """True if this password was checked against this stored hash recently."""
+        return super().get(self._key(username, password, passwordHash)) is not None
+
+    def remember(self, username, password, passwordHash):
+        super().put(self._key(username, password, passwordHash), True, time.time() + CREDENTIALS_TTL)
+
+
+def Tokens():
+    """Return the shared TokenCache."""
+    global _tokens
+    with _lock:
+        if _tokens is None:
+            _tokens = TokenCache()
+        return _tokens
+
+
+def Credentials():
+    """Return the shared CredentialCache."""
+    global _credentials
+    with _lock:
+        if _credentials is None:
+            _credentials = CredentialCache()
+        return _credentials
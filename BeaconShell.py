@@ -1,47 +1,450 @@
 import argparse
+import asyncio
 import base64
+import collections
+import datetime
+import hashlib
+import itertools
+import json
 import os
 import requests
 import sys
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-BASE_URL = "http://127.0.0.1:5000"  # API URL
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-def login(username, password):
-    """Login and get Bearer token."""
-    resp = requests.post(f"{BASE_URL}/login", json={
-        "username": username,
-        "password": password
-    })
+BASE_URL = "http://127.0.0.1:5000"  # API URL
 
-    if resp.status_code != 200:
-        print(f"[Error] Login failed: {resp.text}")
+# Seconds before the expiration when a token is already renewed
+TOKEN_MARGIN = 60
+
+# Seconds to wait for the server (connect, read)
+TIMEOUT = (10, 60)
+
+# Retries of the failed requests, with exponentially growing waits (BACKOFF, 2*BACKOFF, ...)
+RETRIES = 3
+BACKOFF = 0.5
+# Answers retried for the idempotent methods only (IDEMPOTENT_METHODS)
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = Retry.DEFAULT_ALLOWED_METHODS
+
+# Answers of /ingest after which TelemetryBuffer keeps the batch for the next flush (besides 5xx)
+KEEP_STATUSES = (401, 403, 404, 408, 429)
+
+# Kept-alive connections per host
+POOL_SIZE = 10
+
+
+class AuthError(Exception):
+    """The server did not accept the credentials."""
+
+
+class BeaconClient:
+    """
+    Reusable API client of the server.
+
+    -One requests.Session with a pool of kept-alive connections: the TCP (and TLS)
+     handshake is done once, not on every call.
+    -The token is cached until shortly before it expires, renewed through /refresh,
+     and the request is repeated once if the server answers 401.
+    -Failed connection attempts are retried with backoff for every request. Read errors
+     and 429/502/503/504 answers are only retried for idempotent requests (GET, PUT,
+     DELETE...), never for POST, so a message or image is never sent twice.
+    """
+
+    def __init__(self, username, password, baseUrl=None, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT, poolSize=POOL_SIZE):
+        self.username = username
+        self.password = password
+        self.baseUrl = baseUrl or BASE_URL
+        self.timeout = timeout
+        self.token = None
+        self.refreshToken = None
+        self.expires = 0
+
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=IDEMPOTENT_METHODS, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _store_tokens(self, body):
+        self.token = body["access_token"]
+        self.refreshToken = body.get("refresh_token", self.refreshToken)
+        self.expires = time.time() + body.get("expires_in", 0)
+        return self.token
+
+    def login(self):
+        """Log in with the password and return the new access token."""
+        resp = self.session.post(f"{self.baseUrl}/login", json={"username": self.username, "password": self.password}, timeout=self.timeout)
+        if resp.status_code != 200 or not resp.json().get("access_token"):
+            raise AuthError(f"Login failed: {resp.text}")
+        return self._store_tokens(resp.json())
+
+    def refresh(self):
+        """Renew the access token with the refresh token, or log in again if it is not accepted."""
+        if self.refreshToken:
+            resp = self.session.post(f"{self.baseUrl}/refresh", json={"refresh_token": self.refreshToken}, timeout=self.timeout)
+            if resp.status_code == 200:
+                return self._store_tokens(resp.json())
+        return self.login()
+
+    def get_token(self):
+        """Return a valid access token: the cached one, a refreshed one, or a new login."""
+        if self.token is None:
+            return self.login()
+        if self.expires - TOKEN_MARGIN <= time.time():
+            return self.refresh()
+        return self.token
+
+    def request(self, method, endpoint, **kwargs):
+        """
+        Call an API endpoint with the Bearer token.
+
+        :param method: HTTP method.
+        :param endpoint: Path of the endpoint, e.g. "/get-devices".
+        :param kwargs: Passed to requests (json, params, data, headers...).
+        :return: The requests.Response.
+        """
+        headers = dict(kwargs.pop("headers", None) or {})
+        kwargs.setdefault("timeout", self.timeout)
+        url = f"{self.baseUrl}{endpoint}"
+
+        headers["Authorization"] = f"Bearer {self.get_token()}"
+        resp = self.session.request(method, url, headers=headers, **kwargs)
+
+        # Expired or revoked on the server side: renew once and repeat (not possible for a consumed stream)
+        if resp.status_code == 401 and not hasattr(kwargs.get("data"), "read"):
+            headers["Authorization"] = f"Bearer {self.refresh()}"
+            resp = self.session.request(method, url, headers=headers, **kwargs)
+        return resp
+
+    def get(self, endpoint, **kwargs):
+        return self.request("GET", endpoint, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        return self.request("POST", endpoint, **kwargs)
+
+    def ping(self):
+        return self.get("/ping")
+
+    def send_message(self, deviceId, message):
+        return self.post("/send-message", json={"deviceId": deviceId, "message": message})
+
+    def send_info(self, deviceId, batteryLevel=None, coreTemp=None, houseTemp=None, **fields):
+        return self.post("/send-info", json={"deviceId": deviceId, "batteryLevel": batteryLevel, "coreTemp": coreTemp, "houseTemp": houseTemp, **fields})
+
+    def ingest(self, items, deviceId=None):
+        """Send many readings and messages in one request (see TelemetryBuffer)."""
+        return self.post("/ingest", json={"deviceId": deviceId, "items": items})
+
+    def get_devices(self):
+        return self.get("/get-devices")
+
+    def get_device_info(self, deviceId):
+        return self.get("/get-device-info", params={"deviceId": deviceId})
+
+    def get_camera_configuration(self, deviceId=None):
+        return self.get("/get-camera-configuration", params={"deviceId": deviceId} if deviceId else None)
+
+    def configure_camera(self, cameraConfig, deviceId=None):
+        return self.post("/configure-camera", json=cameraConfig, params={"deviceId": deviceId} if deviceId else None)
+
+    def send_image(self, imagePath, deviceId=None, stream=False):
+        """Send an image as a raw image/png body (stream=True, read in chunks) or base64 encoded in JSON."""
+        if stream:
+            params = {"deviceId": deviceId} if deviceId else None
+            with open(imagePath, "rb") as img_file:
+                return self.post("/send-image", params=params, data=img_file, headers={"Content-Type": "image/png"})
+
+        with open(imagePath, "rb") as img_file:
+            payload = {"image": base64.b64encode(img_file.read()).decode("utf-8")}
+        if deviceId:
+            payload["deviceId"] = deviceId
+        return self.post("/send-image", json=payload)
+
+
+class TelemetryBuffer:
+    """
+    Readings and messages collected locally and sent to /ingest in bulk.
+
+    One request carries up to BATCH_SIZE items instead of one request each. If the
+    server is unreachable or busy, the items are kept and sent by the next flush();
+    the items it rejects as invalid are dropped. With a 'path' they are also written
+    to a JSON lines file, so they survive a restart of the Beacon. Above 'maxItems'
+    the oldest items are dropped.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, path=None, maxItems=10000):
+        self.path = path
+        self.items = collections.deque(maxlen=maxItems)
+
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.items.extend(json.loads(line) for line in f if line.strip())
+
+    def __len__(self):
+        return len(self.items)
+
+    def _append(self, item):
+        self.items.append(item)
+        if self.path:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(item) + "\n")
+
+    def add_info(self, deviceId, **fields):
+        """Record a telemetry reading (batteryLevel, coreTemp, ...) with the current time."""
+        self._append({"type": "info", "deviceId": deviceId, "timestamp": _Now(), **fields})
+
+    def add_message(self, deviceId, message):
+        self._append({"type": "message", "deviceId": deviceId, "message": message, "timestamp": _Now()})
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(item) + "\n" for item in self.items)
+        os.replace(tmp, self.path)
+
+    def flush(self, client):
+        """
+        Send the buffered items in batches.
+
+        :param client: The BeaconClient to send with.
+        :return: True if everything was sent, False if some items are kept for the next flush.
+        """
+        sent = True
+        try:
+            while self.items:
+                batch = list(itertools.islice(self.items, self.BATCH_SIZE))
+                resp = client.ingest(batch)
+
+                # Nothing of a rejected batch is stored: drop the invalid items, send the others again
+                if resp.status_code == 400:
+                    rejected = {entry.get("index") for entry in _JsonBody(resp).get("rejected") or []}
+                    if rejected:
+                        print(f"[Error] {len(rejected)} items rejected by the server and dropped: {resp.text}")
+                        for _ in batch:
+                            self.items.popleft()
+                        self.items.extendleft(reversed([item for index, item in enumerate(batch) if index not in rejected]))
+                        continue
+
+                # Server errors, rate limits, refused credentials and servers without /ingest: try again later
+                if resp.status_code >= 500 or resp.status_code in KEEP_STATUSES:
+                    print(f"[Warning] Ingest failed ({resp.status_code}), {len(self.items)} items kept")
+                    sent = False
+                    break
+
+                # Any other answer would be the same next time, so the batch is dropped
+                if resp.status_code != 200:
+                    print(f"[Error] Ingest failed, {len(batch)} items dropped: {resp.text}")
+                for _ in batch:
+                    self.items.popleft()
+        except (requests.RequestException, AuthError) as e:
+            print(f"[Warning] Server unreachable, {len(self.items)} items kept: {e}")
+            sent = False
+
+        self._save()
+        return sent
+
+
+def _Now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _JsonBody(resp):
+    try:
+        body = resp.json()
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+class AsyncBeaconClient:
+    """
+    asyncio (aiohttp) variant of BeaconClient for tools with many concurrent requests.
+
+    The methods are coroutines returning (status, parsed body); the body is the JSON
+    answer, or the text if it is not JSON. Retries follow the rules of BeaconClient.
+    """
+
+    def __init__(self, username, password, baseUrl=None, retries=RETRIES, backoff=BACKOFF, limit=POOL_SIZE, ssl=None, traceConfigs=None):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required by AsyncBeaconClient")
+        self.username = username
+        self.password = password
+        self.baseUrl = baseUrl or BASE_URL
+        self.retries = retries
+        self.backoff = backoff
+        self.token = None
+        self.refreshToken = None
+        self.expires = 0
+        self._authLock = asyncio.Lock()
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit, ssl=ssl),
+                                             timeout=aiohttp.ClientTimeout(sock_connect=TIMEOUT[0], sock_read=TIMEOUT[1]),
+                                             trace_configs=traceConfigs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.session.close()
+
+    def _store_tokens(self, body):
+        self.token = body["access_token"]
+        self.refreshToken = body.get("refresh_token", self.refreshToken)
+        self.expires = time.time() + body.get("expires_in", 0)
+        return self.token
+
+    async def login(self):
+        async with self.session.post(f"{self.baseUrl}/login", json={"username": self.username, "password": self.password}) as resp:
+            body = await resp.json(content_type=None)
+            if resp.status != 200 or not body.get("access_token"):
+                raise AuthError(f"Login failed: {body}")
+            return self._store_tokens(body)
+
+    async def refresh(self, staleToken=None):
+        async with self._authLock:
+            # Another task may have renewed it meanwhile
+            if self.token is not None and self.token != staleToken and self.expires - TOKEN_MARGIN > time.time():
+                return self.token
+            if self.refreshToken:
+                async with self.session.post(f"{self.baseUrl}/refresh", json={"refresh_token": self.refreshToken}) as resp:
+                    if resp.status == 200:
+                        return self._store_tokens(await resp.json())
+            return await self.login()
+
+    async def get_token(self):
+        if self.token is None or self.expires - TOKEN_MARGIN <= time.time():
+            return await self.refresh(self.token)
+        return self.token
+
+    async def request(self, method, endpoint, **kwargs):
+        """Call an API endpoint with the Bearer token; returns (status, body)."""
+        headers = dict(kwargs.pop("headers", None) or {})
+        url = f"{self.baseUrl}{endpoint}"
+        token = await self.get_token()
+        retriedAuth = False
+        attempt = 0
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        while True:
+            headers["Authorization"] = f"Bearer {token}"
+            try:
+                async with self.session.request(method, url, headers=headers, **kwargs) as resp:
+                    status = resp.status
+                    text = await resp.text()
+            except aiohttp.ClientConnectionError as e:
+                # A request that may have reached the server is only repeated if it is idempotent
+                if attempt >= self.retries or not (idempotent or isinstance(e, aiohttp.ClientConnectorError)):
+                    raise
+            else:
+                if status == 401 and not retriedAuth:
+                    retriedAuth = True
+                    token = await self.refresh(token)
+                    continue
+                if status not in RETRY_STATUSES or not idempotent or attempt >= self.retries:
+                    try:
+                        return status, json.loads(text)
+                    except ValueError:
+                        return status, text
+
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    async def get(self, endpoint, **kwargs):
+        return await self.request("GET", endpoint, **kwargs)
+
+    async def post(self, endpoint, **kwargs):
+        return await self.request("POST", endpoint, **kwargs)
+
+    async def send_message(self, deviceId, message):
+        return await self.post("/send-message", json={"deviceId": deviceId, "message": message})
+
+    async def send_info(self, deviceId, **fields):
+        return await self.post("/send-info", json={"deviceId": deviceId, **fields})
+
+
+# (base URL, username, password digest) -> BeaconClient shared by the helper functions below
+_clients = {}
+
+
+def GetClient(username, password):
+    """Return the shared BeaconClient of these credentials (one connection pool and token per user)."""
+    key = (BASE_URL, username, hashlib.sha256(password.encode("utf-8")).hexdigest())
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = BeaconClient(username, password)
+    return client
+
+
+def login(username, password, force=False):
+    """Login and get Bearer token. The token is reused (and refreshed) until it expires, force=True logs in again."""
+    client = GetClient(username, password)
+    try:
+        return client.login() if force else client.get_token()
+    except AuthError as e:
+        print(f"[Error] {e}")
         sys.exit(1)
 
-    token = resp.json().get("access_token")
-    if not token:
-        print("[Error] Don't received access token from server.")
+
+def _PrintResponse(resp):
+    print(f"[API Call] {resp.request.method} {resp.url} - Status: {resp.status_code}")
+
+    try:
+        print(resp.json())
+        return resp.json()
+    except Exception:
+        print(resp.text)
+        return resp.text
+
+
+def _Call(username, password, method, endpoint, **kwargs):
+    try:
+        return _PrintResponse(GetClient(username, password).request(method, endpoint, **kwargs))
+    except AuthError as e:
+        print(f"[Error] {e}")
         sys.exit(1)
-    return token
+
+
+_session = None
 
 
 def call_api(endpoint, token, method="GET", data=None):
-    """API call with Bearer token."""
+    """API call with Bearer token (on a shared, kept-alive session)."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+
     headers = {"Authorization": f"Bearer {token}"}
     url = f"{BASE_URL}{endpoint}"
 
     if method.upper() == "GET":
-        resp = requests.get(url, headers=headers, json=data)
+        resp = _session.get(url, headers=headers, json=data, timeout=TIMEOUT)
     else:
-        resp = requests.post(url, headers=headers, json=data)
-
-    print(f"[API Call] {method} {url} - Status: {resp.status_code}")
+        resp = _session.post(url, headers=headers, json=data, timeout=TIMEOUT)
 
-    try:
-        print(resp.json())
-        return resp.json()
-    except Exception:
-        print(resp.text)
-        return resp.text
+    return _PrintResponse(resp)
 
 def SendMessage(username=None, password=None, deviceId=None, message=None, ask=False):
     if ask:
@@ -50,8 +453,7 @@ def SendMessage(username=None, password=None, deviceId=None, message=None, ask=F
         deviceId = input("Enter Device ID: ")
         message = input("Enter Message: ")
 
-    token = login(username, password)
-    call_api("/send-message", token, "POST", {
+    return _Call(username, password, "POST", "/send-message", json={
         "deviceId": deviceId,
         "message": message
     })
@@ -67,8 +469,7 @@ def SendInfo(username=None, password=None, deviceId=None, batteryLevel=None, cor
         coreTemp = input("Enter Core Temperature: ")
         houseTemp = input("Enter House Temperature: ")
 
-    token = login(username, password)
-    return call_api("/send-info", token, "POST", {
+    return _Call(username, password, "POST", "/send-info", json={
         "deviceId": deviceId,
         "batteryLevel": batteryLevel,
         "coreTemp": coreTemp,
@@ -80,8 +481,7 @@ def GetDevices(username=None, password=None, ask=False):
         username = input("Enter Username: ")
         password = input("Enter Password: ")
 
-    token = login(username, password)
-    return call_api("/get-devices", token)
+    return _Call(username, password, "GET", "/get-devices")
 
 def GetDeviceInfo(username=None, password=None, deviceId=None, ask=False):
     if ask:
@@ -89,8 +489,7 @@ def GetDeviceInfo(username=None, password=None, deviceId=None, ask=False):
         password = input("Enter Password: ")
         deviceId = input("Enter Device ID: ")
 
-    token = login(username, password)
-    return call_api(f"/get-device-info?deviceId={deviceId}", token)
+    return _Call(username, password, "GET", "/get-device-info", params={"deviceId": deviceId})
 
 
 
@@ -99,8 +498,7 @@ def GetCameraConfiguration(username=None, password=None, ask=False):
         username = input("Enter Username: ")
         password = input("Enter Password: ")
 
-    token = login(username, password)
-    return call_api("/get-camera-configuration", token)
+    return _Call(username, password, "GET", "/get-camera-configuration")
 
 def ConfigureCamera(username=None, password=None, cameraConfig=None, ask=False):
     if ask:
@@ -117,50 +515,27 @@ def ConfigureCamera(username=None, password=None, cameraConfig=None, ask=False):
         cameraConfig["iso"] = input("Enter ISO: ")
         cameraConfig["shutter-speed"] = input("Enter Shutter Speed: ")
 
-    token = login(username, password)
-    return call_api("/configure-camera", token, "POST", cameraConfig)
+    return _Call(username, password, "POST", "/configure-camera", json=cameraConfig)
 
 
-def SendImage(username=None, password=None, imagePath=None, ask=False):
-    """Elküldi a képet base64-ben a /send-image végpontnak"""
+def SendImage(username=None, password=None, imagePath=None, deviceId=None, stream=False, ask=False):
+    """Elküldi a képet a /send-image végpontnak (base64 JSON-ben, vagy stream=True esetén nyers image/png törzsként)"""
     if ask:
         username = input("Enter Username: ")
         password = input("Enter Password: ")
         imagePath = input("Image path: ")
 
-    token = login(username, password)
-
     if not os.path.exists(imagePath):
         print(f"[Error] File not found: {imagePath}")
         return
 
-    # Beolvassuk és base64 kódoljuk a képet
-    with open(imagePath, "rb") as img_file:
-        encoded = base64.b64encode(img_file.read()).decode("utf-8")
-
-    payload = {
-        "image": encoded
-    }
-
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
-    url = f"{BASE_URL}/send-image"
-
-    resp = requests.post(url, headers=headers, json=payload)
-
-    print(f"[API Call] POST {url} - Status: {resp.status_code}")
-
     try:
-        print(resp.json())
-        return resp.json()
-    except Exception:
-        print(resp.text)
-        return resp.text
-    
-    
+        # stream=True: a requests a fájlt darabokban küldi el, így nem kell egészben a memóriában tartani
+        return _PrintResponse(GetClient(username, password).send_image(imagePath, deviceId=deviceId, stream=stream))
+    except AuthError as e:
+        print(f"[Error] {e}")
+        sys.exit(1)
+
 
 def main():
     parser = argparse.ArgumentParser(description="Beacon API client")
@@ -169,6 +544,8 @@ def main():
                         choices=["ping", "get-devices", "get-device-info",
                                  "get-messages", "get-images", "send-message", "send-image",
                                  "send-info", "get-camera-configuration", "configure-camera"])
+    parser.add_argument("--stream", action="store_true",
+                        help="send-image: upload the raw PNG instead of base64 JSON")
 
     args = parser.parse_args()
 
@@ -187,7 +564,7 @@ def main():
     elif args.command == "configure-camera":
         ConfigureCamera(ask=True)
     elif args.command == "send-image":
-        SendImage(ask=True)
+        SendImage(stream=args.stream, ask=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,152 @@
+"""
+In-memory, mtime-validated camera configuration with atomic writes.
+
+The parsed configuration is kept in memory, and every read only checks the
+file's mtime and size to notice changes made outside the server. Writes go to a
+temporary file that replaces the configuration with os.replace, so readers
+(in this or in another process) never see a half-written file.
+
+Every Beacon can have its own configuration in database/camera-configs/<deviceId>.json.
+A device without its own file uses the global database/camera-config.json, and
+its first update starts from the global values.
+"""
+import copy
+import datetime
+import json
+import os
+import re
+import threading
+
+GLOBAL_CONFIG_PATH = "database/camera-config.json"
+DEVICE_CONFIG_DIR = "database/camera-configs"
+
+_service = None
+_serviceLock = threading.Lock()
+
+
+class ConfigEntry:
+    """A parsed configuration file and the file state it was read from."""
+
+    __slots__ = ("data", "mtime", "size", "version")
+
+    def __init__(self, data, mtime, size, version):
+        self.data = data
+        self.mtime = mtime
+        self.size = size
+        self.version = version
+
+    @property
+    def etag(self):
+        return f"{self.mtime:x}-{self.size:x}"
+
+    @property
+    def last_modified(self):
+        return datetime.datetime.fromtimestamp(self.mtime // 1_000_000_000, datetime.timezone.utc)
+
+
+class CameraConfigService:
+    """Global and per-device camera configurations, cached in memory."""
+
+    def __init__(self, globalPath=GLOBAL_CONFIG_PATH, deviceDir=DEVICE_CONFIG_DIR):
+        self.globalPath = globalPath
+        self.deviceDir = deviceDir
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._listeners = []
+        # Incremented on every change, so listeners can tell whether they are up to date
+        self.version = 0
+
+    def _devicePath(self, deviceId):
+        if not deviceId:
+            return self.globalPath
+
+        # The device ID becomes a file name, so it must not contain path separators
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", str(deviceId)).strip(".")
+        return os.path.join(self.deviceDir, f"{safe}.json")
+
+    def _path(self, deviceId):
+        path = self._devicePath(deviceId)
+        return path if os.path.exists(path) else self.globalPath
+
+    def _entry(self, path):
+        stat = os.stat(path)
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.mtime == stat.st_mtime_ns and entry.size == stat.st_size:
+                return entry
+
+            # First read, or the file was changed outside the server
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            self.version += 1
+            entry = ConfigEntry(data, stat.st_mtime_ns, stat.st_size, self.version)
+            self._entries[path] = entry
+            return entry
+
+    def get(self, deviceId=None):
+        """
+        Return the camera configuration of a device (or the global one).
+
+        :return: The cached ConfigEntry; its data must not be modified.
+        """
+        return self._entry(self._path(deviceId))
+
+    def update(self, changes, deviceId=None):
+        """
+        Apply changes to the configuration of a device (or the global one) and write it atomically.
+
+        :param changes: The already validated {key: value} changes.
+        :param deviceId: The device to configure, None for the global configuration.
+        :return: The new ConfigEntry.
+        """
+        with self._lock:
+            data = copy.deepcopy(self.get(deviceId).data)
+            data.update(changes)
+
+            path = self._devicePath(deviceId)
+            self._write(path, data)
+
+            stat = os.stat(path)
+            self.version += 1
+            entry = ConfigEntry(data, stat.st_mtime_ns, stat.st_size, self.version)
+            self._entries[path] = entry
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            listener(deviceId)
+
+        return entry
+
+    def subscribe(self, listener):
+        """Call listener(deviceId) after every update (deviceId is None for the global configuration)."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmpPath = f"{path}.tmp"
+        try:
+            with open(tmpPath, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+            os.replace(tmpPath, path)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+
+def Get():
+    """Return the shared camera configuration service."""
+    global _service
+
+    with _serviceLock:
+        if _service is None:
+            _service = CameraConfigService()
+        return _service
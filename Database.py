@@ -0,0 +1,207 @@
+"""
+Long-lived, write-buffered access to the TinyDB JSON files in ./database.
+
+Every file is opened once per process and kept in memory through TinyDB's
+CachingMiddleware, so reads never re-parse the JSON file. Writes are collected
+in memory and flushed back to the very same file by a background thread every
+FLUSH_INTERVAL seconds (or earlier, when MAX_PENDING_WRITES is reached), so the
+on-disk format stays 100% compatible with plain TinyDB.
+
+TinyDB itself is not thread-safe, so every access goes through a per-file lock.
+"""
+import atexit
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from tinydb import TinyDB
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage
+
+import Metrics
+
+log = logging.getLogger(__name__)
+
+DATABASE_DIR = "database"
+
+# Seconds between two background flushes
+FLUSH_INTERVAL = 2.0
+
+# Number of buffered writes after which the file is flushed immediately
+MAX_PENDING_WRITES = 500
+
+_databases = {}
+_databasesLock = threading.Lock()
+_flusher = None
+_stopFlusher = threading.Event()
+
+
+class BufferedDatabase:
+    """
+    A TinyDB database opened once and shared between the request threads.
+
+    The methods mirror the TinyDB table API used by the server, but every call
+    is serialized by a lock and no call touches the disk (except flush).
+    """
+
+    def __init__(self, path, maxPendingWrites=MAX_PENDING_WRITES):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._lock = threading.RLock()
+
+        storage = CachingMiddleware(JSONStorage)
+        storage.WRITE_CACHE_SIZE = maxPendingWrites
+        self._db = TinyDB(path, storage=storage)
+
+    def all(self):
+        with Metrics.STORAGE_LATENCY.time(self.name, "read"), self._lock:
+            return self._db.all()
+
+    def search(self, cond):
+        with Metrics.STORAGE_LATENCY.time(self.name, "read"), self._lock:
+            return self._db.search(cond)
+
+    def get(self, cond):
+        with Metrics.STORAGE_LATENCY.time(self.name, "read"), self._lock:
+            return self._db.get(cond)
+
+    def contains(self, cond):
+        with Metrics.STORAGE_LATENCY.time(self.name, "read"), self._lock:
+            return self._db.contains(cond)
+
+    def count(self, cond):
+        with Metrics.STORAGE_LATENCY.time(self.name, "read"), self._lock:
+            return self._db.count(cond)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._db)
+
+    def insert(self, document):
+        with Metrics.STORAGE_LATENCY.time(self.name, "write"), self._lock:
+            return self._db.insert(document)
+
+    def insert_multiple(self, documents):
+        with Metrics.STORAGE_LATENCY.time(self.name, "write"), self._lock:
+            return self._db.insert_multiple(documents)
+
+    def update(self, fields, cond=None):
+        with Metrics.STORAGE_LATENCY.time(self.name, "write"), self._lock:
+            return self._db.update(fields, cond)
+
+    def upsert(self, document, cond):
+        with Metrics.STORAGE_LATENCY.time(self.name, "write"), self._lock:
+            return self._db.upsert(document, cond)
+
+    def remove(self, cond):
+        with Metrics.STORAGE_LATENCY.time(self.name, "write"), self._lock:
+            return self._db.remove(cond)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the lock for a group of operations and yield the underlying TinyDB,
+        so that a read-modify-write sequence can't interleave with other threads.
+        """
+        with self._lock:
+            yield self._db
+
+    def flush(self):
+        """Write the buffered changes (if any) back to the JSON file."""
+        with Metrics.STORAGE_LATENCY.time(self.name, "flush"), self._lock:
+            self._db.storage.flush()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def Configure(flushInterval=None, maxPendingWrites=None):
+    """
+    Set the flush parameters (usually from the "storage" section of server-config.json).
+
+    :param flushInterval: Seconds between two background flushes.
+    :param maxPendingWrites: Buffered writes after which a flush is forced.
+    """
+    global FLUSH_INTERVAL, MAX_PENDING_WRITES
+
+    if flushInterval is not None:
+        FLUSH_INTERVAL = float(flushInterval)
+    if maxPendingWrites is not None:
+        MAX_PENDING_WRITES = int(maxPendingWrites)
+
+
+def Open(path):
+    """
+    Return the shared BufferedDatabase for the given JSON file, opening it on first use.
+
+    :param path: Path of the TinyDB JSON file.
+    """
+    key = os.path.abspath(path)
+
+    with _databasesLock:
+        db = _databases.get(key)
+        if db is None:
+            os.makedirs(os.path.dirname(key), exist_ok=True)
+            db = BufferedDatabase(path, MAX_PENDING_WRITES)
+            _databases[key] = db
+            _StartFlusher()
+        return db
+
+
+def Get(name):
+    """
+    Return the shared database stored in ./database/<name>.json.
+
+    :param name: Name of the database, e.g. "beacons", "messages" or "users".
+    """
+    return Open(os.path.join(DATABASE_DIR, f"{name}.json"))
+
+
+def FlushAll():
+    """Flush every opened database to disk."""
+    with _databasesLock:
+        databases = list(_databases.values())
+
+    for db in databases:
+        db.flush()
+
+
+def CloseAll():
+    """Stop the background flusher, then flush and close every opened database."""
+    global _flusher
+
+    _stopFlusher.set()
+    if _flusher is not None and _flusher is not threading.current_thread():
+        _flusher.join(timeout=FLUSH_INTERVAL + 1)
+    _flusher = None
+
+    with _databasesLock:
+        databases = list(_databases.values())
+        _databases.clear()
+
+    for db in databases:
+        db.close()
+
+
+def _StartFlusher():
+    global _flusher
+
+    if _flusher is not None and _flusher.is_alive():
+        return
+
+    _stopFlusher.clear()
+    _flusher = threading.Thread(target=_FlushLoop, name="database-flusher", daemon=True)
+    _flusher.start()
+
+
+def _FlushLoop():
+    while not _stopFlusher.wait(FLUSH_INTERVAL):
+        try:
+            FlushAll()
+        except Exception as e:
+            log.error("Flush failed: %s", e)
+
+
+atexit.register(CloseAll)
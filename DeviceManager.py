@@ -1,6 +1,194 @@
-from tinydb import TinyDB, Query
+import atexit
 import datetime
-import json
+import logging
+import math
+import threading
+
+import ConfigService
+import Database
+import Metrics
+import TimeSeries
+
+log = logging.getLogger(__name__)
+
+# Telemetry fields of a Beacon
+INFO_FIELDS = ("batteryLevel", "controllerBattery", "coreTemp", "houseTemp", "latency")
+
+# Seconds between two writes of the changed devices to the database
+REGISTRY_FLUSH_INTERVAL = 1.0
+
+_registry = None
+_registryLock = threading.Lock()
+
+
+class Device:
+    """The latest state of one Beacon."""
+
+    __slots__ = ("deviceId", "docId") + INFO_FIELDS + ("lastActivity",)
+
+    def __init__(self, deviceId, docId=None, **fields):
+        self.deviceId = deviceId
+        self.docId = docId
+        for key in INFO_FIELDS + ("lastActivity",):
+            setattr(self, key, fields.get(key))
+
+    def to_dict(self):
+        data = {"deviceId": self.deviceId}
+        for key in INFO_FIELDS + ("lastActivity",):
+            data[key] = getattr(self, key)
+        return data
+
+
+class DeviceRegistry:
+    """
+    The Beacons held in memory, keyed by device ID.
+
+    Reads never touch the database. Changes are applied in memory, and the changed
+    devices are written to the beacons table by a background thread every
+    REGISTRY_FLUSH_INTERVAL seconds (write-behind), so many updates of one device
+    become one write. Listeners are called with (deviceId, changes) on every change.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._lock = threading.RLock()
+        self._devices = {}
+        self._dirty = set()
+        self._listeners = []
+        self._flushing = threading.Event()
+
+        for doc in db.all():
+            if "deviceId" in doc:
+                self._devices[doc["deviceId"]] = Device(docId=doc.doc_id, **doc)
+
+    def get(self, deviceId):
+        """Return the device as a dict, or None if it is unknown."""
+        with self._lock:
+            device = self._devices.get(deviceId)
+            return device.to_dict() if device is not None else None
+
+    def ids(self):
+        with self._lock:
+            return list(self._devices)
+
+    def all(self):
+        with self._lock:
+            return [device.to_dict() for device in self._devices.values()]
+
+    def update(self, deviceId, **fields):
+        """
+        Apply new telemetry to a device (None values are ignored) and touch its 'lastActivity'.
+
+        :return: True if the device was new.
+        """
+        return bool(self.update_many({deviceId: fields}))
+
+    def update_many(self, changes):
+        """
+        Apply {deviceId: fields} to many devices at once.
+
+        :return: The IDs of the devices that were new.
+        """
+        now = datetime.datetime.now().isoformat()
+        created = []
+        notifications = []
+
+        with self._lock:
+            for deviceId, fields in changes.items():
+                applied = {key: value for key, value in fields.items() if key in INFO_FIELDS and value is not None}
+                applied["lastActivity"] = now
+
+                device = self._devices.get(deviceId)
+                if device is None:
+                    device = self._devices[deviceId] = Device(deviceId)
+                    created.append(deviceId)
+                for key, value in applied.items():
+                    setattr(device, key, value)
+
+                self._dirty.add(deviceId)
+                notifications.append((deviceId, applied))
+            listeners = list(self._listeners)
+
+        self._schedule_flush()
+        for deviceId, applied in notifications:
+            for listener in listeners:
+                listener(deviceId, applied)
+        return created
+
+    def _schedule_flush(self):
+        if self._flushing.is_set():
+            return
+        self._flushing.set()
+        timer = threading.Timer(REGISTRY_FLUSH_INTERVAL, self.flush)
+        timer.daemon = True
+        timer.start()
+
+    def flush(self):
+        """Write the changed devices to the database."""
+        with self._lock:
+            self._flushing.clear()
+            dirty = [self._devices[deviceId] for deviceId in self._dirty]
+            self._dirty.clear()
+            if not dirty:
+                return
+
+            with self._db.transaction() as table:
+                for device in dirty:
+                    if device.docId is not None:
+                        table.update(device.to_dict(), doc_ids=[device.docId])
+                    else:
+                        device.docId = table.insert(device.to_dict())
+
+    def subscribe(self, listener):
+        """Call listener(deviceId, changes) whenever a device is updated or created."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+
+def GetRegistry():
+    """Return the shared device registry, loading it from the beacons table on first use."""
+    global _registry
+    with _registryLock:
+        if _registry is None:
+            _registry = DeviceRegistry(Database.Get("beacons"))
+            # Runs before Database's own exit hook (registered earlier), so the last changes are flushed to disk
+            atexit.register(_registry.flush)
+        return _registry
+
+
+def ParseInfo(data):
+    """
+    Read the telemetry fields of a request, before anything is stored.
+
+    :param data: The request body (or frame, or ingest item).
+    :return: {field: value} for every INFO_FIELDS entry; numbers (0 included) are kept, numeric
+             strings become floats, and missing, null or "" values are None.
+    :raises ValueError: If a value is not a finite number.
+    """
+    fields = {}
+    for key in INFO_FIELDS:
+        value = data.get(key)
+        if value == "":
+            value = None
+        if value is not None:
+            try:
+                if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+                    raise ValueError
+                number = float(value)
+            except (ValueError, OverflowError):
+                raise ValueError(f"'{key}' must be a number: {value!r}") from None
+            if not math.isfinite(number):
+                raise ValueError(f"'{key}' must be a finite number: {value!r}")
+            if isinstance(value, str):
+                value = number
+        fields[key] = value
+    return fields
+
 
 def UpdateBeaconData(deviceId, batteryLevel = None, controllerBattery = None, coreTemp = None, houseTemp = None, latency = None):
     """
@@ -11,43 +199,57 @@ def UpdateBeaconData(deviceId, batteryLevel = None, controllerBattery = None, co
     :param coreTemp: The updated core temperature of the beacon.
     :param houseTemp: The updated house temperature of the beacon.
     """
-    db = TinyDB("database/beacons.json")
-    query = Query()
-    
-    # Check if the device exists in the database
-    if not db.contains(query.deviceId == deviceId):
-        # If not, create a new entry
-        db.insert({"deviceId": deviceId, "batteryLevel": batteryLevel, "controllerBattery": controllerBattery, "coreTemp": coreTemp, "houseTemp": houseTemp, "latency": latency, "lastActivity": datetime.datetime.now().isoformat()})
-        print(f"Device {deviceId} not found in the database. Created a new entry.")
+    with Metrics.STORAGE_LATENCY.time("registry", "update"):
+        created = GetRegistry().update(deviceId, batteryLevel=batteryLevel, controllerBattery=controllerBattery, coreTemp=coreTemp, houseTemp=houseTemp, latency=latency)
+    if created:
+        log.info("Device %s not found in the database. Created a new entry.", deviceId)
     else:
-        # Update the existing device information
-        data = {}
-        if batteryLevel is not None:
-            data["batteryLevel"] = batteryLevel
-        if controllerBattery is not None:
-            data["controllerBattery"] = controllerBattery
-        if coreTemp is not None:
-            data["coreTemp"] = coreTemp
-        if houseTemp is not None:
-            data["houseTemp"] = houseTemp
-        if latency is not None:
-            data["latency"] = latency
-
-        data["lastActivity"] = datetime.datetime.now().isoformat()
-        
-        db.update(data, query.deviceId == deviceId)
-        print(f"Device {deviceId} updated successfully.")
-
-
-def UpdateCameraConfiguration(cameraConfig):
+        log.debug("Device %s updated successfully.", deviceId)
+
+    # The registry keeps the latest values, the history goes to the time-series store
+    TimeSeries.Get().append(deviceId, batteryLevel=batteryLevel, controllerBattery=controllerBattery, coreTemp=coreTemp, houseTemp=houseTemp, latency=latency)
+
+
+def UpdateBeaconDataBatch(updates):
+    """
+    Apply the telemetry of many readings, from one or more beacons, at once.
+
+    The readings of a device are coalesced: a field gets its last non-empty value, and
+    'lastActivity' is written once per device instead of once per reading.
+
+    :param updates: List of {"deviceId": ..., "timestamp": <epoch seconds, optional>, <INFO_FIELDS>...} dicts,
+                    oldest first. A reading without telemetry fields only touches 'lastActivity'.
+    :return: The IDs of the updated devices.
+    """
+    # Every reading goes to the history, with the time it was taken
+    TimeSeries.Get().append_many(updates)
+
+    merged = {}
+    for update in updates:
+        fields = merged.setdefault(update["deviceId"], {})
+        for key in INFO_FIELDS:
+            if update.get(key) is not None:
+                fields[key] = update[key]
+
+    if not merged:
+        return []
+
+    with Metrics.STORAGE_LATENCY.time("registry", "update"):
+        created = GetRegistry().update_many(merged)
+    if created:
+        log.info("Created %d new device entries: %s", len(created), ", ".join(created))
+
+    return list(merged)
+
+
+def UpdateCameraConfiguration(cameraConfig, deviceId=None):
     """
     Update the camera configuration for a specific device.
 
     :param cameraConfig: The new camera configuration data.
+    :param deviceId: The ID of the beacon to configure, or None for the global configuration.
     """
-    
-    with open("database/camera-config.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = {}
 
     if "Brightness" in cameraConfig:
         data["Brightness"] = float(cameraConfig["Brightness"])
@@ -68,5 +270,5 @@ def UpdateCameraConfiguration(cameraConfig):
     if "HdrMode" in cameraConfig:
         data["HdrMode"] = int(cameraConfig["HdrMode"])
 
-    with open("database/camera-config.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    # The read-modify-write runs under the service's lock and replaces the file atomically
+    ConfigService.Get().update(data, deviceId)
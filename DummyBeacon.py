@@ -12,15 +12,29 @@ houseTemp = 22
 
 msgIndex = 0
 
+# Seconds between two uploads of the buffered readings
+FLUSH_INTERVAL = 30
+
+# Egy kliens az egész futásra: egyszeri bejelentkezés, nyitva tartott kapcsolat
+client = BeaconShell.BeaconClient(username, password)
+
+# A mérések helyben gyűlnek, és egy kérésben mennek el (kapcsolat nélkül is megmaradnak)
+buffer = BeaconShell.TelemetryBuffer("dummy-beacon-buffer.jsonl")
+lastFlush = time.monotonic()
+
 while True:
-    BeaconShell.SendInfo(username=username, password=password, deviceId=deviceId, batteryLevel=batteryLevel, coreTemp=coreTemp, houseTemp=houseTemp)
+    buffer.add_info(deviceId, batteryLevel=batteryLevel, coreTemp=coreTemp, houseTemp=houseTemp)
     batteryLevel -= 0.01
     coreTemp += random.uniform(-0.05, 0.05)
     houseTemp += random.uniform(-0.01, 0.01)
     houseTemp -= 0.002
     time.sleep(5)
 
-    BeaconShell.SendMessage(username=username, password=password, deviceId=deviceId, message=f"Hello from DummyBeacon! Message index: {msgIndex}")
+    buffer.add_message(deviceId, f"Hello from DummyBeacon! Message index: {msgIndex}")
     msgIndex += 1
 
-    time.sleep(2)
\ No newline at end of file
+    if time.monotonic() - lastFlush >= FLUSH_INTERVAL:
+        lastFlush = time.monotonic()
+        print(f"Flushing {len(buffer)} items:", "sent" if buffer.flush(client) else "kept for later")
+
+    time.sleep(2)
@@ -0,0 +1,216 @@
+"""
+Streaming tar / zip archives of several images, for downloading a set of captures in one request.
+
+The archives are produced chunk by chunk while they are sent, so they are never
+buffered in memory or written to disk. Tar archives are uncompressed and their
+layout is known in advance, so their exact size is announced and any byte range
+of them can be served, which lets interrupted downloads resume. The images are
+PNGs (already compressed), so the zip archives store them without compression.
+"""
+import calendar
+import datetime
+import hashlib
+import re
+import tarfile
+import zipfile
+
+import ImageStore
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+CHUNK_SIZE = ImageStore.CHUNK_SIZE
+
+FORMATS = {
+    "tar": "application/x-tar",
+    "zip": "application/zip",
+}
+
+
+def ArchiveETag(images):
+    """Strong ETag of the archive: it changes whenever the set or the content of the images changes."""
+    digest = hashlib.sha1()
+    for image in images:
+        digest.update(f"{image.name}\0{image.size}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class TarArchive:
+    """An uncompressed tar archive of images, with known size and random access to its byte ranges."""
+
+    def __init__(self, images):
+        self.images = list(images)
+        # (offset of the header, header length, data length) of every member
+        self._members = []
+
+        offset = 0
+        for image in self.images:
+            headerLength = len(self._header(image))
+            self._members.append((offset, headerLength, image.size))
+            offset += headerLength + self._padded(image.size)
+
+        # The archive ends with two empty blocks
+        self.size = offset + 2 * BLOCK_SIZE
+
+    @staticmethod
+    def _padded(size):
+        return -(-size // BLOCK_SIZE) * BLOCK_SIZE
+
+    @staticmethod
+    def _header(image):
+        info = tarfile.TarInfo(image.name)
+        info.size = image.size
+        info.mode = 0o644
+        # The capture time of the file name, so the header doesn't depend on the file system
+        info.mtime = _CaptureTime(image.captured)
+        return info.tobuf(format=tarfile.GNU_FORMAT)
+
+    def stream(self, start=0, end=None):
+        """
+        Yield the bytes start..end (inclusive) of the archive.
+
+        :param start: The first byte to send.
+        :param end: The last byte to send, or None for the end of the archive.
+        """
+        end = self.size - 1 if end is None else end
+
+        for image, (offset, headerLength, dataLength) in zip(self.images, self._members):
+            memberEnd = offset + headerLength + self._padded(dataLength)
+            if memberEnd <= start:
+                continue
+            if offset > end:
+                return
+
+            # Header
+            yield from _Slice(self._header(image), offset, start, end)
+
+            # Data
+            dataOffset = offset + headerLength
+            if dataOffset + dataLength > start and dataOffset <= end:
+                yield from _FileRange(image.path, max(start - dataOffset, 0), min(end - dataOffset, dataLength - 1))
+
+            # Padding
+            padding = self._padded(dataLength) - dataLength
+            if padding:
+                yield from _Slice(b"\0" * padding, dataOffset + dataLength, start, end)
+
+        yield from _Slice(b"\0" * (2 * BLOCK_SIZE), self.size - 2 * BLOCK_SIZE, start, end)
+
+
+class _ZipWriter:
+    """Unseekable file object collecting what zipfile writes, to be yielded by the generator."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def StreamZip(images):
+    """Yield a zip archive of the images (stored without compression)."""
+    writer = _ZipWriter()
+
+    with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for image in images:
+            info = zipfile.ZipInfo(image.name, date_time=_CaptureTuple(image.captured))
+            info.file_size = image.size
+            info.external_attr = 0o644 << 16
+
+            with archive.open(info, "w") as member, open(image.path, "rb") as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    member.write(chunk)
+                    data = writer.drain()
+                    if data:
+                        yield data
+
+            data = writer.drain()
+            if data:
+                yield data
+
+    data = writer.drain()
+    if data:
+        yield data
+
+
+def ParseRange(header, size):
+    """
+    Parse a single 'Range: bytes=...' header.
+
+    :return: (start, end) inclusive, None if there is no usable range header.
+    :raises ValueError: If the range can't be satisfied.
+    """
+    if not header:
+        return None
+
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header)
+    if not match or (not match.group(1) and not match.group(2)):
+        # Multiple or malformed ranges: send the whole archive
+        return None
+
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+
+    end = min(end, size - 1)
+    if start > end:
+        raise ValueError(f"Range not satisfiable: {header}")
+    return start, end
+
+
+def _Slice(data, offset, start, end):
+    """Yield the part of 'data' (placed at 'offset' in the archive) that falls into start..end."""
+    first = max(start - offset, 0)
+    last = min(end - offset, len(data) - 1)
+    if first <= last:
+        yield data[first:last + 1]
+
+
+def _FileRange(path, first, last):
+    with open(path, "rb") as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                # The file got shorter than announced, keep the archive layout intact
+                chunk = b"\0" * min(CHUNK_SIZE, remaining)
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _CaptureTuple(captured):
+    digits = (captured or "") + "19800101000000"[len(captured or ""):]
+    try:
+        parts = (int(digits[0:4]), int(digits[4:6]), int(digits[6:8]), int(digits[8:10]), int(digits[10:12]), int(digits[12:14]))
+    except ValueError:
+        return (1980, 1, 1, 0, 0, 0)
+    # zip can't store dates before 1980
+    return parts if parts[0] >= 1980 else (1980, 1, 1, 0, 0, 0)
+
+
+def _CaptureTime(captured):
+    try:
+        return calendar.timegm(datetime.datetime(*_CaptureTuple(captured)).timetuple())
+    except ValueError:
+        return 0
@@ -0,0 +1,351 @@
+"""
+Storage and catalog of the images uploaded by the Beacon devices.
+
+The images are written to disk in CHUNK_SIZE pieces, so an upload never has to
+be held in memory as a whole.
+
+The ImageCatalog is built once from the uploads folder and then updated by the
+uploads themselves, so listing, counting and "latest N" queries are answered
+from a sorted in-memory index instead of listing the folder on every request.
+If the folder can also be changed by other processes, StartWatcher() rescans it
+periodically.
+
+The images are stored per device and per day:
+
+    uploads/<deviceId>/<YYYYmmdd>/<YYYYmmddHHMMSS>-<seq>.png
+
+Every image is written to a temporary file first and renamed when complete, so
+readers never see half-written images. Images of the old flat layout
+(uploads/<YYYYmmddHHMMSS>.png) are still listed, and can be moved to the new
+layout with:
+
+    python ImageStore.py migrate [--device unknown]
+"""
+import argparse
+import bisect
+import datetime
+import logging
+import os
+import re
+import shutil
+import threading
+
+import Metrics
+
+log = logging.getLogger(__name__)
+
+UPLOADS_DIR = "uploads"
+
+# Size of the pieces in which the uploaded images are copied to disk
+CHUNK_SIZE = 64 * 1024
+
+# Device folder of the images uploaded without a device ID
+UNKNOWN_DEVICE = "unknown"
+
+# Sorts after every file name, so (timestamp, _MAX_NAME) is the upper bound of a timestamp
+_MAX_NAME = chr(0x10FFFF)
+
+_catalog = None
+_catalogLock = threading.Lock()
+_watcher = None
+_stopWatcher = threading.Event()
+
+
+class ImageInfo:
+    """Metadata of one stored image."""
+
+    __slots__ = ("path", "name", "size", "deviceId", "captured")
+
+    def __init__(self, path, size, deviceId=None, captured=None, root=UPLOADS_DIR):
+        self.path = path
+        # Path relative to the uploads folder, e.g. "Beacon_1/20251026/20251026120000-0.png"
+        self.name = os.path.relpath(path, root).replace(os.sep, "/")
+        self.size = size
+        self.deviceId = deviceId
+        # Capture time in the YYYYmmddHHMMSS format of the file names
+        self.captured = captured or os.path.splitext(os.path.basename(path))[0].split("-")[0]
+
+    @property
+    def key(self):
+        return (self.captured, self.name)
+
+    def to_dict(self):
+        return {"name": self.name, "size": self.size, "deviceId": self.deviceId, "captured": self.captured}
+
+
+class ImageCatalog:
+    """Sorted in-memory index of the images, oldest first."""
+
+    def __init__(self, root=UPLOADS_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._keys = []
+        self._images = []
+        self._byDevice = {}
+
+    @staticmethod
+    def _pngs(folder):
+        return [entry for entry in os.scandir(folder) if entry.is_file() and entry.name.lower().endswith(".png")]
+
+    @classmethod
+    def _scan_device(cls, root, deviceId):
+        images = []
+        for day in os.scandir(os.path.join(root, deviceId)):
+            if day.is_dir():
+                for entry in cls._pngs(day.path):
+                    size = entry.stat().st_size
+                    # Empty files are the reserved names of uploads still being written
+                    if size:
+                        images.append(ImageInfo(entry.path, size, deviceId, root=root))
+        return images
+
+    @classmethod
+    def _scan(cls, root):
+        images = []
+        if not os.path.isdir(root):
+            return images
+
+        # Images of the old flat layout, without device
+        for entry in cls._pngs(root):
+            images.append(ImageInfo(entry.path, entry.stat().st_size, root=root))
+
+        for device in os.scandir(root):
+            if device.is_dir() and not device.name.startswith("."):
+                images.extend(cls._scan_device(root, device.name))
+        return images
+
+    def rebuild(self):
+        """Read the uploads folder again and replace the whole index."""
+        images = sorted(self._scan(self.root), key=lambda info: info.key)
+
+        byDevice = {}
+        for info in images:
+            if info.deviceId is not None:
+                keys, infos = byDevice.setdefault(info.deviceId, ([], []))
+                keys.append(info.key)
+                infos.append(info)
+
+        with self._lock:
+            self._keys = [info.key for info in images]
+            self._images = images
+            self._byDevice = byDevice
+
+    def add(self, info):
+        """Register a newly saved image."""
+        with self._lock:
+            self._insert(self._keys, self._images, info)
+
+            if info.deviceId is not None:
+                keys, infos = self._byDevice.setdefault(info.deviceId, ([], []))
+                self._insert(keys, infos, info)
+
+    @staticmethod
+    def _insert(keys, images, info):
+        index = bisect.bisect_left(keys, info.key)
+        if index < len(keys) and keys[index] == info.key:
+            # The file was overwritten, only its metadata changes
+            images[index] = info
+        else:
+            keys.insert(index, info.key)
+            images.insert(index, info)
+
+    def _index(self, deviceId):
+        if deviceId is None:
+            return self._keys, self._images
+        # The images are stored under the sanitized ID, so the lookups use it too
+        return self._byDevice.get(_SafeDeviceId(deviceId), ([], []))
+
+    def count(self, deviceId=None):
+        with self._lock:
+            return len(self._index(deviceId)[1])
+
+    def latest(self, n=1, deviceId=None):
+        """Return the n newest images, oldest first."""
+        with self._lock:
+            images = self._index(deviceId)[1]
+            return images[-n:] if n > 0 else []
+
+    def get(self, index=1, deviceId=None):
+        """Return the index-th newest image (1 is the newest) or None."""
+        with self._lock:
+            images = self._index(deviceId)[1]
+            if index < 1 or index > len(images):
+                return None
+            return images[-index]
+
+    def since(self, last=None, deviceId=None):
+        """Return the images captured after the 'last' YYYYmmddHHMMSS timestamp, oldest first."""
+        with self._lock:
+            keys, images = self._index(deviceId)
+            if not last:
+                return list(images)
+            return images[bisect.bisect_right(keys, (last, _MAX_NAME)):]
+
+
+def GetCatalog():
+    """Return the shared image catalog, building it on first use."""
+    global _catalog
+
+    with _catalogLock:
+        if _catalog is None:
+            _catalog = ImageCatalog(UPLOADS_DIR)
+            _catalog.rebuild()
+        return _catalog
+
+
+def StartWatcher(interval):
+    """
+    Rescan the uploads folder every 'interval' seconds, for images that are not uploaded through the API.
+
+    :param interval: Seconds between two rescans; 0 or None disables the watcher.
+    """
+    global _watcher
+
+    if not interval or (_watcher is not None and _watcher.is_alive()):
+        return
+
+    def watch():
+        while not _stopWatcher.wait(interval):
+            try:
+                GetCatalog().rebuild()
+            except Exception as e:
+                log.error("Rescan failed: %s", e)
+
+    _stopWatcher.clear()
+    _watcher = threading.Thread(target=watch, name="image-watcher", daemon=True)
+    _watcher.start()
+
+
+def StopWatcher():
+    _stopWatcher.set()
+
+
+def _SafeDeviceId(deviceId):
+    # The device ID becomes a folder name, so it must not contain path separators or dots only
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", str(deviceId or "")).strip(".")
+    return safe or UNKNOWN_DEVICE
+
+
+def _ImagePath(deviceId, captured, seq):
+    return os.path.join(UPLOADS_DIR, deviceId, captured[:8], f"{captured}-{seq}.png")
+
+
+def _CreateImageFile(deviceId, captured):
+    """
+    Reserve a free <captured>-<seq>.png path by creating it empty.
+
+    O_EXCL makes the creation fail if the file exists, so two uploads of the same second
+    never get the same name, even when they are saved by different processes.
+    """
+    seq = 0
+    while True:
+        path = _ImagePath(deviceId, captured, seq)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return path
+        except FileExistsError:
+            seq += 1
+
+
+def _ReserveImagePath(deviceId):
+    """Choose a free <timestamp>-<seq>.png path for a new image of the device."""
+    deviceId = _SafeDeviceId(deviceId)
+    captured = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    return _CreateImageFile(deviceId, captured), deviceId
+
+
+def _WriteAtomic(path, write):
+    """Write the image through a temporary file, and rename it over the reserved path when complete."""
+    tmpPath = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    written = False
+    try:
+        with Metrics.STORAGE_LATENCY.time("images", "write"), open(tmpPath, "wb") as f:
+            write(f)
+        os.replace(tmpPath, path)
+        written = True
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        # A failed upload gives its name back
+        if not written and os.path.exists(path):
+            os.remove(path)
+
+
+def _Register(filename, deviceId):
+    info = ImageInfo(filename, os.path.getsize(filename), deviceId)
+    GetCatalog().add(info)
+    return info
+
+
+def SaveImageStream(stream, deviceId=None):
+    """
+    Copy an image from a file-like object to the uploads folder chunk by chunk.
+
+    :param stream: Readable binary stream (request body, uploaded file, ...).
+    :param deviceId: The ID of the Beacon that took the image.
+    :return: The ImageInfo of the saved image.
+    """
+    filename, deviceId = _ReserveImagePath(deviceId)
+    _WriteAtomic(filename, lambda f: shutil.copyfileobj(stream, f, CHUNK_SIZE))
+
+    return _Register(filename, deviceId)
+
+
+def SaveImageBytes(imageBytes, deviceId=None):
+    """
+    Save an image that is already in memory (legacy base64 JSON uploads).
+
+    :param imageBytes: The decoded image.
+    :param deviceId: The ID of the Beacon that took the image.
+    :return: The ImageInfo of the saved image.
+    """
+    filename, deviceId = _ReserveImagePath(deviceId)
+    _WriteAtomic(filename, lambda f: f.write(imageBytes))
+
+    return _Register(filename, deviceId)
+
+
+def MigrateFlatLayout(deviceId=UNKNOWN_DEVICE):
+    """
+    Move the images of the old flat layout (uploads/<timestamp>.png) into the per-device layout.
+
+    :param deviceId: The device folder of the moved images, since the old layout didn't store it.
+    :return: The number of moved images.
+    """
+    deviceId = _SafeDeviceId(deviceId)
+    moved = 0
+
+    if not os.path.isdir(UPLOADS_DIR):
+        return moved
+
+    for entry in ImageCatalog._pngs(UPLOADS_DIR):
+        stem = os.path.splitext(entry.name)[0]
+        if not (len(stem) == 14 and stem.isdigit()):
+            # Not a timestamp name, use the modification time instead
+            stem = datetime.datetime.fromtimestamp(entry.stat().st_mtime).strftime('%Y%m%d%H%M%S')
+
+        os.replace(entry.path, _CreateImageFile(deviceId, stem))
+
+        moved += 1
+
+    if _catalog is not None:
+        _catalog.rebuild()
+
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Beacon image storage tools")
+    parser.add_argument("command", choices=["migrate"], help="What do you want to do?")
+    parser.add_argument("--device", default=UNKNOWN_DEVICE, help="Device ID of the images of the flat layout")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        moved = MigrateFlatLayout(args.device)
+        print(f"{moved} images moved to {os.path.join(UPLOADS_DIR, _SafeDeviceId(args.device))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Downscaled and re-encoded variants (thumbnails, WebP/JPEG previews) of the uploaded images.
+
+After every upload a background worker pool renders the PREGENERATED variants, so
+the dashboard previews are ready before anyone asks for them. Other variants are
+rendered on first request. Every variant is cached on disk next to the uploads:
+
+    uploads/.variants/<deviceId>/<YYYYmmdd>/<image name>/<size>.<format>
+
+Pillow is optional: without it only the original images are served. The rendering
+always runs in native threads: under gevent (serve.py, gunicorn) the threads of a
+plain ThreadPoolExecutor would be greenlets, and Pillow would block every request.
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    from PIL import Image, UnidentifiedImageError
+except ImportError:
+    Image = None
+    UnidentifiedImageError = None
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    monkey = None
+
+import ImageStore
+
+VARIANTS_DIR = os.path.join(ImageStore.UPLOADS_DIR, ".variants")
+
+# Named sizes: the longer side of the variant in pixels
+SIZES = {
+    "thumb": 160,
+    "small": 480,
+    "medium": 1024,
+}
+
+# Numeric sizes are accepted between these bounds
+MIN_SIZE = 16
+MAX_SIZE = 4096
+
+# format name -> (Pillow format, mimetype, save options)
+FORMATS = {
+    "png": ("PNG", "image/png", {"optimize": True}),
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 80, "optimize": True}),
+}
+
+# Variants rendered in the background right after each upload
+PREGENERATED = [("thumb", "webp"), ("small", "jpeg")]
+
+WORKERS = 2
+
+_executor = None
+_executorLock = threading.Lock()
+_pending = {}
+_pendingLock = threading.Lock()
+
+
+class UnreadableImageError(Exception):
+    """The stored file is not an image Pillow can open."""
+
+
+class _GeventExecutor:
+    """
+    Native-thread pool for gevent, with the submit() of a ThreadPoolExecutor.
+
+    gevent's ThreadPool.spawn() blocks the caller until a thread is free, so an upload would
+    wait for the renderings before it. Here a greenlet waits for the thread instead; it also
+    completes the Future, so the done callbacks run in a greenlet and not in the hub.
+    """
+
+    def __init__(self, workers):
+        self._pool = ThreadPool(workers)
+
+    def submit(self, fn, *args):
+        future = Future()
+
+        def call():
+            # The exception is handed over as a value, gevent would print it as an unhandled error
+            try:
+                return fn(*args), None
+            except Exception as e:
+                return None, e
+
+        def run():
+            result, error = self._pool.apply(call)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        gevent.spawn(run)
+        return future
+
+    def shutdown(self, wait=True):
+        if wait:
+            self._pool.join()
+        self._pool.kill()
+
+
+def Available():
+    """True if Pillow is installed, so variants can be rendered."""
+    return Image is not None
+
+
+def ParseSize(size):
+    """
+    Turn the 'size' request parameter into pixels.
+
+    :param size: A named size (thumb, small, medium), a number of pixels or None (original size).
+    :raises ValueError: If the size is unknown or out of bounds.
+    """
+    if size is None or size == "" or size == "original":
+        return None
+    if size in SIZES:
+        return SIZES[size]
+    if str(size).isdigit() and MIN_SIZE <= int(size) <= MAX_SIZE:
+        return int(size)
+    raise ValueError(f"Invalid size: {size}. Use one of {', '.join(SIZES)} or {MIN_SIZE}-{MAX_SIZE} pixels.")
+
+
+def ParseFormat(fmt):
+    """
+    Normalize the 'format' request parameter.
+
+    :raises ValueError: If the format is not supported.
+    """
+    if fmt is None or fmt == "":
+        return "png"
+    fmt = fmt.lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in FORMATS:
+        raise ValueError(f"Invalid format: {fmt}. Use one of {', '.join(FORMATS)}.")
+    return fmt
+
+
+def VariantPath(image, pixels, fmt):
+    name = os.path.splitext(image.name)[0]
+    label = pixels if pixels is not None else "original"
+    return os.path.join(VARIANTS_DIR, *name.split("/"), f"{label}.{fmt}")
+
+
+def _Render(image, pixels, fmt, path):
+    pilFormat, _, options = FORMATS[fmt]
+
+    with Image.open(image.path) as img:
+        if pixels is not None:
+            img.thumbnail((pixels, pixels))
+        if pilFormat == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = f"{path}.tmp"
+        try:
+            img.save(tmpPath, format=pilFormat, **options)
+            os.replace(tmpPath, path)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    return path
+
+
+def _Executor():
+    global _executor
+
+    with _executorLock:
+        if _executor is None:
+            if monkey is not None and monkey.is_module_patched("threading"):
+                _executor = _GeventExecutor(WORKERS)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="image-variants")
+        return _executor
+
+
+def _Submit(image, pixels, fmt):
+    """Start rendering a variant, or join the rendering already in progress."""
+    path = VariantPath(image, pixels, fmt)
+
+    with _pendingLock:
+        future = _pending.get(path)
+        if future is not None:
+            return future
+        future = _Executor().submit(_Render, image, pixels, fmt, path)
+        _pending[path] = future
+
+    # Outside the lock: the callback of a future that is already done runs right away, in this thread
+    future.add_done_callback(lambda f: _Forget(path, f))
+    return future
+
+
+def _Forget(path, future):
+    with _pendingLock:
+        if _pending.get(path) is future:
+            del _pending[path]
+
+
+def Schedule(image):
+    """Render the PREGENERATED variants of a newly uploaded image in the background."""
+    if not Available():
+        return
+
+    for size, fmt in PREGENERATED:
+        pixels = ParseSize(size)
+        if not os.path.exists(VariantPath(image, pixels, fmt)):
+            _Submit(image, pixels, fmt)
+
+
+def GetVariant(image, size=None, fmt=None):
+    """
+    Return the (path, mimetype) of the requested variant, rendering it if it is not cached yet.
+
+    :param image: The ImageInfo of the original image.
+    :param size: The 'size' request parameter.
+    :param fmt: The 'format' request parameter.
+    :raises ValueError: If the size or format is invalid.
+    :raises UnreadableImageError: If the original can't be decoded.
+    """
+    pixels = ParseSize(size)
+    fmt = ParseFormat(fmt)
+
+    # The original image, or Pillow is not installed
+    if (pixels is None and fmt == "png") or not Available():
+        return image.path, "image/png"
+
+    path = VariantPath(image, pixels, fmt)
+    if not os.path.exists(path):
+        try:
+            _Submit(image, pixels, fmt).result()
+        except UnidentifiedImageError as e:
+            raise UnreadableImageError(f"{image.name} is not a readable image") from e
+
+    return path, FORMATS[fmt][1]
+
+
+def Shutdown():
+    global _executor
+
+    with _executorLock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,175 @@
+"""
+Logging of the server: structured, and off the request's hot path.
+
+The request threads only put the log records on a queue (QueueHandler); a single
+background thread (QueueListener) formats them and writes them to the console and
+the log file. A slow terminal or disk therefore never blocks a request, and the
+%-style arguments are only formatted in the background, and only for the records
+that pass the level checks.
+
+Every record carries the ID of the current request and the Beacon it concerns,
+taken from context variables that BindRequest() / BindDevice() set (one context
+per thread or greenlet). In JSON format a record is one line:
+
+    {"time": "...", "level": "INFO", "logger": "app", "message": "...", "request_id": "...", "deviceId": "..."}
+
+Configured by the "logging" section of the server configuration:
+
+    "logging": {
+        "level": "INFO",                        root level
+        "format": "json",                       "json" or "text"
+        "levels": {"Signaling": "WARNING"},     per-logger levels
+        "sampling": {"app.access": 0.1}         fraction of the records kept, per logger
+    }
+"""
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import uuid
+
+# Attributes of every LogRecord; the others were given in 'extra' and are written as fields
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id", "deviceId"}
+
+_requestId = contextvars.ContextVar("request_id", default=None)
+_deviceId = contextvars.ContextVar("deviceId", default=None)
+
+_listener = None
+
+
+def BindRequest(requestId=None):
+    """Set (or generate) the ID of the request handled in the current context, and return it."""
+    requestId = requestId or uuid.uuid4().hex[:16]
+    _requestId.set(requestId)
+    _deviceId.set(None)
+    return requestId
+
+
+def BindDevice(deviceId):
+    """Set the Beacon the records of the current context are about."""
+    _deviceId.set(deviceId)
+
+
+def ClearContext():
+    _requestId.set(None)
+    _deviceId.set(None)
+
+
+class ContextFilter(logging.Filter):
+    """Copy the request ID and device ID of the logging context into the record."""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = _requestId.get()
+        if not hasattr(record, "deviceId"):
+            record.deviceId = _deviceId.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records of high-volume loggers; warnings and errors are always kept."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = {name: float(rate) for name, rate in (rates or {}).items()}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        # The most specific configured logger name (e.g. "app.access" before "app")
+        while name:
+            if name in self.rates:
+                return random.random() < self.rates[name]
+            name = name.rpartition(".")[0]
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record):
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            data["request_id"] = record.request_id
+        if getattr(record, "deviceId", None):
+            data["deviceId"] = record.deviceId
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves the formatting to the listener thread."""
+
+    def prepare(self, record):
+        # The default prepare() formats the message in the caller's thread; the listener
+        # runs in the same process, so the record can be passed on as it is
+        return record
+
+
+def Configure(config=None, logFile=None):
+    """
+    Route every log record through the background writer.
+
+    :param config: The "logging" section of the server configuration.
+    :param logFile: Path of the log file, besides the console (None: console only).
+    """
+    global _listener
+    config = config or {}
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    if config.get("format", "json") == "json":
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s %(deviceId)s] %(message)s")
+
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if logFile:
+        handlers.append(logging.FileHandler(logFile, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queueHandler = _QueueHandler(records)
+    queueHandler.addFilter(SamplingFilter(config.get("sampling")))
+    queueHandler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queueHandler)
+    root.setLevel(config.get("level", "INFO"))
+
+    for name, level in (config.get("levels") or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def Shutdown():
+    """Write the queued records and stop the background writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(Shutdown)
@@ -0,0 +1,371 @@
+"""
+Pluggable storage for the messages sent by the Beacon devices.
+
+Two backends are available:
+    -tinydb: The original database/messages.json file (through Database.py)
+    -sqlite: A SQLite database in WAL mode with a (deviceId, timestamp) index,
+             so inserts don't rewrite the history and 'since' queries only
+             touch the matching rows
+
+The first time the SQLite backend is opened, the existing TinyDB file is imported
+into it. The migration can also be run by hand:
+
+    python MessageStore.py migrate [--source database/messages.json] [--target database/messages.sqlite]
+"""
+import argparse
+import base64
+import binascii
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from tinydb import Query
+
+import Database
+import Metrics
+
+log = logging.getLogger(__name__)
+
+BACKEND = "sqlite"
+SQLITE_PATH = "database/messages.sqlite"
+TINYDB_PATH = "database/messages.json"
+
+_repository = None
+_repositoryLock = threading.Lock()
+
+
+class MessageRepository:
+    """Interface of the message storage backends."""
+
+    def insert(self, deviceId, message, timestamp):
+        """Store one message."""
+        raise NotImplementedError
+
+    def insert_multiple(self, messages):
+        """Store several {"deviceId", "message", "timestamp"} messages at once."""
+        for msg in messages:
+            self.insert(msg["deviceId"], msg["message"], msg["timestamp"])
+
+    def find(self, deviceId=None, since=None):
+        """Return the messages ordered by timestamp, optionally filtered by device and timestamp."""
+        raise NotImplementedError
+
+    def find_page(self, deviceId=None, since=None, limit=100, after=None):
+        """
+        Return one page of messages in (timestamp, id) order.
+
+        :param after: The (timestamp, id) key of the last message of the previous page.
+        :return: (messages, key of the last returned message or None if there are no more pages)
+        """
+        raise NotImplementedError
+
+    def iterate(self, deviceId=None, since=None, after=None, batchSize=500):
+        """Yield the matching messages page by page, so the whole result is never held in memory."""
+        while True:
+            messages, after = self.find_page(deviceId, since, batchSize, after)
+            yield from messages
+            if after is None:
+                return
+
+    def count(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TinyDBMessageRepository(MessageRepository):
+    """The original JSON storage, kept for small installations and as migration source."""
+
+    def __init__(self, path=TINYDB_PATH):
+        self._db = Database.Open(path)
+
+    def insert(self, deviceId, message, timestamp):
+        self._db.insert({"message": message, "deviceId": deviceId, "timestamp": timestamp})
+
+    def insert_multiple(self, messages):
+        self._db.insert_multiple([{"message": m["message"], "deviceId": m["deviceId"], "timestamp": m["timestamp"]} for m in messages])
+
+    def _search(self, deviceId, since):
+        Message = Query()
+        query = None
+
+        if deviceId:
+            q = (Message.deviceId == deviceId)
+            query = q if query is None else query & q
+
+        if since:
+            q = (Message.timestamp >= since)
+            query = q if query is None else query & q
+
+        if query is None:
+            results = self._db.all()
+        else:
+            results = self._db.search(query)
+
+        results.sort(key=lambda doc: (doc.get("timestamp", ""), doc.doc_id))
+        return results
+
+    def find(self, deviceId=None, since=None):
+        return [dict(doc) for doc in self._search(deviceId, since)]
+
+    def find_page(self, deviceId=None, since=None, limit=100, after=None):
+        results = self._search(deviceId, since)
+        if after is not None:
+            results = [doc for doc in results if (doc.get("timestamp", ""), doc.doc_id) > tuple(after)]
+
+        page = results[:limit]
+        last = page[-1] if page and len(results) > limit else None
+        return [dict(doc) for doc in page], (last["timestamp"], last.doc_id) if last else None
+
+    def count(self):
+        return len(self._db)
+
+
+class SQLiteMessageRepository(MessageRepository):
+    """SQLite (WAL mode) storage with a composite (deviceId, timestamp) index."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            deviceId TEXT NOT NULL,
+            message TEXT,
+            timestamp TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_device_timestamp ON messages (deviceId, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.name = os.path.basename(path)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # One connection shared by every request thread (or greenlet), so none is left open
+        # when a thread ends; the lock serializes its use, as SQLite does for the writes anyway
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn as conn:
+            conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    def _encode(message):
+        # Keep strings and numbers as they are, anything else is stored as JSON text
+        if message is None or isinstance(message, (str, int, float)):
+            return message
+        return json.dumps(message, ensure_ascii=False)
+
+    def insert(self, deviceId, message, timestamp):
+        with Metrics.STORAGE_LATENCY.time(self.name, "write"), self._lock, self._conn as conn:
+            conn.execute("INSERT INTO messages (deviceId, message, timestamp) VALUES (?, ?, ?)",
+                         (deviceId, self._encode(message), timestamp))
+
+    def insert_multiple(self, messages):
+        with Metrics.STORAGE_LATENCY.time(self.name, "write"), self._lock, self._conn as conn:
+            conn.executemany("INSERT INTO messages (deviceId, message, timestamp) VALUES (?, ?, ?)",
+                             [(m["deviceId"], self._encode(m["message"]), m["timestamp"]) for m in messages])
+
+    def _select(self, deviceId, since, after=None):
+        conditions = []
+        params = []
+
+        if deviceId:
+            conditions.append("deviceId = ?")
+            params.append(deviceId)
+
+        if since:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+
+        if after is not None:
+            conditions.append("(timestamp, id) > (?, ?)")
+            params.extend(after)
+
+        sql = "SELECT id, message, deviceId, timestamp FROM messages"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY timestamp, id"
+        return sql, params
+
+    def find(self, deviceId=None, since=None):
+        sql, params = self._select(deviceId, since)
+        with Metrics.STORAGE_LATENCY.time(self.name, "read"), self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [{"message": row["message"], "deviceId": row["deviceId"], "timestamp": row["timestamp"]} for row in rows]
+
+    def find_page(self, deviceId=None, since=None, limit=100, after=None):
+        sql, params = self._select(deviceId, since, after)
+        # One extra row tells whether there is a next page
+        with Metrics.STORAGE_LATENCY.time(self.name, "read"), self._lock:
+            rows = self._conn.execute(sql + " LIMIT ?", params + [limit + 1]).fetchall()
+
+        page = rows[:limit]
+        last = page[-1] if page and len(rows) > limit else None
+        messages = [{"message": row["message"], "deviceId": row["deviceId"], "timestamp": row["timestamp"]} for row in page]
+        return messages, (last["timestamp"], last["id"]) if last else None
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def import_messages(self, messages, source):
+        """
+        Store migrated messages and record their source as "migrated_from" in one transaction.
+
+        :return: False (and nothing is stored) if a migration was already recorded, e.g. by another worker.
+        """
+        with Metrics.STORAGE_LATENCY.time(self.name, "write"), self._lock, self._conn as conn:
+            # Takes the write lock before the check, so two processes can't both import
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone() is not None:
+                return False
+            conn.executemany("INSERT INTO messages (deviceId, message, timestamp) VALUES (?, ?, ?)",
+                             [(m["deviceId"], self._encode(m["message"]), m["timestamp"]) for m in messages])
+            conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (source,))
+        return True
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock, self._conn as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def EncodeCursor(after):
+    """Turn the (timestamp, id) key of a message into an opaque cursor string."""
+    return base64.urlsafe_b64encode(json.dumps(list(after)).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def DecodeCursor(cursor):
+    """
+    Turn a cursor created by EncodeCursor back into a (timestamp, id) key.
+
+    :raises ValueError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, docId = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+    if not isinstance(timestamp, str) or not isinstance(docId, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return timestamp, docId
+
+
+def MigrateFromTinyDB(repository, sourcePath=TINYDB_PATH):
+    """
+    Import the messages of a TinyDB JSON file into a SQLite repository (only once).
+
+    The original file is read directly and left untouched, so it can serve as backup.
+    The messages and the "migrated_from" flag are committed together: an interrupted
+    migration is repeated from scratch, never imported twice.
+
+    :param repository: The target SQLiteMessageRepository.
+    :param sourcePath: Path of the TinyDB messages file.
+    :return: The number of imported messages.
+    """
+    if repository.get_meta("migrated_from") is not None:
+        return 0
+
+    if not os.path.exists(sourcePath) or os.path.getsize(sourcePath) == 0:
+        repository.set_meta("migrated_from", "")
+        return 0
+
+    with open(sourcePath, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    documents = data.get("_default", {})
+    messages = [documents[docId] for docId in sorted(documents, key=int)]
+    messages = [m for m in messages if "deviceId" in m and "timestamp" in m]
+
+    if not repository.import_messages([{"deviceId": m["deviceId"], "message": m.get("message"), "timestamp": m["timestamp"]} for m in messages],
+                                      os.path.abspath(sourcePath)):
+        return 0
+
+    log.info("Migrated %d messages from %s", len(messages), sourcePath)
+    return len(messages)
+
+
+def Create(backend=BACKEND, sqlitePath=SQLITE_PATH, tinydbPath=TINYDB_PATH):
+    """
+    Create a message repository.
+
+    :param backend: "sqlite" or "tinydb".
+    :param sqlitePath: Path of the SQLite database.
+    :param tinydbPath: Path of the TinyDB file (storage of the tinydb backend, migration source of the sqlite one).
+    """
+    if backend == "tinydb":
+        return TinyDBMessageRepository(tinydbPath)
+
+    if backend == "sqlite":
+        repository = SQLiteMessageRepository(sqlitePath)
+        MigrateFromTinyDB(repository, tinydbPath)
+        return repository
+
+    raise ValueError(f"Unknown message storage backend: {backend}")
+
+
+def Configure(backend=None, sqlitePath=None, tinydbPath=None):
+    """
+    Set the backend used by Get() (usually from the "storage" section of server-config.json).
+    """
+    global BACKEND, SQLITE_PATH, TINYDB_PATH, _repository
+
+    if backend is not None:
+        BACKEND = backend
+    if sqlitePath is not None:
+        SQLITE_PATH = sqlitePath
+    if tinydbPath is not None:
+        TINYDB_PATH = tinydbPath
+
+    with _repositoryLock:
+        if _repository is not None:
+            _repository.close()
+        _repository = None
+
+
+def Get():
+    """Return the shared message repository of the server, creating it on first use."""
+    global _repository
+
+    with _repositoryLock:
+        if _repository is None:
+            _repository = Create(BACKEND, SQLITE_PATH, TINYDB_PATH)
+        return _repository
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Beacon message storage tools")
+    parser.add_argument("command", choices=["migrate"], help="What do you want to do?")
+    parser.add_argument("--source", default=TINYDB_PATH, help="TinyDB messages file")
+    parser.add_argument("--target", default=SQLITE_PATH, help="SQLite database")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        repository = SQLiteMessageRepository(args.target)
+        count = MigrateFromTinyDB(repository, args.source)
+        print(f"{count} messages imported, {repository.count()} messages in {args.target}")
+        repository.close()
+
+
+if __name__ == "__main__":
+    main()
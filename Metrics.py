@@ -0,0 +1,248 @@
+"""
+In-process metrics of the server, served in the Prometheus text format on /metrics.
+
+Three kinds of metrics, each with an optional set of labels:
+
+    Counter     only goes up (requests, bytes, ingested items)
+    Gauge       goes up and down (requests in flight)
+    Histogram   counts observations in fixed buckets (latencies)
+
+Recording a value is a lock and a few additions, without any allocation for an
+existing label set; Render() builds the text only when /metrics is scraped.
+Latencies are recorded with the timer of a histogram:
+
+    with Metrics.STORAGE_LATENCY.time("sqlite", "find"):
+        rows = conn.execute(...)
+
+A label can be limited to a number of distinct values (e.g. the device IDs of
+INGESTED_ITEMS): the values seen after the first ones are counted under "other",
+so a growing fleet can't grow the memory and the scrapes without bound.
+
+The values live in the memory of one process: with several gunicorn workers every
+worker exposes its own. Configured by the "metrics" section of the server
+configuration:
+
+    "metrics": {
+        "enabled": true,        record the metrics
+        "token": null           bearer token required by /metrics (null: /metrics is not served)
+    }
+"""
+import bisect
+import math
+import threading
+import time
+
+# Upper bounds (seconds) of the latency buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Distinct device IDs labelled one by one, the others are counted as OTHER_LABEL
+MAX_DEVICE_LABELS = 500
+OTHER_LABEL = "other"
+
+_enabled = True
+_token = None
+_metrics = []
+
+
+def Configure(enabled=None, token=None):
+    """
+    Enable or disable the recording, and set the token of the /metrics endpoint.
+
+    :param enabled: Record the metrics; when disabled, every recording call returns immediately.
+    :param token: Bearer token /metrics requires (None: /metrics is not served).
+    """
+    global _enabled, _token
+    if enabled is not None:
+        _enabled = bool(enabled)
+    _token = token or None
+
+
+def Enabled():
+    return _enabled
+
+
+def Token():
+    return _token
+
+
+def _FormatValue(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _EscapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _FormatLabels(names, values, extra=""):
+    pairs = [f'{name}="{_EscapeLabel(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), limits=None):
+        """
+        :param limits: {label name: max distinct values} of the labels whose values are not a fixed set.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        # (label index, max distinct values, values seen)
+        self._limits = [(self.labels.index(label), limit, set()) for label, limit in (limits or {}).items()]
+        _metrics.append(self)
+
+    def _limited(self, labels):
+        """Replace the label values beyond their limits with OTHER_LABEL (called under the lock)."""
+        for index, limit, seen in self._limits:
+            value = labels[index]
+            if value not in seen:
+                if len(seen) >= limit:
+                    labels = labels[:index] + (OTHER_LABEL,) + labels[index + 1:]
+                    continue
+                seen.add(value)
+        return labels
+
+    def _samples(self):
+        """Return the (suffix, label values, extra label, value) lines of the metric."""
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_FormatLabels(self.labels, values, extra)} {_FormatValue(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        if not _enabled:
+            return
+        with self._lock:
+            if self._limits:
+                labels = self._limited(labels)
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [("", labels, "", value) for labels, value in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        if not _enabled:
+            return
+        with self._lock:
+            if self._limits:
+                labels = self._limited(labels)
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        if not _enabled:
+            return
+        with self._lock:
+            if self._limits:
+                labels = self._limited(labels)
+            self._values[labels] = value
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [("", labels, "", value) for labels, value in items]
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, limits=None):
+        super().__init__(name, documentation, labels, limits)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        if not _enabled:
+            return
+        # Index of the first bucket whose upper bound is >= value; len(buckets) is the +Inf bucket
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if self._limits:
+                labels = self._limited(labels)
+            series = self._values.get(labels)
+            if series is None:
+                # [count per bucket..., +Inf bucket, sum]
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, *labels):
+        """Context manager that observes the seconds its block took."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._values.items()]
+
+        samples = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series[:-1]):
+                cumulative += count
+                samples.append(("_bucket", labels, f'le="{_FormatValue(bound)}"', cumulative))
+            samples.append(("_sum", labels, "", series[-1]))
+            samples.append(("_count", labels, "", cumulative))
+        return samples
+
+
+def Render():
+    """Return every metric in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+# HTTP requests
+HTTP_REQUESTS = Counter("beacon_http_requests_total", "HTTP requests handled.", ("method", "endpoint", "status"))
+HTTP_LATENCY = Histogram("beacon_http_request_duration_seconds", "Time to produce the response of an HTTP request.", ("method", "endpoint"))
+HTTP_REQUEST_BYTES = Counter("beacon_http_request_bytes_total", "Bytes received in HTTP request bodies.", ("endpoint",))
+HTTP_RESPONSE_BYTES = Counter("beacon_http_response_bytes_total", "Bytes sent in HTTP response bodies of known length.", ("endpoint",))
+HTTP_IN_FLIGHT = Gauge("beacon_http_requests_in_flight", "HTTP requests (and WebSocket connections) being served.")
+
+# Token check of the secured endpoints
+AUTH_LATENCY = Histogram("beacon_auth_duration_seconds", "Time of the Bearer token check.", ("result",))
+
+# Stores and file I/O
+STORAGE_LATENCY = Histogram("beacon_storage_duration_seconds", "Time of the storage operations.", ("store", "operation"))
+
+# Data sent by the Beacons
+INGESTED_ITEMS = Counter("beacon_ingested_items_total", "Telemetry readings, messages and images received, per device.", ("deviceId", "type"),
+                         limits={"deviceId": MAX_DEVICE_LABELS})
@@ -0,0 +1,290 @@
+"""
+Persistent WebSocket channel between the server and the Beacon devices.
+
+Instead of polling the HTTP endpoints (with a token check on every call), a
+Beacon opens one WebSocket, authenticates once, and then:
+    -receives its actions and camera configuration changes as pushed events,
+    -sends its telemetry and messages as lightweight frames.
+
+Every frame is a JSON object with a 'type' field.
+
+Beacon -> server:
+    {"type": "auth", "token": "<access token>", "deviceId": "Beacon_1"}   (first frame)
+    {"type": "info", "batteryLevel": 75, "coreTemp": 40.1, ...}          (same fields as /send-info)
+    {"type": "message", "message": "..."}
+    {"type": "ack", "ids": ["<action id>", ...]}
+    {"type": "ping"} / {"type": "pong"}
+
+Server -> Beacon:
+    {"type": "welcome", "deviceId": "Beacon_1", "heartbeat": 20}
+    {"type": "actions", "actions": [{"id": "...", "action": "take-photo"}, ...]}
+    {"type": "config", "version": 3, "data": {...}}
+    {"type": "ping", "time": 1730000000.0} / {"type": "pong"}
+    {"type": "error", "message": "..."}
+
+Actions are delivered with acknowledgement (see ActionQueue), so an action sent
+to a connection that dies before the 'ack' is delivered again.
+
+Heartbeats: the server sends a ping every HEARTBEAT_INTERVAL seconds and closes
+the connection if nothing arrives for HEARTBEAT_TIMEOUT seconds.
+
+Backpressure: every connection has an outbox of OUTBOX_SIZE frames, written by a
+dedicated sender thread. A Beacon that can't keep up fills its outbox and is
+disconnected instead of making the server buffer without limit.
+"""
+import datetime
+import json
+import logging
+import queue
+import threading
+import time
+
+from simple_websocket import ConnectionClosed
+
+import ActionQueue
+import ConfigService
+import DeviceManager
+import MessageStore
+import Metrics
+
+log = logging.getLogger(__name__)
+
+# Seconds between two server pings
+HEARTBEAT_INTERVAL = 20.0
+
+# Seconds of silence after which a connection is considered dead
+HEARTBEAT_TIMEOUT = 60.0
+
+# Seconds the client has to send the 'auth' frame
+AUTH_TIMEOUT = 10.0
+
+# Frames waiting to be sent to one Beacon
+OUTBOX_SIZE = 256
+
+# Telemetry fields accepted in 'info' frames
+INFO_FIELDS = DeviceManager.INFO_FIELDS
+
+_connections = {}
+_connectionsLock = threading.Lock()
+
+# Marker put into the outbox when new actions may be waiting
+_CHECK_ACTIONS = object()
+_CHECK_CONFIG = object()
+
+
+class BeaconConnection:
+    """One authenticated WebSocket connection of a Beacon."""
+
+    def __init__(self, ws, deviceId, user, expires):
+        self.ws = ws
+        self.deviceId = deviceId
+        self.user = user
+        self.expires = expires
+        self.outbox = queue.Queue(maxsize=OUTBOX_SIZE)
+        self.closed = threading.Event()
+        self.lastSeen = time.monotonic()
+        self.configVersion = None
+
+    def enqueue(self, frame):
+        """Queue a frame (or marker) for sending; a full outbox closes the connection."""
+        if self.closed.is_set():
+            return
+        try:
+            self.outbox.put_nowait(frame)
+        except queue.Full:
+            log.warning("%s is too slow, disconnecting", self.deviceId)
+            self.close()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        try:
+            self.ws.close()
+        except ConnectionClosed:
+            pass
+
+    # Called by ActionQueue whenever an action is queued
+    def on_action(self, deviceId):
+        if deviceId is None or deviceId == self.deviceId:
+            self.enqueue(_CHECK_ACTIONS)
+
+    # Called by ConfigService whenever a configuration is written
+    def on_config(self, deviceId):
+        if deviceId is None or deviceId == self.deviceId:
+            self.enqueue(_CHECK_CONFIG)
+
+    def _send(self, frame):
+        self.ws.send(json.dumps(frame, ensure_ascii=False))
+
+    def _send_actions(self):
+        actions = ActionQueue.Get().take(deviceId=self.deviceId, ack=True)
+        if actions:
+            self._send({"type": "actions", "actions": actions})
+
+    def _send_config(self):
+        config = ConfigService.Get().get(self.deviceId)
+        if config.version != self.configVersion:
+            self.configVersion = config.version
+            self._send({"type": "config", "version": config.version, "data": config.data})
+
+    def sender(self):
+        """Thread writing the outbox to the socket, and sending the heartbeats."""
+        nextPing = time.monotonic() + HEARTBEAT_INTERVAL
+
+        try:
+            while not self.closed.is_set():
+                try:
+                    frame = self.outbox.get(timeout=max(nextPing - time.monotonic(), 0))
+                except queue.Empty:
+                    frame = None
+
+                if frame is _CHECK_ACTIONS:
+                    self._send_actions()
+                elif frame is _CHECK_CONFIG:
+                    self._send_config()
+                elif frame is not None:
+                    self._send(frame)
+
+                now = time.monotonic()
+                if now >= nextPing:
+                    nextPing = now + HEARTBEAT_INTERVAL
+
+                    if now - self.lastSeen > HEARTBEAT_TIMEOUT:
+                        log.info("%s timed out", self.deviceId)
+                        break
+                    if self.expires is not None and time.time() >= self.expires:
+                        self._send({"type": "error", "message": "Token expired"})
+                        break
+
+                    self._send({"type": "ping", "time": time.time()})
+                    # Leased actions that were not acknowledged in time, and configuration
+                    # files changed outside the server are picked up here
+                    self._send_actions()
+                    self._send_config()
+        except ConnectionClosed:
+            pass
+        finally:
+            self.close()
+
+    def handle(self, frame):
+        """Process one frame received from the Beacon."""
+        self.lastSeen = time.monotonic()
+        frameType = frame.get("type")
+
+        if frameType == "info":
+            try:
+                fields = DeviceManager.ParseInfo(frame)
+            except ValueError as e:
+                self.enqueue({"type": "error", "message": str(e)})
+                return
+            DeviceManager.UpdateBeaconData(self.deviceId, **fields)
+            Metrics.INGESTED_ITEMS.inc(self.deviceId, "info")
+
+        elif frameType == "message":
+            if "message" not in frame:
+                self.enqueue({"type": "error", "message": "Message text is required."})
+                return
+            MessageStore.Get().insert(self.deviceId, frame["message"], datetime.datetime.now(datetime.timezone.utc).isoformat())
+            DeviceManager.UpdateBeaconData(self.deviceId)
+            Metrics.INGESTED_ITEMS.inc(self.deviceId, "message")
+
+        elif frameType == "ack":
+            try:
+                ActionQueue.Get().ack(frame.get("ids") or [])
+            except ValueError as e:
+                self.enqueue({"type": "error", "message": str(e)})
+
+        elif frameType == "ping":
+            self.enqueue({"type": "pong"})
+
+        elif frameType == "pong":
+            pass
+
+        else:
+            self.enqueue({"type": "error", "message": f"Unknown frame type: {frameType}"})
+
+
+def _Receive(ws, timeout):
+    data = ws.receive(timeout=timeout)
+    if data is None:
+        return None
+    frame = json.loads(data)
+    if not isinstance(frame, dict):
+        raise ValueError("Frames must be JSON objects")
+    return frame
+
+
+def Serve(ws, authenticate):
+    """
+    Run a Beacon connection until it is closed (called from the WebSocket route).
+
+    :param ws: The flask_sock WebSocket.
+    :param authenticate: Function that verifies an access token and returns its
+                         (user, expiration timestamp), or raises an exception.
+    """
+    try:
+        frame = _Receive(ws, AUTH_TIMEOUT)
+        if frame is None or frame.get("type") != "auth" or not frame.get("deviceId"):
+            ws.send(json.dumps({"type": "error", "message": "First frame must be auth with token and deviceId"}))
+            return
+
+        try:
+            user, expires = authenticate(frame.get("token") or "")
+        except Exception as e:
+            ws.send(json.dumps({"type": "error", "message": f"Authentication failed: {e}"}))
+            return
+    except (ConnectionClosed, ValueError):
+        return
+
+    connection = BeaconConnection(ws, str(frame["deviceId"]), user, expires)
+    _Register(connection)
+    log.info("%s connected as %s", connection.deviceId, user)
+
+    sender = threading.Thread(target=connection.sender, name=f"push-{connection.deviceId}", daemon=True)
+    sender.start()
+
+    connection.enqueue({"type": "welcome", "deviceId": connection.deviceId, "heartbeat": HEARTBEAT_INTERVAL})
+    connection.enqueue(_CHECK_CONFIG)
+    connection.enqueue(_CHECK_ACTIONS)
+
+    try:
+        while not connection.closed.is_set():
+            try:
+                frame = _Receive(ws, HEARTBEAT_INTERVAL)
+            except ValueError as e:
+                connection.enqueue({"type": "error", "message": f"Invalid frame: {e}"})
+                continue
+            if frame is not None:
+                connection.handle(frame)
+    except ConnectionClosed:
+        pass
+    finally:
+        connection.close()
+        _Unregister(connection)
+        sender.join(timeout=1)
+        log.info("%s disconnected", connection.deviceId)
+
+
+def _Register(connection):
+    with _connectionsLock:
+        _connections.setdefault(connection.deviceId, set()).add(connection)
+    ActionQueue.Get().subscribe(connection.on_action)
+    ConfigService.Get().subscribe(connection.on_config)
+
+
+def _Unregister(connection):
+    ActionQueue.Get().unsubscribe(connection.on_action)
+    ConfigService.Get().unsubscribe(connection.on_config)
+    with _connectionsLock:
+        connections = _connections.get(connection.deviceId)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del _connections[connection.deviceId]
+
+
+def ConnectedDevices():
+    """Return the IDs of the devices that have an open push channel."""
+    with _connectionsLock:
+        return list(_connections)
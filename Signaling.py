@@ -0,0 +1,532 @@
+"""
+WebRTC signaling relay with rooms, multiple listeners per sender, and pluggable pub/sub.
+
+Every Beacon has its own room. A peer joins a room with a JSON hello frame:
+
+    {"room": "Beacon_1", "role": "sender" | "listener", "peerId": "optional", "token": "<access token>"}
+
+and the server answers {"type": "joined", "room": ..., "peerId": ...}. After that,
+every frame has the form
+
+    <target>\\n<payload>
+
+where <target> is a peer ID (which can't start with "@" or "{"), "@all"
+(everyone else in the room), "@senders" or "@listeners". The payload (SDP
+offers, answers, ICE candidates, ...) is never parsed: it is forwarded to the
+targets as "<from peer ID>\\n<payload>".
+
+The peers also get {"type": "peer-joined" | "peer-present" | "peer-left", "peerId", "role"}
+events, so a sender knows whom to send offers to, even if the peers are
+connected to different workers.
+
+Room names, peer IDs and targets can't contain tabs or newlines. A frame
+with an invalid target is answered with {"type": "error", "message": ...}, and
+the connection stays open.
+
+Rooms are connected through a broker, so peers on different gunicorn workers
+can talk to each other:
+    -InProcessBroker: the default, for a single process
+    -SocketBroker: a client of the small TCP broker started by
+        python Signaling.py broker [--host 127.0.0.1] [--port 5099]
+     (a local stand-in for Redis-like pub/sub). The connection is reopened with
+     growing waits if the broker goes away; frames published meanwhile are lost.
+"""
+import argparse
+import json
+import logging
+import socket
+import socketserver
+import struct
+import threading
+import uuid
+
+from simple_websocket import ConnectionClosed
+
+log = logging.getLogger(__name__)
+
+ROLES = ("sender", "listener")
+
+BROKER = "inprocess"
+BROKER_ADDRESS = ("127.0.0.1", 5099)
+
+# Seconds between two attempts to reconnect to the TCP broker (doubled up to the maximum)
+BROKER_RETRY_MIN = 0.5
+BROKER_RETRY_MAX = 30.0
+
+_broker = None
+_brokerLock = threading.Lock()
+_rooms = {}
+_roomsLock = threading.Lock()
+
+
+#######################################
+#
+#   Pub/sub brokers
+#
+#######################################
+
+
+class InProcessBroker:
+    """Delivers the published messages to the subscribers of the same process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel, callback):
+        with self._lock:
+            callbacks = self._subscribers.get(channel, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._subscribers.pop(channel, None)
+
+    def channels(self):
+        with self._lock:
+            return list(self._subscribers)
+
+    def publish(self, channel, data):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, []))
+        # A failing subscriber must not break the publisher (a WebSocket or the broker reader)
+        for callback in callbacks:
+            try:
+                callback(data)
+            except Exception:
+                log.exception("Delivery on %s failed", channel)
+
+    def close(self):
+        pass
+
+
+# Broker wire format: 4 byte length, then "<op> <channel>\n<data>"
+def _WriteFrame(sock, op, channel, data=b""):
+    body = f"{op} {channel}\n".encode("utf-8") + data
+    sock.sendall(struct.pack(">I", len(body)) + body)
+
+
+def _ReadExactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Broker connection closed")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def _ReadFrame(sock):
+    size = struct.unpack(">I", _ReadExactly(sock, 4))[0]
+    body = _ReadExactly(sock, size)
+    header, data = body.split(b"\n", 1)
+    op, channel = header.decode("utf-8").split(" ", 1)
+    return op, channel, data
+
+
+class SocketBroker:
+    """
+    Client of the TCP broker, shared by the rooms of one worker process.
+
+    The reader thread connects, and reconnects with growing waits whenever the
+    connection is lost; the subscriptions are sent again on every new connection.
+    """
+
+    def __init__(self, address=BROKER_ADDRESS):
+        self.address = address
+        self._sock = None
+        self._sendLock = threading.Lock()
+        self._closed = threading.Event()
+        self._local = InProcessBroker()
+        try:
+            self._connect()
+        except OSError as e:
+            log.warning("Broker %s:%d unreachable: %s", *self.address, e)
+        self._reader = threading.Thread(target=self._read, name="signaling-broker", daemon=True)
+        self._reader.start()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address)
+        with self._sendLock:
+            for channel in self._local.channels():
+                _WriteFrame(sock, "SUB", channel)
+            self._sock = sock
+        return sock
+
+    def _read(self):
+        sock = self._sock
+        delay = BROKER_RETRY_MIN
+        while not self._closed.is_set():
+            if sock is None:
+                self._closed.wait(delay)
+                try:
+                    sock = self._connect()
+                except OSError as e:
+                    delay = min(delay * 2, BROKER_RETRY_MAX)
+                    log.warning("Broker %s:%d unreachable, retrying in %.1f s: %s", *self.address, delay, e)
+                    continue
+                log.info("Reconnected to the broker %s:%d", *self.address)
+                delay = BROKER_RETRY_MIN
+
+            try:
+                while True:
+                    op, channel, data = _ReadFrame(sock)
+                    if op == "MSG":
+                        self._local.publish(channel, data)
+            except (ConnectionError, OSError, ValueError) as e:
+                if not self._closed.is_set():
+                    log.error("Broker connection lost: %s", e)
+            finally:
+                with self._sendLock:
+                    if self._sock is sock:
+                        self._sock = None
+                sock.close()
+                sock = None
+
+    def _send(self, op, channel, data=b""):
+        with self._sendLock:
+            if self._sock is None:
+                return False
+            try:
+                _WriteFrame(self._sock, op, channel, data)
+                return True
+            except OSError as e:
+                log.error("Broker connection lost: %s", e)
+                # Wakes the reader up, which reconnects
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return False
+
+    def subscribe(self, channel, callback):
+        # Without a connection the subscription is sent by the next _connect()
+        self._local.subscribe(channel, callback)
+        self._send("SUB", channel)
+
+    def unsubscribe(self, channel, callback):
+        self._local.unsubscribe(channel, callback)
+        self._send("UNSUB", channel)
+
+    def publish(self, channel, data):
+        if not self._send("PUB", channel, data):
+            log.warning("No broker connection, frame on %s dropped", channel)
+
+    def close(self):
+        self._closed.set()
+        with self._sendLock:
+            if self._sock is not None:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    """One worker connected to the TCP broker."""
+
+    def handle(self):
+        server = self.server
+        sendLock = threading.Lock()
+        subscriptions = {}
+
+        def deliver(channel, data):
+            with sendLock:
+                _WriteFrame(self.request, "MSG", channel, data)
+
+        try:
+            while True:
+                op, channel, data = _ReadFrame(self.request)
+                if op == "SUB":
+                    subscriptions[channel] = subscriptions.get(channel, 0) + 1
+                    if subscriptions[channel] == 1:
+                        server.subscribe(channel, deliver)
+                elif op == "UNSUB" and subscriptions.get(channel):
+                    subscriptions[channel] -= 1
+                    if subscriptions[channel] == 0:
+                        del subscriptions[channel]
+                        server.unsubscribe(channel, deliver)
+                elif op == "PUB":
+                    server.publish(channel, data)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            for channel in subscriptions:
+                server.unsubscribe(channel, deliver)
+
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, _BrokerHandler)
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, channel, deliver):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(deliver)
+
+    def unsubscribe(self, channel, deliver):
+        with self._lock:
+            delivers = self._subscribers.get(channel, [])
+            if deliver in delivers:
+                delivers.remove(deliver)
+            if not delivers:
+                self._subscribers.pop(channel, None)
+
+    def publish(self, channel, data):
+        with self._lock:
+            delivers = list(self._subscribers.get(channel, []))
+        for deliver in delivers:
+            try:
+                deliver(channel, data)
+            except OSError:
+                pass
+
+
+def Configure(broker=None, address=None):
+    """
+    Select the broker (usually from the "signaling" section of server-config.json).
+
+    :param broker: "inprocess" or "socket".
+    :param address: "host:port" of the TCP broker.
+    """
+    global BROKER, BROKER_ADDRESS
+
+    if broker is not None:
+        BROKER = broker
+    if address is not None:
+        host, port = address.rsplit(":", 1)
+        BROKER_ADDRESS = (host, int(port))
+
+
+def GetBroker():
+    global _broker
+
+    with _brokerLock:
+        if _broker is None:
+            if BROKER == "socket":
+                _broker = SocketBroker(BROKER_ADDRESS)
+            elif BROKER == "inprocess":
+                _broker = InProcessBroker()
+            else:
+                raise ValueError(f"Unknown signaling broker: {BROKER}")
+        return _broker
+
+
+#######################################
+#
+#   Rooms and peers
+#
+#######################################
+
+
+class Peer:
+    """A WebSocket connected to this worker."""
+
+    def __init__(self, ws, peerId, role):
+        self.ws = ws
+        self.peerId = peerId
+        self.role = role
+        self._sendLock = threading.Lock()
+
+    def send(self, data):
+        # The broker callbacks of several rooms may send at the same time
+        with self._sendLock:
+            try:
+                self.ws.send(data)
+            except ConnectionClosed:
+                pass
+
+    def matches(self, target, sender):
+        if self.peerId == sender:
+            return False
+        if target == "@all":
+            return True
+        if target == "@senders":
+            return self.role == "sender"
+        if target == "@listeners":
+            return self.role == "listener"
+        return self.peerId == target
+
+
+class Room:
+    """The local peers of one room, subscribed to the room's broker channel."""
+
+    def __init__(self, name):
+        self.name = name
+        self.channel = f"room:{name}"
+        self._lock = threading.Lock()
+        self._peers = {}
+
+    def add(self, peer):
+        with self._lock:
+            self._peers[peer.peerId] = peer
+
+    def remove(self, peer):
+        with self._lock:
+            if self._peers.get(peer.peerId) is peer:
+                del self._peers[peer.peerId]
+            return not self._peers
+
+    def peers(self):
+        with self._lock:
+            return list(self._peers.values())
+
+    def publish(self, kind, target, sender, payload):
+        # Envelope: "<kind>\t<target>\t<from>\n<payload>", the payload stays opaque
+        header = f"{kind}\t{target}\t{sender}\n".encode("utf-8")
+        GetBroker().publish(self.channel, header + payload)
+
+    def deliver(self, data):
+        """Broker callback: hand a published envelope to the matching local peers."""
+        try:
+            header, payload = data.split(b"\n", 1)
+            kind, target, sender = header.decode("utf-8").split("\t")
+            text = payload.decode("utf-8")
+            event = {"msg": None, "join": "peer-joined", "present": "peer-present", "leave": "peer-left"}[kind]
+        except (ValueError, KeyError) as e:
+            # One bad envelope is dropped, the room and the broker connection go on
+            log.warning("Malformed envelope in %s dropped: %s", self.name, e)
+            return
+
+        for peer in self.peers():
+            if not peer.matches(target, sender):
+                continue
+
+            if event is None:
+                peer.send(f"{sender}\n{text}")
+            else:
+                peer.send(json.dumps({"type": event, "peerId": sender, "role": text}))
+
+                # Introduce ourselves to the newcomer, wherever it is connected
+                if kind == "join":
+                    self.publish("present", sender, peer.peerId, peer.role.encode("utf-8"))
+
+
+def _JoinRoom(name, peer):
+    with _roomsLock:
+        room = _rooms.get(name)
+        if room is None:
+            room = Room(name)
+            _rooms[name] = room
+            GetBroker().subscribe(room.channel, room.deliver)
+        room.add(peer)
+    return room
+
+
+def _LeaveRoom(room, peer):
+    with _roomsLock:
+        if room.remove(peer) and _rooms.get(room.name) is room:
+            del _rooms[room.name]
+            GetBroker().unsubscribe(room.channel, room.deliver)
+
+
+def _ValidName(name):
+    # Tabs and newlines separate the fields of the envelopes and broker frames
+    return bool(name) and "\t" not in name and "\n" not in name
+
+
+def _Hello(hello, authenticate):
+    """Parse the hello frame into (room, peer ID, role); raises ValueError if it is invalid."""
+    try:
+        data = json.loads(hello)
+    except ValueError:
+        data = None
+
+    if not isinstance(data, dict):
+        raise ValueError("Hello must be a JSON object with 'room', 'role' and 'token'")
+
+    room = data.get("room")
+    role = data.get("role")
+    if not room or role not in ROLES:
+        raise ValueError("Hello must contain 'room' and 'role' (sender or listener)")
+
+    authenticate(data.get("token") or "")
+
+    room = str(room)
+    if not _ValidName(room):
+        raise ValueError(f"Invalid room: {room}")
+
+    peerId = str(data.get("peerId") or uuid.uuid4().hex)
+    if peerId.startswith(("@", "{")) or not _ValidName(peerId):
+        raise ValueError(f"Invalid peer ID: {peerId}")
+    return room, peerId, role
+
+
+def Serve(ws, authenticate):
+    """
+    Run a signaling connection until it is closed (called from the WebSocket route).
+
+    :param ws: The flask_sock WebSocket.
+    :param authenticate: Function that verifies an access token, or raises an exception.
+    """
+    try:
+        hello = ws.receive()
+        if not hello:
+            return
+        try:
+            if isinstance(hello, bytes):
+                hello = hello.decode("utf-8")
+            roomName, peerId, role = _Hello(hello, authenticate)
+        except Exception as e:
+            ws.send(json.dumps({"type": "error", "message": str(e)}))
+            return
+    except ConnectionClosed:
+        return
+
+    peer = Peer(ws, peerId, role)
+    room = _JoinRoom(roomName, peer)
+    log.info("%s joined %s as %s", peerId, roomName, role)
+
+    peer.send(json.dumps({"type": "joined", "room": roomName, "peerId": peerId}))
+    room.publish("join", "@all", peerId, role.encode("utf-8"))
+
+    try:
+        while True:
+            msg = ws.receive()
+            if msg is None:
+                break
+            if isinstance(msg, bytes):
+                try:
+                    msg = msg.decode("utf-8")
+                except UnicodeDecodeError:
+                    peer.send(json.dumps({"type": "error", "message": "Frames must be UTF-8 text"}))
+                    continue
+
+            target, sep, payload = msg.partition("\n")
+            if not sep or not target:
+                continue
+            if not _ValidName(target):
+                peer.send(json.dumps({"type": "error", "message": f"Invalid target: {target}"}))
+                continue
+            room.publish("msg", target, peerId, payload.encode("utf-8"))
+    except ConnectionClosed:
+        pass
+    finally:
+        room.publish("leave", "@all", peerId, role.encode("utf-8"))
+        _LeaveRoom(room, peer)
+        log.info("%s left %s", peerId, roomName)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Signaling pub/sub broker for multi-worker deployments")
+    parser.add_argument("command", choices=["broker"], help="What do you want to do?")
+    parser.add_argument("--host", default=BROKER_ADDRESS[0])
+    parser.add_argument("--port", type=int, default=BROKER_ADDRESS[1])
+
+    args = parser.parse_args()
+
+    if args.command == "broker":
+        with BrokerServer((args.host, args.port)) as server:
+            print(f"[Signaling] Broker listening on {args.host}:{args.port}")
+            server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
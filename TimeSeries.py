@@ -0,0 +1,369 @@
+"""
+Append-only history of the Beacon telemetry (battery levels, temperatures, latency).
+
+The beacons table only holds the latest values; every reading is also appended here
+as one fixed-size NumPy record, in one chunk file per device and UTC day:
+
+    database/telemetry/<deviceId>/raw/<YYYYmmdd>.bin       (time + one float32 per field)
+    database/telemetry/<deviceId>/<ROLLUP_STEP>s/<YYYYmmdd>.bin   (time + min/max/sum/count per field)
+
+Retention tiers: raw days older than RAW_RETENTION_DAYS are rolled up into ROLLUP_STEP
+buckets (and the raw chunk is deleted); rollups older than ROLLUP_RETENTION_DAYS are
+deleted. Compact() does both, StartCompactor() runs it periodically.
+
+Queries read only the chunks of the requested days, and compute the min/max/avg of
+every 'step' seconds with vectorized NumPy reductions (reduceat), so a week-long
+chart is a few hundred points, whatever the number of raw readings.
+"""
+import datetime
+import logging
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+import ImageStore
+import Metrics
+
+log = logging.getLogger(__name__)
+
+TELEMETRY_DIR = os.path.join("database", "telemetry")
+
+# Recorded telemetry fields (same as DeviceManager.INFO_FIELDS)
+FIELDS = ("batteryLevel", "controllerBattery", "coreTemp", "houseTemp", "latency")
+
+RAW_RETENTION_DAYS = 7
+ROLLUP_STEP = 300
+ROLLUP_RETENTION_DAYS = 365
+
+# Buckets returned by one query
+MAX_POINTS = 2000
+
+# Buckets of a query without 'step'
+DEFAULT_POINTS = 500
+
+# Longest range of one query
+MAX_RANGE_DAYS = 3660
+
+RAW_DTYPE = np.dtype([("t", "<f8")] + [(field, "<f4") for field in FIELDS])
+ROLLUP_DTYPE = np.dtype([("t", "<f8")] + [(f"{field}_{part}", dtype) for field in FIELDS
+                                          for part, dtype in (("min", "<f4"), ("max", "<f4"), ("sum", "<f8"), ("count", "<u4"))])
+
+_DAY = 86400
+_store = None
+_storeLock = threading.Lock()
+_compactor = None
+
+
+def _DayName(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y%m%d")
+
+
+def _DayStart(name):
+    return datetime.datetime.strptime(name, "%Y%m%d").replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def ParseTime(value, default=None):
+    """
+    Turn a request parameter (epoch seconds or ISO 8601) into epoch seconds.
+
+    :raises ValueError: If the value is neither.
+    """
+    if value is None or value == "":
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.astimezone()
+    return parsed.timestamp()
+
+
+def _ToRollup(raw):
+    """Convert raw records into one-reading rollup records, so both tiers aggregate the same way."""
+    rollup = np.zeros(len(raw), dtype=ROLLUP_DTYPE)
+    rollup["t"] = raw["t"]
+    for field in FIELDS:
+        values = raw[field]
+        present = ~np.isnan(values)
+        rollup[f"{field}_min"] = values
+        rollup[f"{field}_max"] = values
+        rollup[f"{field}_sum"] = np.where(present, values, 0)
+        rollup[f"{field}_count"] = present
+    return rollup
+
+
+def _Aggregate(records, start, step):
+    """
+    Reduce rollup records (sorted by time) into 'step' second buckets from 'start'.
+
+    :return: (bucket start times, {field: (min, max, sum, count)}) with one element per non-empty bucket.
+    """
+    buckets = ((records["t"] - start) // step).astype(np.int64)
+    # Index of the first record of every bucket
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    times = start + buckets[starts] * step
+
+    result = {}
+    for field in FIELDS:
+        result[field] = (
+            np.fmin.reduceat(records[f"{field}_min"], starts),
+            np.fmax.reduceat(records[f"{field}_max"], starts),
+            np.add.reduceat(records[f"{field}_sum"], starts),
+            np.add.reduceat(records[f"{field}_count"].astype(np.int64), starts),
+        )
+    return times, result
+
+
+class TimeSeriesStore:
+    """Per-device, per-day chunk files of telemetry records."""
+
+    def __init__(self, root=TELEMETRY_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _path(self, deviceId, tier, day):
+        return os.path.join(self.root, ImageStore._SafeDeviceId(deviceId), tier, day + ".bin")
+
+    @staticmethod
+    def _rollup_tier():
+        return f"{ROLLUP_STEP}s"
+
+    def append(self, deviceId, timestamp=None, **values):
+        """
+        Record one reading; fields that are missing or None are stored as NaN.
+
+        :param deviceId: The ID of the beacon.
+        :param timestamp: Epoch seconds of the reading (default: now).
+        """
+        self.append_many([{"deviceId": deviceId, "timestamp": timestamp, **values}])
+
+    def append_many(self, readings):
+        """
+        Record many readings, with one file append per device and day.
+
+        :param readings: {"deviceId": ..., "timestamp": <epoch seconds or None>, <FIELDS>...} dicts.
+        """
+        chunks = {}
+        now = time.time()
+        for reading in readings:
+            values = [reading.get(field) for field in FIELDS]
+            if all(value is None for value in values):
+                continue
+            timestamp = reading.get("timestamp") or now
+            record = (timestamp,) + tuple(np.nan if value is None else float(value) for value in values)
+            chunks.setdefault((reading["deviceId"], _DayName(timestamp)), []).append(record)
+
+        with Metrics.STORAGE_LATENCY.time("telemetry", "write"), self._lock:
+            for (deviceId, day), records in chunks.items():
+                path = self._path(deviceId, "raw", day)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "ab") as f:
+                    f.write(np.array(records, dtype=RAW_DTYPE).tobytes())
+
+    def _days(self, deviceId, tier, first, last):
+        """Return the names of the existing chunks of a tier between two day names (inclusive)."""
+        folder = os.path.dirname(self._path(deviceId, tier, first))
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            return set()
+        return {name[:-len(".bin")] for name in names if name.endswith(".bin") and first <= name[:-len(".bin")] <= last}
+
+    def _read(self, deviceId, start, end):
+        """Return the rollup-form records of [start, end), sorted by time."""
+        parts = []
+        first, last = _DayName(start), _DayName(end)
+        rollupTier = self._rollup_tier()
+        # Only the chunks that exist are read, however long the range is
+        days = sorted(self._days(deviceId, rollupTier, first, last) | self._days(deviceId, "raw", first, last))
+
+        with Metrics.STORAGE_LATENCY.time("telemetry", "read"):
+            for name in days:
+                # A day being rolled up must not be read half-way (both or neither tier); the lock
+                # is taken per day, so the appends are not held up by a long query
+                with self._lock:
+                    rollupPath = self._path(deviceId, rollupTier, name)
+                    rawPath = self._path(deviceId, "raw", name)
+                    if os.path.exists(rollupPath):
+                        parts.append(np.fromfile(rollupPath, dtype=ROLLUP_DTYPE))
+                    if os.path.exists(rawPath):
+                        parts.append(np.fromfile(rawPath, dtype=RAW_DTYPE))
+
+        parts = [part if part.dtype == ROLLUP_DTYPE else _ToRollup(part) for part in parts]
+
+        if not parts:
+            return np.zeros(0, dtype=ROLLUP_DTYPE)
+        records = np.concatenate(parts)
+        records = records[(records["t"] >= start) & (records["t"] < end)]
+        # Buffered readings may arrive out of order
+        return records[np.argsort(records["t"], kind="stable")]
+
+    def query(self, deviceId, start, end, step=None, fields=None):
+        """
+        Return the min/max/avg of every 'step' seconds between 'start' and 'end'.
+
+        :param deviceId: The ID of the beacon.
+        :param start: Epoch seconds, inclusive.
+        :param end: Epoch seconds, exclusive.
+        :param step: Bucket size in seconds (default: the range divided into DEFAULT_POINTS).
+        :param fields: The fields to return (default: all).
+        :return: {"from", "to", "step", "t": [bucket start...], "fields": {field: {"min", "max", "avg", "count"}}};
+                 empty buckets are left out, missing values are None.
+        :raises ValueError: If the range, step or a field is invalid.
+        """
+        if not (math.isfinite(start) and math.isfinite(end)):
+            raise ValueError("'from' and 'to' must be finite.")
+        if end <= start:
+            raise ValueError("'to' must be after 'from'.")
+        if end - start > MAX_RANGE_DAYS * _DAY:
+            raise ValueError(f"The range can be at most {MAX_RANGE_DAYS} days.")
+        try:
+            _DayName(start), _DayName(end)
+        except (OverflowError, OSError, ValueError):
+            raise ValueError("'from' and 'to' must be dates between the years 1 and 9999.") from None
+        fields = list(fields or FIELDS)
+        unknown = [field for field in fields if field not in FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}. Use {', '.join(FIELDS)}.")
+
+        if step is None:
+            step = max(1, math.ceil((end - start) / DEFAULT_POINTS))
+        if not math.isfinite(step) or step <= 0:
+            raise ValueError("'step' must be a positive number.")
+        if (end - start) / step > MAX_POINTS:
+            raise ValueError(f"At most {MAX_POINTS} points can be returned, use a larger 'step'.")
+
+        records = self._read(deviceId, start, end)
+        result = {"from": start, "to": end, "step": step, "t": [], "fields": {field: {"min": [], "max": [], "avg": [], "count": []} for field in fields}}
+        if len(records) == 0:
+            return result
+
+        times, aggregates = _Aggregate(records, start, step)
+        result["t"] = times.tolist()
+        for field in fields:
+            mins, maxs, sums, counts = aggregates[field]
+            empty = counts == 0
+            with np.errstate(invalid="ignore", divide="ignore"):
+                avgs = sums / counts
+            result["fields"][field] = {
+                "min": _List(mins, empty),
+                "max": _List(maxs, empty),
+                "avg": _List(avgs, empty),
+                "count": counts.tolist(),
+            }
+        return result
+
+    def compact(self, now=None):
+        """
+        Apply the retention tiers: roll up the raw days older than RAW_RETENTION_DAYS,
+        and delete the rollups older than ROLLUP_RETENTION_DAYS.
+
+        :return: Number of (rolled up, deleted) chunk files.
+        """
+        now = now or time.time()
+        rawLimit = _DayName(now - RAW_RETENTION_DAYS * _DAY)
+        rollupLimit = _DayName(now - ROLLUP_RETENTION_DAYS * _DAY)
+        rolled = deleted = 0
+
+        if not os.path.isdir(self.root):
+            return rolled, deleted
+
+        for device in os.listdir(self.root):
+            rawDir = os.path.join(self.root, device, "raw")
+            rollupDir = os.path.join(self.root, device, self._rollup_tier())
+
+            for name in sorted(os.listdir(rawDir)) if os.path.isdir(rawDir) else []:
+                day = name[:-len(".bin")]
+                if not name.endswith(".bin") or day >= rawLimit:
+                    continue
+                with self._lock:
+                    self._roll_up(os.path.join(rawDir, name), os.path.join(rollupDir, name), _DayStart(day))
+                rolled += 1
+
+            for name in os.listdir(rollupDir) if os.path.isdir(rollupDir) else []:
+                if name.endswith(".bin") and name[:-len(".bin")] < rollupLimit:
+                    os.remove(os.path.join(rollupDir, name))
+                    deleted += 1
+
+        if rolled or deleted:
+            log.info("Rolled up %d and deleted %d day chunks", rolled, deleted)
+        return rolled, deleted
+
+    @staticmethod
+    def _roll_up(rawPath, rollupPath, dayStart):
+        raw = np.fromfile(rawPath, dtype=RAW_DTYPE)
+        records = _ToRollup(raw[np.argsort(raw["t"], kind="stable")])
+        if os.path.exists(rollupPath):
+            records = np.concatenate([np.fromfile(rollupPath, dtype=ROLLUP_DTYPE), records])
+            records = records[np.argsort(records["t"], kind="stable")]
+
+        rollup = np.zeros(0, dtype=ROLLUP_DTYPE)
+        if len(records):
+            times, aggregates = _Aggregate(records, dayStart, ROLLUP_STEP)
+            rollup = np.zeros(len(times), dtype=ROLLUP_DTYPE)
+            rollup["t"] = times
+            for field, (mins, maxs, sums, counts) in aggregates.items():
+                rollup[f"{field}_min"] = mins
+                rollup[f"{field}_max"] = maxs
+                rollup[f"{field}_sum"] = sums
+                rollup[f"{field}_count"] = counts
+
+        os.makedirs(os.path.dirname(rollupPath), exist_ok=True)
+        tmp = rollupPath + ".tmp"
+        rollup.tofile(tmp)
+        os.replace(tmp, rollupPath)
+        os.remove(rawPath)
+
+
+def _List(values, empty):
+    return [None if isEmpty else round(float(value), 4) for value, isEmpty in zip(values, empty)]
+
+
+def Configure(rawRetentionDays=None, rollupStep=None, rollupRetentionDays=None):
+    """Set the retention tiers (from the 'telemetry' section of the server configuration)."""
+    global RAW_RETENTION_DAYS, ROLLUP_STEP, ROLLUP_RETENTION_DAYS
+    if rawRetentionDays:
+        RAW_RETENTION_DAYS = int(rawRetentionDays)
+    if rollupStep:
+        ROLLUP_STEP = int(rollupStep)
+    if rollupRetentionDays:
+        ROLLUP_RETENTION_DAYS = int(rollupRetentionDays)
+
+
+def Get():
+    """Return the shared TimeSeriesStore."""
+    global _store
+    with _storeLock:
+        if _store is None:
+            _store = TimeSeriesStore()
+        return _store
+
+
+def StartCompactor(interval):
+    """
+    Run Compact() every 'interval' seconds in a background thread.
+
+    :param interval: Seconds between two runs; 0 or None disables the compactor.
+    """
+    global _compactor
+    if not interval or _compactor is not None:
+        return
+
+    def run():
+        while True:
+            # Any failure is logged and retried on the next run, the thread must not die
+            try:
+                Get().compact()
+            except Exception:
+                log.exception("Compaction failed")
+            time.sleep(interval)
+
+    _compactor = threading.Thread(target=run, name="telemetry-compactor", daemon=True)
+    _compactor.start()
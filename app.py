@@ -1,19 +1,56 @@
 import base64
 import datetime
+import hmac
 import logging
 from functools import wraps
 import os
+import queue
+import threading
+import time
 from flask import Flask, render_template, request, jsonify, send_file
 import jwt
+from werkzeug.http import quote_etag, unquote_etag
 from werkzeug.security import check_password_hash, generate_password_hash
 import json
-from tinydb import TinyDB, Query
+from tinydb import Query
 from flask_sock import Sock
 
+import ActionQueue
+import AudioRelay
+import AuthCache
+import ConfigService
+import Database
 import DeviceManager
+import ImageArchive
+import ImageStore
+import ImageVariants
+import Logs
+import MessageStore
+import Metrics
+import PushChannel
+import Signaling
+import TimeSeries
 
 app = Flask(__name__)
 
+log = logging.getLogger("app")
+accessLog = logging.getLogger("app.access")
+
+# Default and maximal page size of the paginated /get-messages responses
+MESSAGES_PAGE_SIZE = 100
+MESSAGES_MAX_PAGE_SIZE = 1000
+
+# Buffered events of one /device-events client, and seconds between two keep-alive comments
+DEVICE_EVENTS_QUEUE_SIZE = 100
+DEVICE_EVENTS_KEEPALIVE = 15
+
+# Items accepted in one /ingest request
+MAX_INGEST_ITEMS = 1000
+
+# Lifetime of the issued tokens
+ACCESS_TOKEN_LIFETIME = datetime.timedelta(hours=2)
+REFRESH_TOKEN_LIFETIME = datetime.timedelta(days=30)
+
 #######################################
 #
 #   Audio transmission via WebSocket
@@ -21,41 +58,84 @@ app = Flask(__name__)
 #######################################
 
 
-'''
+sock = Sock(app)
 
 
-sock = Sock(app)
+# Every log record of a request carries its ID (taken from 'X-Request-ID' or generated) and the device ID
+@app.before_request
+def bind_log_context():
+    request.started = time.perf_counter()
+    request.request_id = Logs.BindRequest(request.headers.get("X-Request-ID"))
+
+    deviceId = request.args.get('deviceId')
+    if deviceId is None and request.is_json:
+        # Parsed once: the handlers get the cached body
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            deviceId = body.get('deviceId')
+    if deviceId is not None:
+        Logs.BindDevice(deviceId)
+
+
+@app.after_request
+def log_request(response):
+    started = getattr(request, "started", None)
+    if started is None:
+        return response
+
+    response.headers["X-Request-ID"] = request.request_id
+    accessLog.info("%s %s %s", request.method, request.path, response.status_code,
+                   extra={"status": response.status_code, "duration_ms": round((time.perf_counter() - started) * 1000, 2), "user": getattr(request, "user", None)})
+    return response
+
+
+@app.teardown_request
+def clear_log_context(exc):
+    Logs.ClearContext()
+
+
+# Request counts, latencies and body sizes per endpoint (see Metrics.py)
+#   -- the endpoint is the URL rule, not the path, so the IDs in the paths don't create new series
+@app.before_request
+def start_request_metrics():
+    if Metrics.Enabled():
+        request.in_flight = True
+        Metrics.HTTP_IN_FLIGHT.inc()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = getattr(request, "started", None)
+    if started is None or not Metrics.Enabled():
+        return response
+
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    Metrics.HTTP_LATENCY.observe(time.perf_counter() - started, request.method, endpoint)
+    Metrics.HTTP_REQUESTS.inc(request.method, endpoint, str(response.status_code))
+    if request.content_length:
+        Metrics.HTTP_REQUEST_BYTES.inc(endpoint, amount=request.content_length)
+    # Streamed responses have no length
+    if response.content_length:
+        Metrics.HTTP_RESPONSE_BYTES.inc(endpoint, amount=response.content_length)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if getattr(request, "in_flight", False):
+        Metrics.HTTP_IN_FLIGHT.dec()
+
 
 @app.route('/')
 def home():
     return render_template('index.html')
 
 
-clients = {}
-
+# Signaling relay of the WebRTC audio: rooms per beacon, opaque payloads (see Signaling.py)
 @sock.route("/ws")
 def ws_endpoint(ws):
-    peer_id = ws.receive()
-    if not peer_id:
-        return
-    clients[peer_id] = ws
-    print(f"[SIGNAL] {peer_id} connected")
+    Signaling.Serve(ws, authenticate_token)
 
-    try:
-        while True:
-            msg = ws.receive()
-            if msg is None:
-                break
-            data = json.loads(msg)
-            target = data.get("target")
-            print(f"[SIGNAL] {peer_id} -> {target}: {data.get('type')}")
-            if target and target in clients:
-                clients[target].send(json.dumps(data))
-    finally:
-        if clients.get(peer_id) is ws:
-            del clients[peer_id]
-        print(f"[SIGNAL] {peer_id} disconnected")
-'''
 #######################################
 #
 #   Secured API Endpoints
@@ -63,29 +143,84 @@ def ws_endpoint(ws):
 #######################################
 
 
+# --- verifies the token's signature and expiration, and returns its payload ---
+#   -- a token verified once is served from AuthCache until its 'exp', without decoding it again
+def decode_token(token):
+    tokens = AuthCache.Tokens()
+    payload = tokens.get(token)
+    if payload is not None:
+        return payload
+
+    payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    if payload.get("typ") == "refresh":
+        raise jwt.InvalidTokenError("Refresh tokens can only be used on /refresh")
+    tokens.put(token, payload)
+    return payload
+
+
+# --- creates a signed access or refresh token for the user ---
+def issue_token(username, kind="access"):
+    now = datetime.datetime.utcnow()
+    lifetime = REFRESH_TOKEN_LIFETIME if kind == "refresh" else ACCESS_TOKEN_LIFETIME
+    payload = {
+        "sub": username,  # subject
+        "typ": kind,
+        "iat": now,
+        "exp": now + lifetime
+    }
+    # PyJWT v2+ visszaad stringet
+    return jwt.encode(payload, app.config['SECRET_KEY'], algorithm="HS256")
+
+
+# --- the body of the /login and /refresh responses ---
+def token_response(username, refreshToken):
+    return jsonify({
+        "access_token": issue_token(username),
+        "refresh_token": refreshToken,
+        "token_type": "Bearer",
+        "expires_in": int(ACCESS_TOKEN_LIFETIME.total_seconds())
+    })
+
+
+# --- token check of the WebSocket connections: returns the (user, expiration) of the token ---
+def authenticate_token(token):
+    payload = decode_token(token)
+    return payload.get("sub"), payload.get("exp")
+
+
+# --- checks the Bearer token in the Authorization header: sets request.user, or returns the error response ---
+def check_bearer_token():
+    auth_header = request.headers.get("Authorization", None)
+    if not auth_header:
+        return jsonify({"message": "Authorization header missing"}), 401
+
+    # várt formátum: "Bearer <token>"
+    parts = auth_header.split()
+    if len(parts) != 2 or parts[0].lower() != "bearer":
+        return jsonify({"message": "Invalid Authorization header format. Expected: Bearer <token>"}), 401
+
+    token = parts[1]
+    try:
+        payload = decode_token(token)
+        # payload tartalmazhat pl. 'sub' (subject) vagy 'user' mezőt
+        request.user = payload.get("sub")
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    return None
+
+
 # --- decorator that checks the Bearer token in the Authorization header ---
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth_header = request.headers.get("Authorization", None)
-        if not auth_header:
-            return jsonify({"message": "Authorization header missing"}), 401
-
-        # várt formátum: "Bearer <token>"
-        parts = auth_header.split()
-        if len(parts) != 2 or parts[0].lower() != "bearer":
-            return jsonify({"message": "Invalid Authorization header format. Expected: Bearer <token>"}), 401
+        started = time.perf_counter()
+        error = check_bearer_token()
+        Metrics.AUTH_LATENCY.observe(time.perf_counter() - started, "rejected" if error else "accepted")
+        if error:
+            return error
 
-        token = parts[1]
-        try:
-            payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            # payload tartalmazhat pl. 'sub' (subject) vagy 'user' mezőt
-            request.user = payload.get("sub")
-        except jwt.ExpiredSignatureError:
-            return jsonify({"message": "Token expired"}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({"message": "Invalid token"}), 401
-        
         return f(*args, **kwargs)
     return decorated
 
@@ -99,22 +234,136 @@ def login():
         return jsonify({"message": "Missing username or password"}), 400
 
     # Read the user from the database
-    db = TinyDB("database/users.json")
+    db = Database.Get("users")
     userQuerry = Query()
-    user = db.search(userQuerry.username == username)[0]
-
-    if not user or not check_password_hash(user["password"], password):
+    user = db.get(userQuerry.username == username)
+    if not user:
         return jsonify({"message": "Invalid credentials"}), 401
 
-    # token payload
-    payload = {
-        "sub": username,  # subject
-        "iat": datetime.datetime.utcnow(),
-        "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=2)  # lejárat: 2 óra
-    }
-    token = jwt.encode(payload, app.config['SECRET_KEY'], algorithm="HS256")
-    # PyJWT v2+ visszaad stringet
-    return jsonify({"access_token": token})
+    # The slow password hash is only checked again once the remembered check expires
+    credentials = AuthCache.Credentials()
+    if not credentials.verified(username, password, user["password"]):
+        if not check_password_hash(user["password"], password):
+            return jsonify({"message": "Invalid credentials"}), 401
+        credentials.remember(username, password, user["password"])
+
+    return token_response(username, issue_token(username, "refresh"))
+
+
+# --- új access token a refresh token alapján, jelszó nélkül ---
+#   -- requires 'refresh_token' in the request body
+@app.route("/refresh", methods=["POST"])
+def refresh():
+    data = request.get_json(silent=True) or {}
+    refreshToken = data.get("refresh_token")
+    if not refreshToken:
+        return jsonify({"message": "Missing refresh token"}), 400
+
+    try:
+        payload = jwt.decode(refreshToken, app.config['SECRET_KEY'], algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Refresh token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid refresh token"}), 401
+    if payload.get("typ") != "refresh":
+        return jsonify({"message": "Invalid refresh token"}), 401
+
+    # The user may have been removed since the login
+    username = payload.get("sub")
+    if not Database.Get("users").contains(Query().username == username):
+        return jsonify({"message": "Invalid refresh token"}), 401
+
+    return token_response(username, refreshToken)
+
+
+#######################################
+#
+#   Beacon push channel (WebSocket)
+#
+#######################################
+
+# Persistent connection of a Beacon: authenticates once, then receives its actions and
+# configuration as pushed events and sends telemetry as frames (see PushChannel.py)
+@sock.route("/beacon-ws")
+def beacon_ws(ws):
+    PushChannel.Serve(ws, authenticate_token)
+
+
+#######################################
+#
+#   Audio relay (server-side fan-out)
+#
+#######################################
+
+# Publish the Beacon's microphone to the server once; listeners are served from the server (see AudioRelay.py)
+#   -- requires 'deviceId' and the SDP offer ('sdp', 'type') in the request body
+#   -- optionally 'record' to save the audio on the server
+@app.route("/audio/publish", methods=["POST"])
+@token_required
+def audio_publish():
+    if not AudioRelay.Available():
+        return jsonify(success=False, message="The audio relay is not available on this server."), 503
+
+    data = request.get_json(silent=True) or {}
+    if not data.get('deviceId'):
+        return jsonify(success=False, message="Device ID is required."), 400
+
+    try:
+        answer = AudioRelay.Publish(data['deviceId'], data, record=data.get('record'))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    except TimeoutError as e:
+        return jsonify(success=False, message=str(e)), 504
+    return jsonify(success=True, **answer), 200
+
+
+# Listen to the microphone of a Beacon through the server
+#   -- requires 'deviceId' and the SDP offer (receive-only audio) in the request body
+@app.route("/audio/listen", methods=["POST"])
+@token_required
+def audio_listen():
+    if not AudioRelay.Available():
+        return jsonify(success=False, message="The audio relay is not available on this server."), 503
+
+    data = request.get_json(silent=True) or {}
+    if not data.get('deviceId'):
+        return jsonify(success=False, message="Device ID is required."), 400
+
+    try:
+        answer = AudioRelay.Listen(data['deviceId'], data)
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    except LookupError as e:
+        return jsonify(success=False, message=str(e)), 404
+    except OverflowError as e:
+        return jsonify(success=False, message=str(e)), 429
+    except TimeoutError as e:
+        return jsonify(success=False, message=str(e)), 504
+    return jsonify(success=True, **answer), 200
+
+
+# Stop relaying the microphone of a Beacon
+#   -- requires 'deviceId' in the request body
+@app.route("/audio/stop", methods=["POST"])
+@token_required
+def audio_stop():
+    data = request.get_json(silent=True) or {}
+    if not data.get('deviceId'):
+        return jsonify(success=False, message="Device ID is required."), 400
+    try:
+        stopped = AudioRelay.Available() and AudioRelay.Stop(data['deviceId'])
+    except TimeoutError as e:
+        return jsonify(success=False, message=str(e)), 504
+    if not stopped:
+        return jsonify(success=False, message=f"{data['deviceId']} is not publishing audio."), 404
+    return jsonify(success=True, message="Audio relay stopped."), 200
+
+
+# Get the published microphones and their listener counts
+@app.route("/audio/sessions", methods=["GET"])
+@token_required
+def audio_sessions():
+    return jsonify(success=True, data=AudioRelay.Sessions() if AudioRelay.Available() else []), 200
 
 
 #######################################
@@ -128,10 +377,25 @@ def login():
 @app.route("/ping")
 @token_required
 def ping():
-    print(f"Ping request from user: {request.user}")
+    log.debug("Ping request from user: %s", request.user)
     return jsonify(success=True, message=f"Hello {request.user}, ping successful."), 200
 
 
+# Metrics of the server in the Prometheus text format (see Metrics.py)
+#   -- requires 'Authorization: Bearer <token>' with the token of the "metrics" configuration
+#   -- not served (404) if the metrics are disabled or no token is set
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    token = Metrics.Token()
+    if not Metrics.Enabled() or token is None:
+        return jsonify(success=False, message="Metrics are disabled."), 404
+
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return jsonify({"message": "Invalid token"}), 401
+
+    return app.response_class(Metrics.Render(), content_type=Metrics.CONTENT_TYPE)
+
+
 #######################################
 #
 #   Client API Endpoints
@@ -143,9 +407,8 @@ def ping():
 @app.route("/get-devices", methods=["GET"])
 @token_required
 def get_devices():
-    db = TinyDB("database/beacons.json")
-    devices = [row["deviceId"] for row in db.all() if "deviceId" in row]
-    print(f"Get devices request from user: {request.user}")
+    devices = DeviceManager.GetRegistry().ids()
+    log.debug("Get devices request from user: %s", request.user)
     return jsonify(success=True, data=devices), 200
 
 
@@ -155,49 +418,164 @@ def get_devices():
 def get_device_info():
     device_id = request.args.get('deviceId')
 
-    print(f"Get device info request by: {request.user} for device ID: {device_id}")
+    device_info = DeviceManager.GetRegistry().get(device_id)
+    if device_info is None:
+        return jsonify(success=False, message="Device not found."), 404
 
-    db = TinyDB("database/beacons.json")
-    query = Query()
-    result = db.search(query.deviceId == device_id)
+    log.debug("Get device info request from user: %s", request.user)
+    return jsonify(success=True, data=device_info), 200
 
-    if not result:
-        return jsonify(success=False, message="Device not found."), 404
 
-    device_info = result[0]
+# Stream the changes of the Beacons as Server-Sent Events, instead of polling /get-device-info
+#   -- optionally 'deviceId' to follow only one device
+#   -- every event is {"deviceId": ..., "changes": {...}}; a comment line is sent every DEVICE_EVENTS_KEEPALIVE seconds
+@app.route("/device-events", methods=["GET"])
+@token_required
+def device_events():
+    device_id = request.args.get('deviceId')
+    events = queue.Queue(maxsize=DEVICE_EVENTS_QUEUE_SIZE)
+
+    def listener(deviceId, changes):
+        if device_id is None or deviceId == device_id:
+            try:
+                events.put_nowait({"deviceId": deviceId, "changes": changes})
+            except queue.Full:
+                pass  # A client that does not read drops events, it does not slow down the updates
+
+    def generate():
+        registry = DeviceManager.GetRegistry()
+        registry.subscribe(listener)
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=DEVICE_EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            registry.unsubscribe(listener)
+
+    return app.response_class(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# Get the telemetry history of a Beacon device as min/max/avg per time bucket
+#   -- requires 'deviceId'; 'from' and 'to' are epoch seconds or ISO 8601 (default: the last 24 hours)
+#   -- 'step': bucket size in seconds (default: the range in ~500 points)
+#   -- 'fields': comma separated subset of batteryLevel, controllerBattery, coreTemp, houseTemp, latency
+@app.route("/get-telemetry", methods=["GET"])
+@token_required
+def get_telemetry():
+    deviceId = request.args.get('deviceId')
+    if not deviceId:
+        return jsonify(success=False, message="Device ID is required."), 400
+
+    try:
+        end = TimeSeries.ParseTime(request.args.get('to'), time.time())
+        start = TimeSeries.ParseTime(request.args.get('from'), end - 86400)
+        step = float(request.args['step']) if request.args.get('step') else None
+        fields = request.args.get('fields')
+        data = TimeSeries.Get().query(deviceId, start, end, step=step, fields=fields.split(",") if fields else None)
+    except (ValueError, OverflowError, OSError) as e:
+        return jsonify(success=False, message=str(e)), 400
 
-    print(f"Get device info request from user: {request.user} for device ID: {device_id}")
-    return jsonify(success=True, data=device_info), 200
+    return jsonify(success=True, data=data), 200
 
 
 # Get the messages from the Beacon device
 #   -- optionally 'deviceId' and 'since' can be provided in the request body
+#   -- 'limit' (1 to MESSAGES_MAX_PAGE_SIZE) and/or 'cursor' returns one page and the 'next_cursor' of the following one
+#   -- 'format=ndjson' streams every matching message as one JSON object per line
 @app.route("/get-messages", methods=["GET"])
 @token_required
 def get_messages():
     device_id = request.args.get('deviceId')
     since = request.args.get('since')
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    output_format = request.args.get('format', default="json")
+
+    if limit is not None:
+        # An invalid limit must not fall back to the whole unpaginated history
+        try:
+            limit = int(limit)
+        except ValueError:
+            return jsonify(success=False, message="'limit' must be an integer."), 400
+        if not 1 <= limit <= MESSAGES_MAX_PAGE_SIZE:
+            return jsonify(success=False, message=f"'limit' must be between 1 and {MESSAGES_MAX_PAGE_SIZE}."), 400
+
+    after = None
+    if cursor:
+        try:
+            after = MessageStore.DecodeCursor(cursor)
+        except ValueError as e:
+            return jsonify(success=False, message=str(e)), 400
+
+    repository = MessageStore.Get()
+
+    log.debug("Get messages by user: %s", request.user)
 
-    db = TinyDB("database/messages.json")
-    Message = Query()
+    if output_format == "ndjson":
+        def generate():
+            for message in repository.iterate(deviceId=device_id, since=since, after=after):
+                yield json.dumps(message, ensure_ascii=False) + "\n"
 
-    query = None
+        return app.response_class(generate(), mimetype="application/x-ndjson"), 200
 
-    if device_id:
-        q = (Message.deviceId == device_id)
-        query = q if query is None else query & q
+    if limit is None and cursor is None:
+        results = repository.find(deviceId=device_id, since=since)
+        return jsonify(success=True, data=results), 200
 
-    if since:
-        q = (Message.timestamp >= since)
-        query = q if query is None else query & q
+    limit = limit or MESSAGES_PAGE_SIZE
+    results, last = repository.find_page(deviceId=device_id, since=since, limit=limit, after=after)
+    next_cursor = MessageStore.EncodeCursor(last) if last else None
 
-    if query is None:
-        results = db.all()
+    return jsonify(success=True, data=results, next_cursor=next_cursor), 200
+
+# Answer a poll conditionally
+#   -- an unchanged resource (matching If-None-Match / If-Modified-Since) is answered with '304 Not Modified'
+#      before anything is read; 'build' creates the full response otherwise
+def conditional_response(etag, last_modified, build):
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
     else:
-        results = db.search(query)
+        not_modified = request.if_modified_since is not None and request.if_modified_since >= last_modified
+
+    response = app.response_class(status=304) if not_modified else build()
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # Authenticated content: only the client may cache it, and it must revalidate every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+# Answer a poll of a file conditionally, with a strong ETag from the file's mtime and size
+def conditional_file_response(path, build):
+    stat = os.stat(path)
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    last_modified = datetime.datetime.fromtimestamp(int(stat.st_mtime), datetime.timezone.utc)
+
+    return conditional_response(etag, last_modified, build)
+
+
+# Send an image in the variant requested by the optional 'size' (thumb, small, medium or pixels)
+# and 'format' (png, webp, jpeg) parameters
+def send_image_variant(image):
+    try:
+        path, mimetype = ImageVariants.GetVariant(image, request.args.get('size'), request.args.get('format'))
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    except ImageVariants.UnreadableImageError as e:
+        return jsonify(success=False, message=str(e)), 415
+
+    # send_file answers If-None-Match / If-Modified-Since with 304 on its own (mtime based ETag)
+    #   -- the stores' paths are relative to the working directory, send_file would resolve them against the app's folder
+    response = send_file(os.path.abspath(path), mimetype=mimetype)
+    response.cache_control.private = True
+    return response
 
-    print(f"Get messages by user: {request.user} from device ID: {device_id}")
-    return jsonify(success=True, data=results), 200
 
 @app.route("/get-images", methods=["GET"])
 @token_required
@@ -205,49 +583,81 @@ def get_images():
     device_id = request.args.get("deviceId")
     last = request.args.get("last")  # pl. 20251026120000
 
-    print(f"Get images by user: {request.user} from device ID: {device_id}")
+    log.debug("Get images by user: %s", request.user)
 
-    uploads_dir = "./uploads"
+    # A katalógusból kérjük le a 'last' utáni képeket (legkorábbitól a legújabbig)
+    images = ImageStore.GetCatalog().since(last, deviceId=device_id)
 
-    if not os.path.exists(uploads_dir):
-        return jsonify(success=False, message="Uploads directory not found"), 404
+    if not images:
+        return jsonify(success=False, message="No images found"), 404
 
-    # Összegyűjtjük az összes PNG fájlt
-    image_files = [f for f in os.listdir(uploads_dir) if f.lower().endswith(".png")]
+    log.debug("Found %d images to send.", len(images))
 
-    # Csak a fájlnevet (dátumrész) hasonlítjuk össze
-    if last:
-        image_files = [
-            f for f in image_files
-            if f.split(".")[0].isdigit() and f.split(".")[0] > last
-        ]
+    # Ha csak egy képet kérnek (pl. a legutolsó), azt is kezeljük
+    if len(images) == 1:
+        return send_image_variant(images[0])
 
-    if not image_files:
+    # Több kép esetén visszaküldjük a fájlneveket JSON-ban
+    return jsonify(success=True, images=[info.name for info in images])
+
+
+# Download every image matching 'deviceId' / 'last' in one tar (default) or zip archive
+#   -- tar archives support 'Range' requests (with 'If-Range'), so interrupted downloads can be resumed
+@app.route("/get-images-archive", methods=["GET"])
+@token_required
+def get_images_archive():
+    device_id = request.args.get("deviceId")
+    last = request.args.get("last")
+    archive_format = request.args.get("format", default="tar")
+
+    if archive_format not in ImageArchive.FORMATS:
+        return jsonify(success=False, message=f"Invalid format: {archive_format}. Use tar or zip."), 400
+
+    images = ImageStore.GetCatalog().since(last, deviceId=device_id)
+    if not images:
         return jsonify(success=False, message="No images found"), 404
 
-    # A fájlokat dátum szerint rendezzük (legkorábbitól a legújabbig)
-    image_files.sort()
+    log.info("Get images archive by user: %s, %d images", request.user, len(images))
 
-    # Teljes elérési utak a fájlokhoz
-    image_paths = [os.path.join(uploads_dir, f) for f in image_files]
+    etag = ImageArchive.ArchiveETag(images)
+    download_name = f"images-{device_id or 'all'}-{last or 'all'}.{archive_format}"
+    headers = {
+        "Content-Disposition": f"attachment; filename={download_name}",
+        "ETag": quote_etag(etag),
+    }
 
-    print(f"Found {len(image_files)} images to send.")
+    if archive_format == "zip":
+        headers["Accept-Ranges"] = "none"
+        return app.response_class(ImageArchive.StreamZip(images), mimetype=ImageArchive.FORMATS["zip"], headers=headers), 200
 
-    # Ha csak egy képet kérnek (pl. a legutolsó), azt is kezeljük
-    if len(image_paths) == 1:
-        return send_file(image_paths[0], mimetype="image/png")
+    archive = ImageArchive.TarArchive(images)
+    headers["Accept-Ranges"] = "bytes"
 
-    # Több kép esetén visszaküldjük a fájlneveket JSON-ban
-    return jsonify(success=True, images=image_files)
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    # A resumed download is only continued if the archive is still the same
+    if if_range is None or unquote_etag(if_range)[0] == etag:
+        try:
+            byte_range = ImageArchive.ParseRange(request.headers.get("Range"), archive.size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{archive.size}"
+            return app.response_class(status=416, headers=headers)
+
+    if byte_range is None:
+        headers["Content-Length"] = str(archive.size)
+        return app.response_class(archive.stream(), mimetype=ImageArchive.FORMATS["tar"], headers=headers), 200
+
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{archive.size}"
+    return app.response_class(archive.stream(start, end), mimetype=ImageArchive.FORMATS["tar"], headers=headers, status=206)
 
 
 @app.route("/get-image-count", methods=["GET"])
 @token_required
 def get_image_count():
-    uploads_dir = "./uploads"
-    image_files = [f for f in os.listdir(uploads_dir) if f.lower().endswith(".png")]
-
-    return len(image_files)
+    device_id = request.args.get("deviceId")
+    return jsonify(success=True, data=ImageStore.GetCatalog().count(deviceId=device_id)), 200
 
 
 '''
@@ -266,17 +676,36 @@ List of actions:
     -update: Sends data about the device
 '''
 
-actions = []
-
+# Get the actions queued for the Beacon device
+#   -- 'deviceId': the device's own actions are returned besides the shared ones
+#   -- 'wait': seconds to wait for an action if there is none yet (long polling)
+#   -- 'ack=1': the actions are delivered again until they are acknowledged on /ack-actions
 @app.route("/get-actions", methods=["GET"])
 @token_required
 def get_actions():
-    global actions
+    device_id = request.args.get('deviceId')
+    wait = request.args.get('wait', default = 0, type = float)
+    ack = request.args.get('ack', default = "0") in ("1", "true")
+
+    actions = ActionQueue.Get().take(deviceId=device_id, wait=wait, ack=ack)
 
-    actions_temp = actions
-    actions = []
-    print("Actions taken")
-    return jsonify(success=True, data=actions_temp)
+    log.debug("Actions taken by device ID: %s", device_id)
+    return jsonify(success=True, data=[action["action"] for action in actions], actions=actions)
+
+
+# Acknowledge the delivered actions
+#   -- requires 'ids' (list of action IDs) in the request body
+@app.route("/ack-actions", methods=["POST"])
+@token_required
+def ack_actions():
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+
+    try:
+        removed = ActionQueue.Get().ack(ids)
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
+    return jsonify(success=True, message=f"{removed} actions acknowledged."), 200
 
 #######################################
 #
@@ -284,17 +713,18 @@ def get_actions():
 #
 #######################################
 
+# Queue an action
+#   -- requires 'action', optionally 'deviceId' (without it the action goes to the shared queue)
 @app.route("/set-actions", methods=["POST"])
 @token_required
 def set_actions():
-    global actions
-
     action_name = request.args.get('action', default = "", type = str)
+    device_id = request.args.get('deviceId')
 
-    actions.append(action_name)
+    action_id = ActionQueue.Get().push(action_name, deviceId=device_id)
 
-    print(f"Action {action_name} is set")
-    return jsonify(success=True, message=f"Action {action_name} is set"), 200
+    log.info("Action %s is set for device ID: %s", action_name, device_id)
+    return jsonify(success=True, message=f"Action {action_name} is set", id=action_id), 200
 
 
 # Send message from the Beacon device
@@ -307,52 +737,65 @@ def send_message():
     if not 'message' in data or not 'deviceId' in data:
         return jsonify(success=False, message="Message text and Device ID are required."), 400
 
-    db = TinyDB("database/messages.json")
-    db.insert({"message": data["message"], "deviceId": data["deviceId"], "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()})
+    MessageStore.Get().insert(data["deviceId"], data["message"], datetime.datetime.now(datetime.timezone.utc).isoformat())
 
     DeviceManager.UpdateBeaconData(data["deviceId"])
+    Metrics.INGESTED_ITEMS.inc(data["deviceId"], "message")
 
-    print(f"Send message by user: {request.user} with message: {data['message']}")
+    log.debug("Send message by user: %s", request.user)
     return jsonify(success=True, message=f"Message sent successfully."), 200
 
 
 # Send image from the Beacon device
+#   -- 'multipart/form-data' with an 'image' file field, or a raw 'image/png' body: streamed to disk in chunks
+#   -- otherwise the legacy JSON body with the base64 encoded 'image'
+#   -- 'deviceId' can be given as form field, query parameter or JSON field
 @app.route("/send-image", methods=["POST"])
 @token_required
 def send_image():
-    data = request.json or {}
-    image = data.get('image')
-    if not image:
-        return jsonify(success=False, message="Image and Device ID are required."), 400
+    try:
+        if request.mimetype == "multipart/form-data":
+            upload = request.files.get('image')
+            if upload is None:
+                return jsonify(success=False, message="Image file is required."), 400
 
+            device_id = request.form.get('deviceId') or request.args.get('deviceId')
+            image_info = ImageStore.SaveImageStream(upload.stream, device_id)
 
-    try:
-        # If the image is in base64 format, e.g. "data:image/png;base64,...."
-        if "," in image:
-            header, image = image.split(",", 1)
+        elif request.mimetype in ("image/png", "application/octet-stream"):
+            if not request.content_length:
+                return jsonify(success=False, message="Image body is required."), 400
 
-        # Decoding
-        image_bytes = base64.b64decode(image)
+            device_id = request.args.get('deviceId')
+            image_info = ImageStore.SaveImageStream(request.stream, device_id)
 
-        # Save location (e.g. "uploads" folder)
-        os.makedirs("uploads", exist_ok=True)
-        filename = f"uploads/{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}.png"
+        else:
+            data = request.json or {}
+            image = data.get('image')
+            if not image:
+                return jsonify(success=False, message="Image and Device ID are required."), 400
 
-        with open(filename, "wb") as f:
-            f.write(image_bytes)
+            # If the image is in base64 format, e.g. "data:image/png;base64,...."
+            if "," in image:
+                header, image = image.split(",", 1)
 
-        
-        print(f"Send arrived from user: {request.user}, saved to: {filename}")
-        return jsonify(success=True, message=f"Picture uploaded successfully: {filename}"), 200
+            # Decoding
+            image_bytes = base64.b64decode(image)
+            image_info = ImageStore.SaveImageBytes(image_bytes, data.get('deviceId'))
 
-    except Exception as e:
-        return jsonify(success=False, message=f"Error occurred: {e}"), 500
+        ImageVariants.Schedule(image_info)
+        Metrics.INGESTED_ITEMS.inc(image_info.deviceId, "image")
 
+        log.info("Image arrived from user: %s, saved to: %s", request.user, image_info.path)
+        return jsonify(success=True, message=f"Picture uploaded successfully: {image_info.path}"), 200
 
+    except Exception as e:
+        return jsonify(success=False, message=f"Error occurred: {e}"), 500
 
 
 # Send info from the Beacon device
 #   -- requires 'deviceId' and at least one of 'batteryLevel', 'controllerBattery', 'coreTemp', or 'houseTemp' in the request body
+#   -- the values must be numbers (or numeric strings), otherwise nothing is stored (400)
 @app.route("/send-info", methods=["POST"])
 @token_required
 def send_info():
@@ -362,19 +805,92 @@ def send_info():
         return jsonify(success=False, message="Device ID is missing"), 400
 
     deviceId = data.get('deviceId')
-    batteryLevel = data.get('batteryLevel') or None
-    coreTemp = data.get('coreTemp') or None
-    houseTemp = data.get('houseTemp') or None
-    controllerBattery = data.get('controllerBattery') or None
-    latency = data.get('latency') or None
+    try:
+        fields = DeviceManager.ParseInfo(data)
+    except ValueError as e:
+        return jsonify(success=False, message=str(e)), 400
 
-    DeviceManager.UpdateBeaconData(deviceId, batteryLevel=batteryLevel, controllerBattery=controllerBattery, coreTemp=coreTemp, houseTemp=houseTemp, latency=latency)
+    DeviceManager.UpdateBeaconData(deviceId, **fields)
+    Metrics.INGESTED_ITEMS.inc(deviceId, "info")
 
-    print(f"Beacon data is updated for device ID: {deviceId}.")
+    log.debug("Beacon data is updated for device ID: %s.", deviceId)
 
     return jsonify(success=True, message=f"Device {deviceId} updated successfully."), 200
 
 
+# Send many readings and messages at once, e.g. the ones a Beacon buffered while it was offline
+#   -- requires 'items': a list of {"type": "info", <telemetry fields>} and {"type": "message", "message": ...} objects
+#   -- every item may have its own 'deviceId' (default: the body's 'deviceId') and 'timestamp' (default: now)
+#   -- the items are stored in bulk; if any is invalid, nothing is stored and the invalid ones are returned
+#      in 'rejected' with their index (400)
+@app.route("/ingest", methods=["POST"])
+@token_required
+def ingest():
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list):
+        return jsonify(success=False, message="'items' list is required."), 400
+    if len(items) > MAX_INGEST_ITEMS:
+        return jsonify(success=False, message=f"At most {MAX_INGEST_ITEMS} items can be sent at once."), 413
+
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    messages = []
+    updates = []
+    ingested = []
+    rejected = []
+
+    # The whole batch is checked before anything is written: a rejected batch leaves no trace,
+    # so the Beacon can drop the rejected items and send the rest again without duplicates
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            rejected.append({"index": index, "message": "Item must be an object."})
+            continue
+
+        deviceId = item.get('deviceId') or data.get('deviceId')
+        if not deviceId:
+            rejected.append({"index": index, "message": "Device ID is missing"})
+            continue
+
+        try:
+            timestamp = TimeSeries.ParseTime(item.get('timestamp'))
+            isoTimestamp = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat() if timestamp is not None else now
+        except (TypeError, ValueError, OverflowError, OSError):
+            rejected.append({"index": index, "message": f"Invalid timestamp: {item.get('timestamp')}"})
+            continue
+
+        itemType = item.get('type', 'info')
+        if itemType == "message":
+            if 'message' not in item:
+                rejected.append({"index": index, "message": "Message text is required."})
+                continue
+            messages.append({"deviceId": deviceId, "message": item['message'], "timestamp": isoTimestamp})
+            updates.append({"deviceId": deviceId})
+            ingested.append((deviceId, "message"))
+        elif itemType == "info":
+            try:
+                fields = DeviceManager.ParseInfo(item)
+            except ValueError as e:
+                rejected.append({"index": index, "message": str(e)})
+                continue
+            updates.append({"deviceId": deviceId, "timestamp": timestamp, **fields})
+            ingested.append((deviceId, "info"))
+        else:
+            rejected.append({"index": index, "message": f"Unknown item type: {itemType}"})
+
+    if rejected:
+        return jsonify(success=False, message=f"{len(rejected)} of {len(items)} items are invalid, nothing was stored.", rejected=rejected), 400
+
+    if messages:
+        MessageStore.Get().insert_multiple(messages)
+    devices = DeviceManager.UpdateBeaconDataBatch(updates)
+
+    for deviceId, itemType in ingested:
+        Metrics.INGESTED_ITEMS.inc(deviceId, itemType)
+
+    log.info("Ingested %d items from user: %s for %d devices.", len(items), request.user, len(devices))
+    return jsonify(success=True, accepted=len(items), rejected=[], devices=devices), 200
+
+
 #######################################
 #
 #   Beacon Configuration Endpoints (client side)
@@ -387,8 +903,8 @@ def send_info():
 @token_required
 def configure_camera():
     data = request.json or {}
-    DeviceManager.UpdateCameraConfiguration(data)
-    print(f"Configure camera by: {request.user}: {data}")
+    DeviceManager.UpdateCameraConfiguration(data, deviceId=request.args.get('deviceId') or data.get('deviceId'))
+    log.info("Configure camera by: %s", request.user, extra={"config": data})
     return jsonify(success=True, message=f"Camera configured successfully."), 200
 
 
@@ -398,7 +914,7 @@ def configure_camera():
 def configure_beacon():
     data = request.json or {}
     config = data.get('config')
-    print(f"Configure beacon by user: {request.user} with config: {config}")
+    log.info("Configure beacon by user: %s", request.user, extra={"config": config})
     return jsonify(success=True, message=f"Hello {request.user}, beacon configured successfully."), 200
 
 
@@ -413,7 +929,7 @@ def configure_beacon():
 @app.route("/get-beacon-configuration", methods=["GET"])
 @token_required
 def get_beacon_configuration():
-    print(f"Get beacon configuration by user: {request.user}")
+    log.debug("Get beacon configuration by user: %s", request.user)
     return jsonify(success=True, message=f"Hello {request.user}, get beacon configuration successful."), 200
 
 
@@ -421,10 +937,11 @@ def get_beacon_configuration():
 @app.route("/get-camera-configuration", methods=["GET"])
 @token_required
 def get_camera_configuration():
-    with open("database/camera-config.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    print(f"Camera configuration by: {request.user}")
-    return jsonify(success=True, data=data), 200
+    device_id = request.args.get('deviceId')
+    config = ConfigService.Get().get(device_id)
+
+    log.debug("Camera configuration by: %s", request.user)
+    return conditional_response(config.etag, config.last_modified, lambda: jsonify(success=True, data=config.data))
 
 
 #######################################
@@ -437,42 +954,111 @@ def get_camera_configuration():
 @token_required
 def last_image():
     image_index = request.args.get('index', default = 1, type = int)
-    uploads_dir = "./uploads"
-
-    if not os.path.exists(uploads_dir):
-        return jsonify(success=False, message="Uploads directory not found"), 404
+    device_id = request.args.get('deviceId')
 
-    # Összegyűjtjük az összes PNG fájlt
-    image_files = [f for f in os.listdir(uploads_dir) if f.lower().endswith(".png")]
-    image_files.sort()
+    image = ImageStore.GetCatalog().get(image_index, deviceId=device_id)
 
-    if image_index > len(image_files):
+    if image is None:
         return jsonify(success=False, message=f"Image with index {image_index} not found"), 404
 
-    image_path = os.path.join(uploads_dir, image_files[-image_index])
-    print("Sending image: "+image_path)
-    return send_file(image_path, mimetype='image/png')
+    log.debug("Sending image: %s", image.path)
+    return send_image_variant(image)
 
 @app.route("/get-commands", methods=["GET"])
 @token_required
 def get_commands():
-    cmd = ""
-
-    with open('./database/commands.txt', 'r') as commands:
-        cmd = commands.read()
+    def build():
+        with open('./database/commands.txt', 'r') as commands:
+            return app.response_class(commands.read(), mimetype="text/html")
 
-    return cmd
+    return conditional_file_response('./database/commands.txt', build)
 
 
 import os
 
-if __name__ == "__main__":
-    with open(os.path.join(os.getcwd(),"database/server-config.json"), "r", encoding="utf-8") as f:
-        data = json.load(f)
+#######################################
+#
+#   App factory
+#
+#######################################
+
+CONFIG_PATH = os.path.join("database", "server-config.json")
+
+_configured = False
+_configureLock = threading.Lock()
+
+
+# Read the server configuration ('BEACON_CONFIG' environment variable or database/server-config.json)
+def load_config(path=None):
+    path = path or os.environ.get("BEACON_CONFIG") or os.path.join(os.getcwd(), CONFIG_PATH)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Configure the app and the stores, caches and background workers behind it
+#   -- the stores are process-wide singletons, so the app is set up once per process; later calls return it as it is
+#   -- used by 'python app.py' (development server), serve.py (gevent) and gunicorn ("app:create_app()")
+#   -- if a step fails, the app is not marked as configured, so the next call runs every step again
+def create_app(config=None):
+    with _configureLock:
+        if not _configured:
+            _configure(config)
+    return app
+
+
+def _configure(config):
+    global _configured
+
+    data = config if config is not None else load_config()
+
+    # Background log writer; the log file is written besides the console if 'log_to_file' is set
+    Logs.Configure(data.get('logging'), logFile=data['server']['log_file'] if data['server'].get('log_to_file', False) else None)
 
-    if data['server'].get('log_to_file', False):
-        logging.basicConfig(filename=data['server']['log_file'], level=logging.INFO)
+    metrics = data.get('metrics', {})
+    Metrics.Configure(enabled=metrics.get('enabled'), token=metrics.get('token'))
+    if Metrics.Enabled() and Metrics.Token() is None:
+        log.info("/metrics is not served: set the 'token' of the metrics configuration")
+
+    storage = data.get('storage', {})
+    Database.Configure(flushInterval=storage.get('flush_interval'), maxPendingWrites=storage.get('max_pending_writes'))
+    MessageStore.Configure(backend=storage.get('messages_backend'), sqlitePath=storage.get('messages_db'))
+
+    audio = data.get('audio', {})
+    AudioRelay.Configure(record=audio.get('record'), recordingsDir=audio.get('recordings_dir'))
+
+    signaling = data.get('signaling', {})
+    Signaling.Configure(broker=signaling.get('broker'), address=signaling.get('broker_address'))
+
+    telemetry = data.get('telemetry', {})
+    TimeSeries.Configure(rawRetentionDays=telemetry.get('raw_retention_days'), rollupStep=telemetry.get('rollup_step'), rollupRetentionDays=telemetry.get('rollup_retention_days'))
+    TimeSeries.StartCompactor(telemetry.get('compact_interval'))
+
+    images = data.get('images', {})
+    ImageStore.GetCatalog()
+    ImageStore.StartWatcher(images.get('watch_interval'))
+
+    # Loaded now instead of on the first request
+    DeviceManager.GetRegistry()
+    ActionQueue.Get()
 
     app.config['SECRET_KEY'] = data['server']['secret_key']  # Reading the secret key from the config file
-    logging.info(msg=data['server']['secret_key'])
+    app.config['BEACON_CONFIG'] = data
+    _configured = True
+    log.info("Server configured (messages: %s, signaling: %s)", storage.get('messages_backend', 'tinydb'), signaling.get('broker', 'inprocess'))
+
+
+# Release the process-wide resources: the pending writes are flushed, the workers stopped
+def shutdown_app():
+    DeviceManager.GetRegistry().flush()
+    ImageStore.StopWatcher()
+    ImageVariants.Shutdown()
+    if AudioRelay.Available():
+        AudioRelay.Shutdown()
+    Database.FlushAll()
+
+
+# Development server; use serve.py or gunicorn (gunicorn.conf.py) in production
+if __name__ == "__main__":
+    data = load_config()
+    create_app(data)
     app.run(host=data['server']['host'], port=data['server']['port'], debug=data['server']['debug'], threaded=True)
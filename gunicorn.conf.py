@@ -0,0 +1,50 @@
+"""
+gunicorn configuration of the Beacon server.
+
+    gunicorn -c gunicorn.conf.py "app:create_app()"
+
+The values come from the "server" and "production" sections of the server
+configuration; the BEACON_* environment variables override them.
+
+Workers: the server keeps process-wide state in memory (action queue, device
+registry, image catalog, caches) on top of TinyDB files that allow only one writer
+process. Keep one gevent worker, which serves up to 'worker_connections'
+concurrent connections; only raise BEACON_WORKERS when the signaling broker is
+shared ("signaling": {"broker": "socket"}) and the JSON stores are not written.
+"""
+import json
+import os
+
+_configPath = os.environ.get("BEACON_CONFIG", os.path.join("database", "server-config.json"))
+with open(_configPath, "r", encoding="utf-8") as _f:
+    _config = json.load(_f)
+_server = _config.get("server", {})
+_production = _config.get("production", {})
+
+bind = os.environ.get("BEACON_BIND", f"{_server.get('host', '0.0.0.0')}:{_server.get('port', 5000)}")
+
+# One process, many greenlets (see above)
+workers = int(os.environ.get("BEACON_WORKERS", _production.get("workers", 1)))
+worker_class = "gevent"
+worker_connections = int(os.environ.get("BEACON_MAX_CONNECTIONS", _production.get("max_connections", 1000)))
+
+# Seconds an idle keep-alive connection stays open; beacons on cellular links reuse it
+keepalive = int(os.environ.get("BEACON_KEEPALIVE", _production.get("keepalive", 75)))
+
+# A worker silent for this long is restarted; long polls and uploads must fit in it
+timeout = int(os.environ.get("BEACON_TIMEOUT", _production.get("timeout", 120)))
+
+# Seconds the running requests get to finish on SIGTERM
+graceful_timeout = int(os.environ.get("BEACON_GRACEFUL_TIMEOUT", _production.get("graceful_timeout", 30)))
+
+# The app is created in the worker, after the fork: threads and file handles are not shared
+preload_app = False
+
+accesslog = None
+errorlog = "-"
+
+
+def worker_exit(server, worker):
+    # Flush the stores of the exiting worker
+    import app
+    app.shutdown_app()
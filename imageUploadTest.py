@@ -9,6 +9,8 @@ images = [
 ]
 
 
-for img in images:
-    input("Press enter to send the image...")
-    BeaconShell.SendImage(username="admin", password="Titok123", imagePath=img)
+with BeaconShell.BeaconClient("admin", "Titok123") as client:
+    for img in images:
+        input("Press enter to send the image...")
+        resp = client.send_image(img, stream=True)
+        print(resp.status_code, resp.json())
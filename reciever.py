@@ -1,56 +1,135 @@
+import argparse
 import asyncio
 import json
-import sounddevice as sd
-import numpy as np
+import time
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.contrib.media import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from AudioPlayback import AudioPlayer
 from aiohttp import ClientSession, WSMsgType, TCPConnector
 
+SERVER_URL = "https://localhost:5000"
 SIGNAL_URL = "wss://localhost:5000/ws"  # ha SSL, akkor wss://
+ROOM = "Beacon_1"
 SELF_ID = "python-listener"
-TARGET_ID = "python-sender"
 
-async def main():
+
+async def login(session, username, password):
+    async with session.post(f"{SERVER_URL}/login", json={"username": username, "password": password}) as resp:
+        data = await resp.json()
+        if resp.status != 200:
+            raise RuntimeError(f"Login failed: {data}")
+        return data["access_token"]
+
+
+async def listen_via_relay(session, token, pc, args):
+    # A hang a szerver relay-én keresztül érkezik, nem közvetlenül a beacontól
+    pc.addTransceiver("audio", direction="recvonly")
+    offer = await pc.createOffer()
+    await pc.setLocalDescription(offer)
+
+    async with session.post(f"{SERVER_URL}/audio/listen", headers={"Authorization": f"Bearer {token}"}, json={
+        "deviceId": args.room,
+        "sdp": pc.localDescription.sdp,
+        "type": pc.localDescription.type
+    }) as resp:
+        data = await resp.json()
+        if resp.status != 200:
+            raise RuntimeError(f"Listen failed: {data}")
+
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=data["sdp"], type=data["type"]))
+    print("[RELAY] listening via the server")
+
+    closed = asyncio.Event()
+
+    @pc.on("connectionstatechange")
+    def on_state():
+        print("[PC] state:", pc.connectionState)
+        if pc.connectionState in ("failed", "closed"):
+            closed.set()
+
+    await closed.wait()
+
+
+async def main(args):
+    # Egy állandóan nyitott kimenet, az Opus dekóder 48 kHz-es sztereó hangjához
+    with AudioPlayer(sampleRate=args.samplerate, device=args.output_device) as player:
+        await run(args, player)
+
+
+async def run(args, player):
     connector = TCPConnector(ssl=False)
     async with ClientSession(connector=connector) as session:
-        async with session.ws_connect(SIGNAL_URL) as ws:
-            await ws.send_str(SELF_ID)
-            print("[WS] connected")
+        token = await login(session, args.username, args.password)
 
-            pc = RTCPeerConnection()
+        pc = RTCPeerConnection()
 
-            @pc.on("track")
-            async def on_track(track: MediaStreamTrack):
-                print("[PC] got track:", track.kind)
-                if track.kind != "audio":
-                    return
+        @pc.on("track")
+        async def on_track(track: MediaStreamTrack):
+            print("[PC] got track:", track.kind)
+            if track.kind != "audio":
+                return
 
-                # valós idejű lejátszás
-                async def play_audio():
+            # valós idejű lejátszás: a frame-ek a ring bufferbe kerülnek, a hangkártya
+            # saját szálon olvassa őket, így az event loop sosem blokkol
+            async def play_audio():
+                lastStats = time.monotonic()
+                try:
                     while True:
                         frame = await track.recv()
-                        # PCM float32 tömb
-                        samples = frame.to_ndarray()
-                        # sounddevice: channel-ok T, samplerate
-                        sd.play(samples.T, samplerate=frame.sample_rate, blocking=True)
+                        player.write_frame(frame)
+
+                        if args.stats and time.monotonic() - lastStats >= args.stats:
+                            lastStats = time.monotonic()
+                            print("[AUDIO]", player.stats())
+                except MediaStreamError:
+                    print("[AUDIO] track ended", player.stats())
 
-                asyncio.create_task(play_audio())
+            asyncio.create_task(play_audio())
+
+        if args.relay:
+            await listen_via_relay(session, token, pc, args)
+            return
+
+        async with session.ws_connect(SIGNAL_URL) as ws:
+            await ws.send_str(json.dumps({"room": args.room, "role": "listener", "peerId": args.peer_id, "token": token}))
+            print("[WS] connected")
 
             async for msg in ws:
                 if msg.type != WSMsgType.TEXT:
                     continue
-                data = json.loads(msg.data)
-                if data.get("type") == "offer" and data.get("target") == SELF_ID:
+
+                # Szerver események (JSON), pl. peer-joined / peer-left
+                if msg.data.startswith("{"):
+                    event = json.loads(msg.data)
+                    if event.get("type") == "error":
+                        print(f"[SIG] error: {event.get('message')}")
+                    continue
+
+                # Továbbított üzenetek: "<küldő>\n<payload>"
+                sender_id, _, payload = msg.data.partition("\n")
+                data = json.loads(payload)
+                if data.get("type") == "offer":
                     offer = RTCSessionDescription(sdp=data["sdp"], type="offer")
                     await pc.setRemoteDescription(offer)
                     answer = await pc.createAnswer()
                     await pc.setLocalDescription(answer)
-                    await ws.send_str(json.dumps({
+                    await ws.send_str(sender_id + "\n" + json.dumps({
                         "type": "answer",
-                        "from": SELF_ID,
-                        "target": TARGET_ID,
                         "sdp": pc.localDescription.sdp
                     }))
-                    print("[SIG] answer sent")
+                    print(f"[SIG] answer sent to {sender_id}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live listener of a beacon microphone")
+    parser.add_argument("--room", default=ROOM, help="Room of the beacon (usually its device ID)")
+    parser.add_argument("--peer-id", default=SELF_ID)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--relay", action="store_true", help="Listen through the server's audio relay")
+    parser.add_argument("--samplerate", type=int, default=48000, help="Sample rate of the output device")
+    parser.add_argument("--output-device", default=None, help="sounddevice output device")
+    parser.add_argument("--stats", type=float, default=0, help="Print the playback metrics every N seconds")
 
-asyncio.run(main())
+    asyncio.run(main(parser.parse_args()))
@@ -1,52 +1,116 @@
+import argparse
 import asyncio
 import json
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.contrib.media import MediaRecorder
 from aiohttp import ClientSession, WSMsgType, TCPConnector
 
+SERVER_URL = "https://localhost:5000"
 SIGNAL_URL = "wss://localhost:5000/ws"  # ha SSL, akkor wss://
-SELF_ID = "python-listener"
-TARGET_ID = "python-sender"
+ROOM = "Beacon_1"
+SELF_ID = "python-recorder"
 
-async def main():
+
+async def login(session, username, password):
+    async with session.post(f"{SERVER_URL}/login", json={"username": username, "password": password}) as resp:
+        data = await resp.json()
+        if resp.status != 200:
+            raise RuntimeError(f"Login failed: {data}")
+        return data["access_token"]
+
+
+async def listen_via_relay(session, token, pc, args):
+    # A hang a szerver relay-én keresztül érkezik, nem közvetlenül a beacontól
+    pc.addTransceiver("audio", direction="recvonly")
+    offer = await pc.createOffer()
+    await pc.setLocalDescription(offer)
+
+    async with session.post(f"{SERVER_URL}/audio/listen", headers={"Authorization": f"Bearer {token}"}, json={
+        "deviceId": args.room,
+        "sdp": pc.localDescription.sdp,
+        "type": pc.localDescription.type
+    }) as resp:
+        data = await resp.json()
+        if resp.status != 200:
+            raise RuntimeError(f"Listen failed: {data}")
+
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=data["sdp"], type=data["type"]))
+    print("[RELAY] listening via the server")
+
+    closed = asyncio.Event()
+
+    @pc.on("connectionstatechange")
+    def on_state():
+        print("[PC] state:", pc.connectionState)
+        if pc.connectionState in ("failed", "closed"):
+            closed.set()
+
+    await closed.wait()
+
+
+async def main(args):
     connector = TCPConnector(ssl=False)
     async with ClientSession(connector=connector) as session:
-        async with session.ws_connect(SIGNAL_URL) as ws:
-            # Peer ID elküldése
-            await ws.send_str(SELF_ID)
-            print("[WS] connected")
+        token = await login(session, args.username, args.password)
+
+        pc = RTCPeerConnection()
+        # Hangot WAV fájlba menti
+        recorder = MediaRecorder(args.output)
+
+        @pc.on("track")
+        async def on_track(track):
+            print("[PC] got track:", track.kind)
+            if track.kind == "audio":
+                recorder.addTrack(track)
+                await recorder.start()
 
-            pc = RTCPeerConnection()
-            # Hangot WAV fájlba menti
-            recorder = MediaRecorder("output.wav")
+        if args.relay:
+            await listen_via_relay(session, token, pc, args)
+            await recorder.stop()
+            return
 
-            @pc.on("track")
-            async def on_track(track):
-                print("[PC] got track:", track.kind)
-                if track.kind == "audio":
-                    recorder.addTrack(track)
-                    await recorder.start()
+        async with session.ws_connect(SIGNAL_URL) as ws:
+            # Belépés a beacon szobájába
+            await ws.send_str(json.dumps({"room": args.room, "role": "listener", "peerId": args.peer_id, "token": token}))
+            print("[WS] connected")
 
             # WebSocket üzenetek kezelése
             async for msg in ws:
                 if msg.type != WSMsgType.TEXT:
                     continue
-                data = json.loads(msg.data)
+
+                # Szerver események (JSON), pl. peer-joined / peer-left
+                if msg.data.startswith("{"):
+                    continue
+
+                # Továbbított üzenetek: "<küldő>\n<payload>"
+                sender_id, _, payload = msg.data.partition("\n")
+                data = json.loads(payload)
 
                 # Ha offer érkezik
-                if data.get("type") == "offer" and data.get("target") == SELF_ID:
+                if data.get("type") == "offer":
                     offer = RTCSessionDescription(sdp=data["sdp"], type=data["type"])
                     await pc.setRemoteDescription(offer)
 
                     answer = await pc.createAnswer()
                     await pc.setLocalDescription(answer)
 
-                    await ws.send_str(json.dumps({
+                    await ws.send_str(sender_id + "\n" + json.dumps({
                         "type": "answer",
-                        "from": SELF_ID,
-                        "target": TARGET_ID,
                         "sdp": pc.localDescription.sdp
                     }))
-                    print("[SIG] answer sent")
+                    print(f"[SIG] answer sent to {sender_id}")
+
+            await recorder.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recorder of a beacon microphone")
+    parser.add_argument("--room", default=ROOM, help="Room of the beacon (usually its device ID)")
+    parser.add_argument("--peer-id", default=SELF_ID)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--relay", action="store_true", help="Listen through the server's audio relay")
+    parser.add_argument("--output", default="output.wav")
 
-asyncio.run(main())
+    asyncio.run(main(parser.parse_args()))
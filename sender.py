@@ -1,59 +1,141 @@
+import argparse
 import asyncio
 import json
 from aiortc import RTCPeerConnection, RTCSessionDescription
-from aiortc.contrib.media import MediaPlayer
+from aiortc.contrib.media import MediaPlayer, MediaRelay
 from aiohttp import ClientSession, WSMsgType, TCPConnector
 
-SIGNAL_URL = "wss://127.0.0.1:5000/ws"  # Szerver IP/port
+SERVER_URL = "https://127.0.0.1:5000"  # Szerver IP/port
+SIGNAL_URL = "wss://127.0.0.1:5000/ws"
+ROOM = "Beacon_1"
 SELF_ID = "python-sender"
-TARGET_ID = "python-listener"
 
-async def main():
+# Ellenőrizd a mikrofon nevét a "Sound settings -> Recording devices"-n
+MIC_DEVICE = 'audio=Mikrofon (C-Media(R) Audio)'
+
+
+async def login(session, username, password):
+    async with session.post(f"{SERVER_URL}/login", json={"username": username, "password": password}) as resp:
+        data = await resp.json()
+        if resp.status != 200:
+            raise RuntimeError(f"Login failed: {data}")
+        return data["access_token"]
+
+
+async def publish_to_relay(session, token, args):
+    # Egyetlen feltöltött hang a szervernek, a hallgatókat a szerver szolgálja ki
+    player = MediaPlayer(args.device, format='dshow')
+    pc = RTCPeerConnection()
+    pc.addTrack(player.audio)
+
+    offer = await pc.createOffer()
+    await pc.setLocalDescription(offer)
+
+    async with session.post(f"{SERVER_URL}/audio/publish", headers={"Authorization": f"Bearer {token}"}, json={
+        "deviceId": args.room,
+        "sdp": pc.localDescription.sdp,
+        "type": pc.localDescription.type,
+        "record": args.record
+    }) as resp:
+        data = await resp.json()
+        if resp.status != 200:
+            raise RuntimeError(f"Publish failed: {data}")
+
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=data["sdp"], type=data["type"]))
+    print("[RELAY] publishing to the server")
+
+    # Amíg a kapcsolat él
+    closed = asyncio.Event()
+
+    @pc.on("connectionstatechange")
+    def on_state():
+        print("[PC] state:", pc.connectionState)
+        if pc.connectionState in ("failed", "closed"):
+            closed.set()
+
+    await closed.wait()
+
+
+async def main(args):
     connector = TCPConnector(ssl=False)
     async with ClientSession(connector=connector) as session:
+        token = await login(session, args.username, args.password)
+
+        if args.relay:
+            await publish_to_relay(session, token, args)
+            return
+
         async with session.ws_connect(SIGNAL_URL) as ws:
-            await ws.send_str(SELF_ID)
+            await ws.send_str(json.dumps({"room": args.room, "role": "sender", "peerId": args.peer_id, "token": token}))
             print("[WS] connected")
 
-            pc = RTCPeerConnection()
-
             # --- Windows mikrofon capture ---
-            # Ellenőrizd a mikrofon nevét a "Sound settings -> Recording devices"-n
-            player = MediaPlayer(
-                'audio=Mikrofon (C-Media(R) Audio)',
-                format='dshow'
-            )
-            pc.addTrack(player.audio)
+            player = MediaPlayer(args.device, format='dshow')
+            # Egy mikrofon, minden hallgatónak külön peer connection
+            relay = MediaRelay()
+            pcs = {}
+
+            async def offer_to(listener_id):
+                if listener_id in pcs:
+                    await pcs.pop(listener_id).close()
+
+                pc = RTCPeerConnection()
+                pcs[listener_id] = pc
+                pc.addTrack(relay.subscribe(player.audio))
 
-            # --- Signaling ---
-            async def signaling():
                 # Offer készítése
                 offer = await pc.createOffer()
                 await pc.setLocalDescription(offer)
 
-                # Offer küldése a signaling szervernek
-                await ws.send_str(json.dumps({
+                # Offer küldése a hallgatónak
+                await ws.send_str(listener_id + "\n" + json.dumps({
                     "type": "offer",
-                    "from": SELF_ID,
-                    "target": TARGET_ID,
                     "sdp": pc.localDescription.sdp
                 }))
-                print("[SIG] offer sent")
+                print(f"[SIG] offer sent to {listener_id}")
+
+            # --- Signaling ---
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+
+                # Szerver események: JSON objektumok
+                if msg.data.startswith("{"):
+                    event = json.loads(msg.data)
+                    if event.get("type") in ("peer-joined", "peer-present") and event.get("role") == "listener":
+                        await offer_to(event["peerId"])
+                    elif event.get("type") == "peer-left" and event["peerId"] in pcs:
+                        await pcs.pop(event["peerId"]).close()
+                        print(f"[SIG] {event['peerId']} left")
+                    elif event.get("type") == "error":
+                        print(f"[SIG] error: {event.get('message')}")
+                    continue
+
+                # Továbbított üzenetek: "<küldő>\n<payload>"
+                sender_id, _, payload = msg.data.partition("\n")
+                data = json.loads(payload)
+
+                # Answer fogadása
+                if data.get("type") == "answer" and sender_id in pcs:
+                    answer = RTCSessionDescription(
+                        sdp=data["sdp"],
+                        type=data["type"]
+                    )
+                    await pcs[sender_id].setRemoteDescription(answer)
+                    print(f"[SIG] answer received from {sender_id}")
 
-                async for msg in ws:
-                    if msg.type != WSMsgType.TEXT:
-                        continue
-                    data = json.loads(msg.data)
+            for pc in pcs.values():
+                await pc.close()
 
-                    # Answer fogadása
-                    if data.get("type") == "answer" and data.get("target") == SELF_ID:
-                        answer = RTCSessionDescription(
-                            sdp=data["sdp"],
-                            type=data["type"]
-                        )
-                        await pc.setRemoteDescription(answer)
-                        print("[SIG] answer received")
 
-            await signaling()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Beacon microphone sender")
+    parser.add_argument("--room", default=ROOM, help="Room of the beacon (usually its device ID)")
+    parser.add_argument("--peer-id", default=SELF_ID)
+    parser.add_argument("--username", default="beacon")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--device", default=MIC_DEVICE, help="dshow microphone name")
+    parser.add_argument("--relay", action="store_true", help="Publish once to the server's audio relay instead of one connection per listener")
+    parser.add_argument("--record", action="store_true", help="Record the audio on the server (with --relay)")
 
-asyncio.run(main())
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,64 @@
+"""
+Production server: the app on gevent's WSGI server.
+
+Every connection is served by a greenlet instead of an OS thread, so thousands of
+Beacons can keep their long polls, push channels and keep-alive connections open
+at the same time. No reloader or debugger runs.
+
+    python serve.py [--host 0.0.0.0] [--port 5000] [--max-connections 1000]
+
+The defaults come from the "server" and "production" sections of the server
+configuration. SIGTERM / SIGINT stop accepting connections, give the running
+requests 'graceful_timeout' seconds to finish, and flush the stores before exit.
+
+To run several worker processes, use gunicorn instead (see gunicorn.conf.py).
+"""
+# Must run before anything imports socket, ssl or threading
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import logging
+import signal
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+import app as server
+
+log = logging.getLogger("serve")
+
+
+def main():
+    config = server.load_config()
+    production = config.get('production', {})
+
+    parser = argparse.ArgumentParser(description="Beacon server (gevent)")
+    parser.add_argument("--host", default=config['server']['host'])
+    parser.add_argument("--port", type=int, default=config['server']['port'])
+    parser.add_argument("--max-connections", type=int, default=production.get('max_connections', 1000),
+                        help="Connections served at the same time; the rest wait in the listen backlog")
+    parser.add_argument("--graceful-timeout", type=float, default=production.get('graceful_timeout', 30),
+                        help="Seconds the running requests get to finish on shutdown")
+    args = parser.parse_args()
+
+    application = server.create_app(config)
+    http = WSGIServer((args.host, args.port), application, spawn=Pool(args.max_connections), log=None)
+
+    def stop():
+        log.info("Shutting down, waiting up to %s s for the running requests", args.graceful_timeout)
+        http.stop(timeout=args.graceful_timeout)
+
+    gevent.signal_handler(signal.SIGTERM, stop)
+    gevent.signal_handler(signal.SIGINT, stop)
+
+    log.info("Listening on %s:%s (max %d connections)", args.host, args.port, args.max_connections)
+    try:
+        http.serve_forever()
+    finally:
+        server.shutdown_app()
+
+
+if __name__ == "__main__":
+    main()
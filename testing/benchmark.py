@@ -0,0 +1,351 @@
+"""
+In-process benchmark of the server's HTTP endpoints.
+
+The app is driven through Flask's test client, so no server, network or real
+credentials are needed. The stores are seeded in a temporary folder with a
+generated dataset first; the same options always generate the same dataset, so
+the results of two commits can be compared:
+
+    python testing/benchmark.py --dataset small --output before.json
+    ... change the code ...
+    python testing/benchmark.py --dataset small --output after.json --compare before.json
+
+Datasets (every count can be overridden with --messages, --images, --devices):
+
+    small       10 000 messages,     1 000 images,    10 devices
+    medium     100 000 messages,    10 000 images,   100 devices
+    large    1 000 000 messages,   100 000 images, 1 000 devices
+
+Every endpoint is measured, except the ones that can't be answered in one
+request/response: the WebSockets (/ws, /beacon-ws), the Server-Sent Events of
+/device-events, and the WebRTC negotiation of /audio/publish and /audio/listen.
+
+The result is JSON: for every scenario the throughput and the p50 / p99 / max
+latency of one request, and the status codes received. The background work a
+scenario leaves behind (the image variants rendered after the uploads) is
+finished before the next scenario starts; the time it took is its background_s.
+"""
+import argparse
+import base64
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_IMAGES_DIR = os.path.join(REPO_DIR, "testing", "test_images")
+
+DATASETS = {
+    "small": {"messages": 10_000, "images": 1_000, "devices": 10},
+    "medium": {"messages": 100_000, "images": 10_000, "devices": 100},
+    "large": {"messages": 1_000_000, "images": 100_000, "devices": 1_000},
+}
+
+# First timestamp of the generated data; the items follow each other by one second
+BASE_TIME = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+# Telemetry readings generated per device
+READINGS_PER_DEVICE = 100
+
+# Scenarios that return the whole dataset are run at most this many times
+HEAVY_REQUESTS = 5
+
+USERNAME = "bench"
+PASSWORD = "bench-password"
+METRICS_TOKEN = "bench-metrics-token"
+
+
+def DeviceIds(count):
+    return [f"Beacon_{i:04d}" for i in range(count)]
+
+
+def SeedImages(count, devices):
+    """Write the images in the layout of ImageStore; the catalog is built from them at startup."""
+    import ImageStore
+
+    sources = sorted(os.path.join(TEST_IMAGES_DIR, name) for name in os.listdir(TEST_IMAGES_DIR) if name.endswith(".png"))
+    for i in range(count):
+        deviceId = devices[i % len(devices)]
+        captured = (BASE_TIME + datetime.timedelta(seconds=i)).strftime("%Y%m%d%H%M%S")
+        path = os.path.join(ImageStore.UPLOADS_DIR, deviceId, captured[:8], f"{captured}-0.png")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        source = sources[i % len(sources)]
+        # Hard links keep the large datasets small on disk
+        try:
+            os.link(source, path)
+        except OSError:
+            shutil.copyfile(source, path)
+
+
+def SeedStores(messages, devices, rng):
+    """Fill the users, messages, devices, telemetry and actions through the app's own stores."""
+    from werkzeug.security import generate_password_hash
+
+    import ActionQueue
+    import Database
+    import DeviceManager
+    import MessageStore
+
+    Database.Get("users").insert({"username": USERNAME, "password": generate_password_hash(PASSWORD)})
+
+    repository = MessageStore.Get()
+    batch = []
+    for i in range(messages):
+        timestamp = (BASE_TIME + datetime.timedelta(seconds=i)).isoformat()
+        batch.append({"deviceId": devices[i % len(devices)], "message": f"message {i} {rng.random():.6f}", "timestamp": timestamp})
+        if len(batch) == 10_000:
+            repository.insert_multiple(batch)
+            batch = []
+    if batch:
+        repository.insert_multiple(batch)
+
+    start = BASE_TIME.timestamp()
+    updates = []
+    for deviceId in devices:
+        for i in range(READINGS_PER_DEVICE):
+            updates.append({
+                "deviceId": deviceId,
+                "timestamp": start + i * 60,
+                "batteryLevel": rng.uniform(20, 100),
+                "controllerBattery": rng.uniform(20, 100),
+                "coreTemp": rng.uniform(30, 70),
+                "houseTemp": rng.uniform(-10, 40),
+                "latency": rng.uniform(10, 300),
+            })
+    DeviceManager.UpdateBeaconDataBatch(updates)
+
+    queue = ActionQueue.Get()
+    for deviceId in devices[:10]:
+        queue.push("take-photo", deviceId=deviceId)
+
+    DeviceManager.GetRegistry().flush()
+    Database.FlushAll()
+
+
+def Scenarios(client, devices):
+    """Return the (name, request function, maximal number of requests) of every scenario."""
+    tokens = client.post("/login", json={"username": USERNAME, "password": PASSWORD}).get_json()
+    auth = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+    with open(os.path.join(TEST_IMAGES_DIR, "1.png"), "rb") as f:
+        image = f.read()
+    imageBase64 = base64.b64encode(image).decode()
+
+    def device(i):
+        return devices[i % len(devices)]
+
+    start = BASE_TIME.timestamp()
+    end = start + READINGS_PER_DEVICE * 60
+    cameraEtag = client.get("/get-camera-configuration", headers=auth).headers.get("ETag")
+    commandsEtag = client.get("/get-commands", headers=auth).headers.get("ETag")
+
+    return [
+        ("GET /", lambda i: client.get("/"), None),
+        ("POST /login", lambda i: client.post("/login", json={"username": USERNAME, "password": PASSWORD}), None),
+        ("POST /refresh", lambda i: client.post("/refresh", json={"refresh_token": tokens["refresh_token"]}), None),
+        ("GET /ping", lambda i: client.get("/ping", headers=auth), None),
+        ("GET /metrics", lambda i: client.get("/metrics", headers={"Authorization": f"Bearer {METRICS_TOKEN}"}), None),
+        ("GET /get-devices", lambda i: client.get("/get-devices", headers=auth), None),
+        ("GET /get-device-info", lambda i: client.get("/get-device-info", query_string={"deviceId": device(i)}, headers=auth), None),
+        ("GET /get-telemetry", lambda i: client.get("/get-telemetry", query_string={"deviceId": device(i), "from": start, "to": end}, headers=auth), None),
+        ("GET /get-messages (all)", lambda i: client.get("/get-messages", headers=auth), HEAVY_REQUESTS),
+        ("GET /get-messages (device)", lambda i: client.get("/get-messages", query_string={"deviceId": device(i)}, headers=auth), HEAVY_REQUESTS),
+        ("GET /get-messages (page)", lambda i: client.get("/get-messages", query_string={"deviceId": device(i), "limit": 100}, headers=auth), None),
+        ("GET /get-messages (ndjson)", lambda i: client.get("/get-messages", query_string={"format": "ndjson"}, headers=auth), HEAVY_REQUESTS),
+        ("GET /get-images", lambda i: client.get("/get-images", query_string={"deviceId": device(i)}, headers=auth), None),
+        ("GET /get-images-archive", lambda i: client.get("/get-images-archive", query_string={"deviceId": device(i)}, headers=auth), HEAVY_REQUESTS),
+        ("GET /get-image-count", lambda i: client.get("/get-image-count", headers=auth), None),
+        ("GET /last-image", lambda i: client.get("/last-image", query_string={"index": i % 10 + 1}, headers=auth), None),
+        ("GET /last-image (thumb)", lambda i: client.get("/last-image", query_string={"index": i % 10 + 1, "size": "thumb"}, headers=auth), None),
+        ("POST /set-actions", lambda i: client.post("/set-actions", query_string={"action": "take-photo", "deviceId": device(i)}, headers=auth), None),
+        ("GET /get-actions", lambda i: client.get("/get-actions", query_string={"deviceId": device(i)}, headers=auth), None),
+        ("GET /get-actions (ack)", lambda i: client.get("/get-actions", query_string={"deviceId": device(i), "ack": 1}, headers=auth), None),
+        ("POST /ack-actions", lambda i: client.post("/ack-actions", json={"ids": []}, headers=auth), None),
+        ("POST /send-message", lambda i: client.post("/send-message", json={"deviceId": device(i), "message": f"benchmark {i}"}, headers=auth), None),
+        ("POST /send-info", lambda i: client.post("/send-info", json={"deviceId": device(i), "batteryLevel": 80, "coreTemp": 45.5, "latency": 120}, headers=auth), None),
+        ("POST /ingest", lambda i: client.post("/ingest", json={"deviceId": device(i), "items": [{"type": "info", "batteryLevel": 80}] * 50 + [{"type": "message", "message": "m"}] * 50}, headers=auth), None),
+        ("POST /send-image (raw)", lambda i: client.post("/send-image", query_string={"deviceId": device(i)}, data=image, content_type="image/png", headers=auth), None),
+        ("POST /send-image (base64)", lambda i: client.post("/send-image", json={"deviceId": device(i), "image": imageBase64}, headers=auth), None),
+        ("POST /configure-camera", lambda i: client.post("/configure-camera", json={"Sharpness": 1.0 + i % 10 / 10}, query_string={"deviceId": device(i)}, headers=auth), None),
+        ("POST /configure-beacon", lambda i: client.post("/configure-beacon", json={"config": {"interval": 60}}, headers=auth), None),
+        ("GET /get-beacon-configuration", lambda i: client.get("/get-beacon-configuration", headers=auth), None),
+        ("GET /get-camera-configuration", lambda i: client.get("/get-camera-configuration", headers=auth), None),
+        ("GET /get-camera-configuration (304)", lambda i: client.get("/get-camera-configuration", headers={**auth, "If-None-Match": cameraEtag}), None),
+        ("GET /get-commands", lambda i: client.get("/get-commands", headers=auth), None),
+        ("GET /get-commands (304)", lambda i: client.get("/get-commands", headers={**auth, "If-None-Match": commandsEtag}), None),
+        ("GET /audio/sessions", lambda i: client.get("/audio/sessions", headers=auth), None),
+    ]
+
+
+def Percentile(values, q):
+    """Nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def Measure(request, count, warmup):
+    """Run one scenario and return its statistics."""
+    for i in range(warmup):
+        request(i).close()
+
+    latencies = []
+    statuses = {}
+    started = time.perf_counter()
+    for i in range(count):
+        t = time.perf_counter()
+        response = request(warmup + i)
+        # Streamed bodies are only produced when they are read
+        response.get_data()
+        response.close()
+        latencies.append(time.perf_counter() - t)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": count,
+        "throughput_rps": round(count / elapsed, 1),
+        "p50_ms": round(Percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(Percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / count * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "status": {str(code): n for code, n in sorted(statuses.items())},
+    }
+
+
+def GitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def Compare(results, baseline):
+    """Print the change of the p50 / p99 latencies against a previous result file."""
+    print(f"{'scenario':<40} {'p50 ms':>18} {'p99 ms':>18}", file=sys.stderr)
+    for name, current in results["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        cells = []
+        for key in ("p50_ms", "p99_ms"):
+            change = (current[key] - previous[key]) / previous[key] * 100 if previous[key] else 0.0
+            cells.append(f"{current[key]:>9.3f} {change:>+7.1f}%")
+        print(f"{name:<40} {cells[0]:>18} {cells[1]:>18}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process benchmark of the Beacon server")
+    parser.add_argument("--dataset", choices=sorted(DATASETS), default="small")
+    parser.add_argument("--messages", type=int, help="Override the number of messages of the dataset")
+    parser.add_argument("--images", type=int, help="Override the number of images of the dataset")
+    parser.add_argument("--devices", type=int, help="Override the number of devices of the dataset")
+    parser.add_argument("--backend", choices=("sqlite", "tinydb"), default="sqlite", help="Message storage backend")
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests before every scenario")
+    parser.add_argument("--only", help="Run only the scenarios whose name contains this text")
+    parser.add_argument("--no-metrics", action="store_true", help="Disable the metrics recording of the server")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the generated data")
+    parser.add_argument("--output", help="Write the JSON result to this file (default: standard output)")
+    parser.add_argument("--compare", help="Print the change against a previous JSON result")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary folder of the dataset")
+    args = parser.parse_args()
+
+    dataset = dict(DATASETS[args.dataset])
+    for key in dataset:
+        if getattr(args, key) is not None:
+            dataset[key] = getattr(args, key)
+
+    outputPath = os.path.abspath(args.output) if args.output else None
+    comparePath = os.path.abspath(args.compare) if args.compare else None
+
+    # The stores use paths relative to the working directory: the dataset lives in a folder of its own
+    workDir = tempfile.mkdtemp(prefix="beacon-benchmark-")
+    os.makedirs(os.path.join(workDir, "database"))
+    for name in ("camera-config.json", "commands.txt"):
+        shutil.copyfile(os.path.join(REPO_DIR, "database", name), os.path.join(workDir, "database", name))
+    os.chdir(workDir)
+    sys.path.insert(0, REPO_DIR)
+
+    import app as server
+    import ImageVariants
+
+    config = server.load_config(os.path.join(REPO_DIR, "database", "server-config.json"))
+    config["server"]["log_to_file"] = False
+    config["server"]["secret_key"] = "benchmark-secret-key-of-at-least-32-bytes"
+    config["storage"]["messages_backend"] = args.backend
+    config["images"]["watch_interval"] = 0
+    # The generated telemetry is older than the raw retention: keep it as it was written
+    config["telemetry"]["compact_interval"] = 0
+    config["logging"] = {"level": "WARNING", "format": "text"}
+    config["metrics"] = {"enabled": not args.no_metrics, "token": METRICS_TOKEN}
+
+    rng = random.Random(args.seed)
+    devices = DeviceIds(dataset["devices"])
+    timings = {}
+
+    try:
+        t = time.perf_counter()
+        SeedImages(dataset["images"], devices)
+        timings["seed_images_s"] = round(time.perf_counter() - t, 3)
+
+        # The image catalog is built from the uploads folder here
+        t = time.perf_counter()
+        application = server.create_app(config)
+        timings["startup_s"] = round(time.perf_counter() - t, 3)
+
+        t = time.perf_counter()
+        SeedStores(dataset["messages"], devices, rng)
+        timings["seed_stores_s"] = round(time.perf_counter() - t, 3)
+
+        client = application.test_client()
+        results = {}
+        for name, request, limit in Scenarios(client, devices):
+            if args.only and args.only not in name:
+                continue
+            count = min(args.requests, limit) if limit else args.requests
+            results[name] = Measure(request, count, min(args.warmup, count))
+            # Waits for the pending variant renders, so they don't slow down the next scenario
+            t = time.perf_counter()
+            ImageVariants.Shutdown()
+            results[name]["background_s"] = round(time.perf_counter() - t, 3)
+            print(f"{name:<40} {results[name]['p50_ms']:>9.3f} ms p50 {results[name]['p99_ms']:>9.3f} ms p99 "
+                  f"{results[name]['throughput_rps']:>9.1f} req/s", file=sys.stderr)
+    finally:
+        server.shutdown_app()
+        os.chdir(REPO_DIR)
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    output = {
+        "commit": GitCommit(),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "dataset": {"name": args.dataset, "backend": args.backend, "seed": args.seed, **dataset},
+        "requests": args.requests,
+        "metrics": not args.no_metrics,
+        "setup": timings,
+        "results": results,
+    }
+
+    text = json.dumps(output, indent=2)
+    if outputPath:
+        with open(outputPath, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if comparePath:
+        with open(comparePath, "r", encoding="utf-8") as f:
+            Compare(output, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+Load generator: a fleet of virtual Beacons in one process.
+
+Every Beacon is a set of asyncio tasks, so thousands of them run on one event
+loop. They all share one BeaconShell.AsyncBeaconClient: one pool of kept-alive
+connections and one token. Each Beacon:
+
+    -sends its telemetry every --info-interval seconds. The battery drains by
+     --battery-drain percent per hour, and the temperatures wander randomly by
+     --temp-drift degrees per reading.
+    -sends a message every --message-interval seconds
+    -uploads a PNG every --image-interval seconds
+    -polls its actions every --poll-interval seconds and acknowledges them
+
+With --ingest-interval the telemetry and messages are buffered on the Beacon and
+sent in one /ingest request, like a Beacon with an unreliable link. An interval
+of 0 disables the activity. The intervals get +-JITTER random spread, and the
+Beacons start spread over --ramp-up seconds, so the fleet does not send in
+lockstep.
+
+The load is open loop: the requests are started on a fixed timeline, each one in
+its own task, whether or not the previous ones were answered. A server that can't
+keep up shows as growing latencies and errors instead of a lower request rate.
+
+    python testing/fleetSimulator.py --url http://127.0.0.1:5000 --username beacon --password ... --beacons 2000 --duration 600
+
+The achieved rates are printed every --report-interval seconds. At the end a
+JSON summary is written with the target and achieved rate of every request type,
+the p50 / p95 / p99 latencies, and the errors per status code or exception. The
+latencies don't include the time spent waiting for a free connection of the
+--connections pool; that is reported separately as pool_wait.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BeaconShell
+
+TEST_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_images")
+
+# Relative random spread of the intervals
+JITTER = 0.1
+
+
+class OperationStats:
+    """Latencies and outcomes of one request type."""
+
+    def __init__(self):
+        self.latencies = []
+        self.poolWaits = []
+        self.errors = {}
+        self.reported = 0
+
+    def record(self, latency, error=None, poolWait=0.0):
+        self.latencies.append(latency)
+        self.poolWaits.append(poolWait)
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def summary(self, elapsed, target):
+        latencies = sorted(self.latencies)
+        poolWaits = sorted(self.poolWaits)
+
+        def percentile(q, values=latencies):
+            return round(values[max(0, math.ceil(q * len(values)) - 1)] * 1000, 2) if values else None
+
+        return {
+            "requests": len(latencies),
+            "errors": sum(self.errors.values()),
+            "target_rps": round(target, 2),
+            "achieved_rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+            "pool_wait_p50_ms": percentile(0.50, poolWaits),
+            "pool_wait_p99_ms": percentile(0.99, poolWaits),
+            "pool_wait_max_ms": round(poolWaits[-1] * 1000, 2) if poolWaits else None,
+            "error_types": dict(sorted(self.errors.items())),
+        }
+
+
+class Fleet:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.stats = {}
+        self.rng = random.Random(args.seed)
+        self.stopping = asyncio.Event()
+        # The actions started by every() and not finished yet
+        self.pending = set()
+        self.images = []
+        for name in sorted(os.listdir(TEST_IMAGES_DIR)):
+            if name.endswith(".png"):
+                with open(os.path.join(TEST_IMAGES_DIR, name), "rb") as f:
+                    self.images.append(f.read())
+
+    @staticmethod
+    def trace_config():
+        """aiohttp tracing that adds the time a request waited for a pooled connection to its 'poolWait'."""
+        config = BeaconShell.aiohttp.TraceConfig()
+
+        async def queued_start(session, context, params):
+            context.queuedAt = time.perf_counter()
+
+        async def queued_end(session, context, params):
+            context.trace_request_ctx["poolWait"] += time.perf_counter() - context.queuedAt
+
+        config.on_connection_queued_start.append(queued_start)
+        config.on_connection_queued_end.append(queued_end)
+        return config
+
+    async def call(self, operation, method, endpoint, **kwargs):
+        """Send one request and record its latency and outcome; returns the body, or None on error."""
+        stats = self.stats.setdefault(operation, OperationStats())
+        # Filled by trace_config(), over every attempt of the request
+        trace = {"poolWait": 0.0}
+        started = time.perf_counter()
+        try:
+            status, body = await self.client.request(method, endpoint, trace_request_ctx=trace, **kwargs)
+        except (BeaconShell.aiohttp.ClientError, asyncio.TimeoutError, BeaconShell.AuthError) as e:
+            stats.record(time.perf_counter() - started - trace["poolWait"], type(e).__name__, trace["poolWait"])
+            return None
+        stats.record(time.perf_counter() - started - trace["poolWait"], None if status < 400 else str(status), trace["poolWait"])
+        return body if status < 400 else None
+
+    async def every(self, interval, action):
+        """
+        Start 'action' every 'interval' seconds (with jitter) until the fleet stops.
+
+        The start times are on a fixed timeline and every action runs in its own task,
+        so a slow answer doesn't delay the next request (open loop).
+        """
+        if not interval:
+            return
+        loop = asyncio.get_running_loop()
+        # Random phase, so the Beacons started together don't send together
+        due = loop.time() + self.rng.uniform(0, interval)
+        while True:
+            try:
+                await asyncio.wait_for(self.stopping.wait(), max(0.0, due - loop.time()))
+                return
+            except asyncio.TimeoutError:
+                pass
+            task = asyncio.create_task(action())
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+            # From the previous due time, not from now, so the rate doesn't drift when the loop lags
+            due += interval * self.rng.uniform(1 - JITTER, 1 + JITTER)
+
+    async def beacon(self, deviceId, startDelay):
+        args = self.args
+        rng = random.Random(f"{args.seed}-{deviceId}")
+        state = {
+            "batteryLevel": rng.uniform(60, 100),
+            "controllerBattery": rng.uniform(60, 100),
+            "coreTemp": rng.uniform(35, 50),
+            "houseTemp": rng.uniform(10, 25),
+        }
+        drain = args.battery_drain * args.info_interval / 3600 if args.info_interval else 0
+        buffered = []
+        messageIndex = 0
+
+        def reading():
+            state["batteryLevel"] = max(0.0, state["batteryLevel"] - drain * rng.uniform(0.5, 1.5))
+            state["controllerBattery"] = max(0.0, state["controllerBattery"] - drain * rng.uniform(0.5, 1.5))
+            state["coreTemp"] += rng.gauss(0, args.temp_drift)
+            state["houseTemp"] += rng.gauss(0, args.temp_drift)
+            return {key: round(value, 2) for key, value in state.items()}
+
+        async def send_info():
+            if args.ingest_interval:
+                buffered.append({"type": "info", "timestamp": time.time(), **reading()})
+            else:
+                await self.call("send-info", "POST", "/send-info", json={"deviceId": deviceId, **reading()})
+
+        async def send_message():
+            nonlocal messageIndex
+            messageIndex += 1
+            text = f"Hello from {deviceId}, message {messageIndex}"
+            if args.ingest_interval:
+                buffered.append({"type": "message", "message": text})
+            else:
+                await self.call("send-message", "POST", "/send-message", json={"deviceId": deviceId, "message": text})
+
+        async def ingest():
+            if not buffered:
+                return
+            # The server accepts at most MAX_INGEST_ITEMS (1000) items per request. They are taken out
+            # of the buffer while in flight, so an overlapping ingest doesn't send them again.
+            items = buffered[:1000]
+            del buffered[:len(items)]
+            if await self.call("ingest", "POST", "/ingest", json={"deviceId": deviceId, "items": items}) is None:
+                buffered[:0] = items
+
+        async def send_image():
+            await self.call("send-image", "POST", "/send-image", params={"deviceId": deviceId},
+                            data=rng.choice(self.images), headers={"Content-Type": "image/png"})
+
+        async def poll_actions():
+            body = await self.call("get-actions", "GET", "/get-actions", params={"deviceId": deviceId, "ack": "1", "wait": str(args.poll_wait)})
+            ids = [action["id"] for action in (body or {}).get("actions", [])]
+            if ids:
+                await self.call("ack-actions", "POST", "/ack-actions", json={"ids": ids})
+
+        try:
+            await asyncio.wait_for(self.stopping.wait(), startDelay)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+        await asyncio.gather(
+            self.every(args.info_interval, send_info),
+            self.every(args.message_interval, send_message),
+            self.every(args.ingest_interval, ingest),
+            self.every(args.image_interval, send_image),
+            self.every(args.poll_interval, poll_actions),
+        )
+
+    def targets(self):
+        """Requests per second the whole fleet should send, per request type."""
+        args = self.args
+
+        def rate(interval):
+            return args.beacons / interval if interval else 0.0
+
+        targets = {
+            "send-image": rate(args.image_interval),
+            "get-actions": rate(args.poll_interval),
+        }
+        if args.ingest_interval:
+            targets["ingest"] = rate(args.ingest_interval)
+        else:
+            targets["send-info"] = rate(args.info_interval)
+            targets["send-message"] = rate(args.message_interval)
+        return targets
+
+    async def report(self, started):
+        last = time.monotonic()
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.args.report_interval)
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            parts = []
+            for operation, stats in sorted(self.stats.items()):
+                count = len(stats.latencies) - stats.reported
+                stats.reported = len(stats.latencies)
+                parts.append(f"{operation} {count / (now - last):.1f}/s")
+            errors = sum(sum(stats.errors.values()) for stats in self.stats.values())
+            print(f"[{now - started:6.0f} s] " + ", ".join(parts) + f", {errors} errors", file=sys.stderr)
+            last = now
+
+    async def run(self):
+        args = self.args
+        started = time.monotonic()
+        deviceIds = [f"{args.prefix}{i:05d}" for i in range(args.beacons)]
+        beacons = [asyncio.create_task(self.beacon(deviceId, args.ramp_up * i / max(args.beacons, 1)))
+                   for i, deviceId in enumerate(deviceIds)]
+        reporter = asyncio.create_task(self.report(started))
+
+        try:
+            await asyncio.sleep(args.duration)
+        finally:
+            self.stopping.set()
+            # The requests in flight are finished, not cancelled, so their latencies are counted
+            await asyncio.gather(*beacons, return_exceptions=True)
+            await asyncio.gather(*self.pending, return_exceptions=True)
+            await reporter
+
+        elapsed = time.monotonic() - started
+        # The beacons only run at full rate after the ramp-up
+        activeShare = max(0.0, 1 - args.ramp_up / 2 / elapsed)
+        targets = self.targets()
+        return {
+            "beacons": args.beacons,
+            "duration_s": round(elapsed, 1),
+            "connections": args.connections,
+            "operations": {operation: stats.summary(elapsed, targets.get(operation, 0.0) * activeShare)
+                           for operation, stats in sorted(self.stats.items())},
+        }
+
+
+async def Simulate(args):
+    client = BeaconShell.AsyncBeaconClient(args.username, args.password, baseUrl=args.url, retries=args.retries,
+                                           limit=args.connections, traceConfigs=[Fleet.trace_config()])
+    async with client:
+        await client.login()
+        return await Fleet(client, args).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a fleet of Beacons against a running server")
+    parser.add_argument("--url", default=BeaconShell.BASE_URL, help="Base URL of the server")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--beacons", type=int, default=100, help="Number of virtual Beacons")
+    parser.add_argument("--prefix", default="SimBeacon_", help="Prefix of the device IDs")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run")
+    parser.add_argument("--ramp-up", type=float, default=10, help="Seconds over which the Beacons are started")
+    parser.add_argument("--connections", type=int, default=100, help="Size of the shared connection pool")
+    parser.add_argument("--retries", type=int, default=0, help="Retries of the failed requests (0: every failure is counted)")
+    parser.add_argument("--info-interval", type=float, default=5, help="Seconds between two telemetry readings")
+    parser.add_argument("--message-interval", type=float, default=30, help="Seconds between two messages")
+    parser.add_argument("--ingest-interval", type=float, default=0, help="Buffer the readings and messages, and send them to /ingest this often")
+    parser.add_argument("--image-interval", type=float, default=300, help="Seconds between two image uploads")
+    parser.add_argument("--poll-interval", type=float, default=10, help="Seconds between two action polls")
+    parser.add_argument("--poll-wait", type=float, default=0, help="Long-poll 'wait' of the action polls")
+    parser.add_argument("--battery-drain", type=float, default=2.0, help="Battery percent drained per hour")
+    parser.add_argument("--temp-drift", type=float, default=0.05, help="Standard deviation of the temperature change per reading")
+    parser.add_argument("--report-interval", type=float, default=10, help="Seconds between two progress lines")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON summary to this file (default: standard output)")
+    args = parser.parse_args()
+
+    if BeaconShell.aiohttp is None:
+        parser.error("aiohttp is required: pip install aiohttp")
+
+    summary = asyncio.run(Simulate(args))
+
+    text = json.dumps(summary, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()